@@ -0,0 +1,372 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import m50_fixtures
+from timing import measure, measure_memory
+from devicebroker import message_scanner, xml_backend
+from devicebroker.device_cmd import codec, messages
+from devicebroker.xml_templates import escape_text
+
+# Bumped whenever the meaning of a result field changes, so old baselines are not compared against new numbers.
+FORMAT_VERSION = 2
+
+# Result fields where a higher value is a regression.
+COMPARED = ("time_us", "peak_bytes", "retained_bytes")
+
+Result = Dict[str, Any]
+
+def parse_response(response_type : type, message : str) -> Any:
+    response = response_type()
+    if isinstance(response, messages.GenericResponse):
+        response.parse_message(message)
+    else:
+        response.parse(xml_backend.current().parse(message))
+    return response
+
+def bench(op : str, variant : str, name : str, type_name : str, size : int, func : Callable[[], object], args : argparse.Namespace) -> Result:
+    elapsed = measure(func, args.min_time, args.repeat)
+    peak, retained = measure_memory(func)
+    return dict(
+        mode            = args.mode,
+        op              = op,
+        variant         = variant,
+        name            = name,
+        type            = type_name,
+        bytes           = size,
+        time_us         = elapsed * 1e6,
+        mb_per_s        = size / elapsed / 1e6,
+        peak_bytes      = peak,
+        retained_bytes  = retained,
+    )
+
+def selected(name : str, names : Optional[Tuple[str, ...]], args : argparse.Namespace) -> bool:
+    if names is not None and name not in names:
+        return False
+    return not args.filter or args.filter in name
+
+# Every request and response, serialized and parsed the way the broker does it, once per XML backend.
+def run_messages(args : argparse.Namespace) -> List[Result]:
+    results : List[Result] = []
+
+    for name, request in m50_fixtures.make_requests(args.size):
+        if not selected(name, None, args):
+            continue
+        type_name = type(request).__name__
+        size = len(request.to_bytes())
+        results.append(bench("to_str", "template", name, type_name, size, request.to_str, args))
+        results.append(bench("to_bytes", "template", name, type_name, size, request.to_bytes, args))
+        for backend_name in args.xml_backend:
+            backend = xml_backend.get(backend_name)
+            results.append(bench("build", backend.name, name, type_name, size, lambda: backend.tostring(request.to_xml()), args))
+
+    for name, response_type, message in m50_fixtures.make_responses(args.size):
+        if not selected(name, None, args):
+            continue
+        for backend_name in args.xml_backend:
+            xml_backend.select(backend_name)
+            results.append(bench("parse", backend_name, name, response_type.__name__, len(message), lambda: parse_response(response_type, message), args))
+
+    return results
+
+# Looks tags up with one find() each, the way the hand-written parse() methods used to.
+class FindFields:
+    doc : ElementTree.Element
+
+    def __init__(self, doc : ElementTree.Element):
+        super().__init__()
+        self.doc = doc
+
+    def get(self, tag : str, default : Optional[str] = None) -> Optional[str]:
+        elem = self.doc.find(tag)
+        if elem is None:
+            return default
+        return elem.text
+
+# The fixtures whose fields run through every codec.
+CODEC_RESPONSES : Tuple[str, ...] = (
+    "GetUserData", "GetUserData+face", "GetGlog", "GetDeviceInfoAll", "GetWifiSetting", "GetBellSettings", "GetAccessTimezone")
+CODEC_REQUESTS  : Tuple[str, ...] = (
+    "SetUserData", "SetFaceData", "GetFirstGlog", "GetNextGlog", "SetWifiSetting", "SetBellSettings", "SetCenterScreenMessage")
+
+# Schema codecs against per-field find() and the ElementTree serializer. Both sides of parse start from an already
+# parsed tree : fromstring() costs the same either way.
+def run_codecs(args : argparse.Namespace) -> List[Result]:
+    results : List[Result] = []
+
+    def parse_with_find(response_type : type, doc : ElementTree.Element):
+        response = response_type()
+        response.parse_fields(FindFields(doc))
+        return response
+
+    def parse_with_schema(response_type : type, doc : ElementTree.Element):
+        response = response_type()
+        response.parse(doc)
+        return response
+
+    for name, response_type, message in m50_fixtures.make_responses(args.size):
+        if not selected(name, CODEC_RESPONSES, args):
+            continue
+        doc = ElementTree.fromstring(message)
+        results.append(bench("parse", "find", name, response_type.__name__, len(message), lambda: parse_with_find(response_type, doc), args))
+        results.append(bench("parse", "schema", name, response_type.__name__, len(message), lambda: parse_with_schema(response_type, doc), args))
+
+    for name, request in m50_fixtures.make_requests(args.size):
+        if not selected(name, CODEC_REQUESTS, args):
+            continue
+        render_tree = lambda: ElementTree.tostring(request.to_xml(), encoding = "unicode")
+        if render_tree() != request.to_str():
+            raise AssertionError(f"{name} : to_str() and to_xml() disagree")
+        size = len(request.to_bytes())
+        results.append(bench("render", "tree", name, type(request).__name__, size, render_tree, args))
+        results.append(bench("render", "schema", name, type(request).__name__, size, request.to_str, args))
+
+    return results
+
+# The fixtures whose binary payload is --size bytes. Fingerprint templates keep their real, fixed size.
+BINARY_REQUESTS     : Tuple[str, ...] = ("SetFaceData", "SetUserPhoto", "EnrollFaceByPhoto")
+BINARY_RESPONSES    : Tuple[str, ...] = ("GetFaceData", "GetUserPhoto", "GetGlog+photo")
+
+# Large binary fields : rendering straight to bytes against encoding the text, and the field scanner against a tree.
+def run_binary(args : argparse.Namespace) -> List[Result]:
+    results : List[Result] = []
+
+    def parse_via_tree(response_type : type, message : str):
+        response = response_type()
+        response.parse(ElementTree.fromstring(message))
+        return response
+
+    def parse_via_message(response_type : type, message : str):
+        response = response_type()
+        response.parse_message(message)
+        return response
+
+    for name, request in m50_fixtures.make_requests(args.size):
+        if not selected(name, BINARY_REQUESTS, args):
+            continue
+        size = len(request.to_bytes())
+        # What the wire sees : the request text, UTF-8 encoded.
+        results.append(bench("render", "str", name, type(request).__name__, size, lambda: request.to_str().encode("utf-8"), args))
+        results.append(bench("render", "bytes", name, type(request).__name__, size, request.to_bytes, args))
+
+    for name, response_type, message in m50_fixtures.make_responses(args.size):
+        if not selected(name, BINARY_RESPONSES, args):
+            continue
+        results.append(bench("parse", "tree", name, response_type.__name__, len(message), lambda: parse_via_tree(response_type, message), args))
+        results.append(bench("parse", "message", name, response_type.__name__, len(message), lambda: parse_via_message(response_type, message), args))
+
+    return results
+
+# Responses with a binary field : the object holding it, and the attribute name.
+LAZY_RESPONSES : List[Tuple[str, Callable[[object], object], str]] = [
+    ("GetUserData+face"     , lambda response: response.user.face   , "data"),
+    ("GetFaceData"          , lambda response: response             , "face"),
+    ("GetFingerprintData"   , lambda response: response             , "fingerprint_data"),
+    ("GetUserPhoto"         , lambda response: response             , "photo"),
+    ("GetGlog+photo"        , lambda response: response.log         , "photo"),
+]
+
+# Deferred binary fields. eager decodes the field the way every response did before, lazy leaves it alone, raw
+# takes the base64 text to forward it to another device. Retained bytes are what each parsed response keeps.
+def run_lazy(args : argparse.Namespace) -> List[Result]:
+    results : List[Result] = []
+    responses = {name : (response_type, message) for name, response_type, message in m50_fixtures.make_responses(args.size)}
+
+    def parse_eager(response_type : type, message : str, owner : Callable[[object], object], attribute : str):
+        response = parse_response(response_type, message)
+        getattr(owner(response), attribute)
+        return response
+
+    def parse_raw(response_type : type, message : str, owner : Callable[[object], object], attribute : str):
+        return codec.raw_text(owner(parse_response(response_type, message)), attribute)
+
+    for name, owner, attribute in LAZY_RESPONSES:
+        if not selected(name, None, args):
+            continue
+        response_type, message = responses[name]
+        type_name = response_type.__name__
+        results.append(bench("parse", "eager", name, type_name, len(message), lambda: parse_eager(response_type, message, owner, attribute), args))
+        results.append(bench("parse", "lazy", name, type_name, len(message), lambda: parse_response(response_type, message), args))
+        results.append(bench("parse", "raw", name, type_name, len(message), lambda: parse_raw(response_type, message, owner, attribute), args))
+
+    return results
+
+# Precompiled request templates against rendering every field on every call, the way to_str() and to_bytes() worked
+# before templates. Small payloads (--size 1024) show the template overhead best.
+def run_templates(args : argparse.Namespace) -> List[Result]:
+    results : List[Result] = []
+
+    def render_fields(request : messages.GenericRequest) -> str:
+        parts = ["<Message><Request>", escape_text(request.cmd), "</Request>"]
+        request.schema.render_into(parts, request)
+        parts.append("</Message>")
+        return "".join(parts)
+
+    def write_fields(request : messages.GenericRequest) -> bytearray:
+        buf = bytearray(b"<Message><Request>")
+        buf += escape_text(request.cmd).encode("utf-8")
+        buf += b"</Request>"
+        request.schema.write_into(buf, request)
+        buf += b"</Message>"
+        return buf
+
+    for name, request in m50_fixtures.make_requests(args.size):
+        if not selected(name, None, args):
+            continue
+        if request.to_str() != render_fields(request) or request.to_bytes() != write_fields(request):
+            raise AssertionError(f"{name} : template output differs")
+
+        # Constant requests render to the same text whatever they hold, parameterised ones fill slots.
+        kind = "const" if messages.request_template(request.cmd, request.schema).text is not None else "param"
+        type_name = type(request).__name__
+        size = len(request.to_bytes())
+        results.append(bench("to_str", "fields", name, type_name, size, lambda: render_fields(request), args))
+        results.append(bench("to_str", kind, name, type_name, size, request.to_str, args))
+        results.append(bench("to_bytes", "fields", name, type_name, size, lambda: write_fields(request), args))
+        results.append(bench("to_bytes", kind, name, type_name, size, request.to_bytes, args))
+
+    return results
+
+# Classifying frames off the socket : a full ElementTree parse against the flat scanner.
+def run_scan(args : argparse.Namespace) -> List[Result]:
+    results : List[Result] = []
+
+    def classify_with_tree(message : str):
+        parsed_msg = ElementTree.fromstring(message)
+        if (request := parsed_msg.find("Request")) is not None:
+            return request.text, {child.tag : child.text for child in parsed_msg}
+        elif (event := parsed_msg.find("Event")) is not None:
+            return event.text, {child.tag : child.text for child in parsed_msg}
+        return None, None
+
+    def classify_with_scanner(message : str):
+        scanned = message_scanner.scan_message(message)
+        return scanned.name, scanned.fields
+
+    for name, message in m50_fixtures.make_frames(args.size):
+        if not selected(name, None, args):
+            continue
+        results.append(bench("classify", "tree", name, "frame", len(message), lambda: classify_with_tree(message), args))
+        results.append(bench("classify", "scan", name, "frame", len(message), lambda: classify_with_scanner(message), args))
+
+    return results
+
+MODES : Dict[str, Callable[[argparse.Namespace], List[Result]]] = {
+    "messages"  : run_messages,
+    "codecs"    : run_codecs,
+    "binary"    : run_binary,
+    "lazy"      : run_lazy,
+    "templates" : run_templates,
+    "scan"      : run_scan,
+}
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)),
+            capture_output = True, text = True, check = True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Speedup is against the first variant of the same op on the same message : the old way, where a mode has one.
+def print_results(results : List[Result]):
+    reference : Dict[Tuple[str, str], float] = dict()
+    for result in results:
+        reference.setdefault((result["op"], result["name"]), result["time_us"])
+
+    print("peak : tracemalloc high-water mark during one call, above what was traced before it")
+    print("kept : traced bytes still held once the call returns, i.e. by its result; neither counts allocations")
+    print(f"\n{'op':<9} {'variant':<9} {'message':<28} {'bytes':>9} {'time (us)':>11} {'MB/s':>8} {'speedup':>8} {'peak (B)':>10} {'kept (B)':>10}")
+    for result in results:
+        speedup = reference[(result["op"], result["name"])] / result["time_us"]
+        print(f"{result['op']:<9} {result['variant']:<9} {result['name']:<28} {result['bytes']:>9} {result['time_us']:>11.2f} "
+              f"{result['mb_per_s']:>8.1f} {speedup:>7.2f}x {result['peak_bytes']:>10} {result['retained_bytes']:>10}")
+
+# Rows that got worse than the baseline by more than the threshold, as printable lines.
+def compare(baseline : Dict[str, Any], report : Dict[str, Any], threshold : float) -> List[str]:
+    if baseline.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Baseline format {baseline.get('format')} is not {FORMAT_VERSION}")
+    for key in ("mode", "size", "xml_backend"):
+        if baseline["settings"][key] != report["settings"][key]:
+            print(f"warning : baseline was run with {key} = {baseline['settings'][key]}, not {report['settings'][key]}")
+
+    before = {(result["op"], result["variant"], result["name"]) : result for result in baseline["results"]}
+    regressions : List[str] = []
+
+    print(f"\n{'op':<9} {'variant':<9} {'message':<28} " + " ".join(f"{key:>15}" for key in COMPARED))
+    for result in report["results"]:
+        old = before.get((result["op"], result["variant"], result["name"]), None)
+        if old is None:
+            continue
+
+        ratios = [result[key] / old[key] if old[key] > 0 else (1.0 if result[key] <= 0 else float("inf")) for key in COMPARED]
+        print(f"{result['op']:<9} {result['variant']:<9} {result['name']:<28} " + " ".join(f"{ratio:>14.2f}x" for ratio in ratios))
+        for key, ratio in zip(COMPARED, ratios):
+            # Memory is deterministic, timings are not : small memory growth is still worth a look.
+            limit = threshold if key == "time_us" else 1.0 + (threshold - 1.0) / 4
+            if ratio > limit:
+                regressions.append(f"{result['op']} {result['variant']} {result['name']} : {key} {old[key]:.1f} -> {result[key]:.1f} ({ratio:.2f}x)")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serialize and parse cost of the m50 requests and responses")
+    parser.add_argument("--mode"        , type = str, default = "messages", choices = list(MODES), help = "What to compare, see the run_* functions")
+    parser.add_argument("--size"        , type = int, default = 64 * 1024, help = "Binary payload size in bytes (faces, photos, fingerprints, firmware)")
+    parser.add_argument("--min-time"    , type = float, default = 0.02, help = "Minimum seconds per timing run")
+    parser.add_argument("--repeat"      , type = int, default = 3, help = "Timing runs per fixture, the best one is kept")
+    parser.add_argument("--xml-backend" , type = str, nargs = "+", default = ["stdlib"], choices = xml_backend.BACKEND_NAMES,
+                        help = "Backends to time build and parse with in messages mode; the first one is used by every other mode")
+    parser.add_argument("--filter"      , type = str, default = None, help = "Only fixtures whose name contains this")
+    parser.add_argument("--json"        , type = str, default = None, help = "Write the results to this file, '-' for stdout")
+    parser.add_argument("--compare"     , type = str, default = None, help = "Baseline JSON file from an earlier run")
+    parser.add_argument("--threshold"   , type = float, default = 1.25, help = "Time ratio over the baseline counted as a regression")
+    args = parser.parse_args()
+
+    m50_fixtures.check_coverage()
+    args.xml_backend = [xml_backend.get(name).name for name in args.xml_backend]
+    xml_backend.select(args.xml_backend[0])
+
+    results = MODES[args.mode](args)
+    xml_backend.select(args.xml_backend[0])
+
+    report = dict(
+        format      = FORMAT_VERSION,
+        commit      = git_commit(),
+        date        = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec = "seconds"),
+        python      = platform.python_version(),
+        platform    = platform.platform(),
+        settings    = dict(mode = args.mode, size = args.size, min_time = args.min_time, repeat = args.repeat, xml_backend = args.xml_backend),
+        results     = results,
+    )
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent = 1)
+        print()
+    else:
+        print_results(report["results"])
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent = 1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        print(f"\n{len(regressions)} regressions against {args.compare} ({baseline.get('commit')})")
+        for regression in regressions:
+            print(f"    {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from typing import Dict, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import m50_fixtures
+from devicebroker import commands
+from devicebroker.worker import ThreadWorkerHost, WorkerHost
+
+FRAMES : Dict[str, str] = dict(m50_fixtures.make_frames(96 * 1024))
+
+PAYLOADS : Dict[str, str] = {
+    "KeepAlive"     : FRAMES["KeepAlive"],
+    "Response128K"  : FRAMES["Response"],
+}
+
+def recv_reply(pipe) -> tuple:
+    while True:
+        reply = pipe.recv()
+        if reply[0] != commands.WORKER_STATS:
+            return reply
+
+def drain_replies(pipe, count : int):
+    for _ in range(0, count):
+        recv_reply(pipe)
+
+def run_mode(host : WorkerHost, num_workers : int, num_clients : int, payload : str, count : int) -> Tuple[float, float]:
+    pipes = [host.spawn()[1] for _ in range(0, num_workers)]
+
+    for client_id in range(0, num_clients):
+        pipes[client_id % num_workers].send((commands.CLIENT_CONNECTED, client_id, True))
+
+    # Sequential round trips : one message in flight at a time.
+    rtt_count = max(count // 10, 1)
+    start_time = time.perf_counter()
+    for i in range(0, rtt_count):
+        pipe = pipes[i % num_workers]
+        pipe.send((commands.MESSAGE_FROM_CLIENT, i % num_workers, payload))
+        recv_reply(pipe)
+    latency = (time.perf_counter() - start_time) / rtt_count
+
+    # Pipelined throughput : replies are drained on separate threads so full pipes never stall the sender.
+    per_worker = max(count // num_workers, 1)
+    readers = [threading.Thread(target = drain_replies, args = (pipe, per_worker)) for pipe in pipes]
+
+    start_time = time.perf_counter()
+    for reader in readers:
+        reader.start()
+    for i in range(0, per_worker):
+        for worker_index, pipe in enumerate(pipes):
+            pipe.send((commands.MESSAGE_FROM_CLIENT, worker_index, payload))
+    for reader in readers:
+        reader.join()
+    throughput = per_worker * num_workers / (time.perf_counter() - start_time)
+
+    for pipe in pipes:
+        pipe.send((commands.STOP_WORKER, ))
+        recv_reply(pipe)
+        pipe.close()
+    host.stop()
+
+    return latency, throughput
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers" , type = int, default = 4)
+    parser.add_argument("--clients" , type = int, default = 64)
+    parser.add_argument("--count"   , type = int, default = 20000)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'payload':<14} {'rtt (us)':>10} {'msgs/s':>10}")
+    for mode, host_type in (("process", WorkerHost), ("thread", ThreadWorkerHost)):
+        for name, payload in PAYLOADS.items():
+            latency, throughput = run_mode(host_type("http://localhost:8000"), args.workers, args.clients, payload, args.count)
+            print(f"{mode:<8} {name:<14} {latency * 1e6:>10.1f} {throughput:>10.0f}")
+
+if __name__ == "__main__":
+    main()
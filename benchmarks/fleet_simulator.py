@@ -0,0 +1,496 @@
+import argparse
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import datetime
+import math
+import os
+import random
+import sys
+import threading
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from websockets.asyncio.client import ClientConnection, connect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from devicebroker import defaults, message_scanner, xml_consts
+from devicebroker.client import Client
+from devicebroker.device_cmd import messages
+from devicebroker.device_cmd.m50 import device_control, log, user_data
+
+from timing import percentile
+from m50_fixtures import encode_base64, encode_utf16, make_message, make_responses, random_bytes
+
+DEFAULT_URL                 : str = "ws://localhost:8001"
+DEFAULT_LATENCY_MEDIAN_MS   : float = 40
+DEFAULT_LATENCY_SIGMA       : float = 0.6
+DEFAULT_LATENCY_PER_KB_MS   : float = 0.2
+
+TIME_FORMAT     : str = "%Y-%m-%d-T%H:%M:%SZ"
+MAX_LOG_COUNT   : int = 100000
+
+def device_time(timestamp : float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(TIME_FORMAT)
+
+@dataclass
+class FleetOptions:
+    url                 : str = DEFAULT_URL
+    devices             : int = 1000
+    connect_rate        : float = 200           # New connections a second, across the fleet
+    duration            : float = 60
+    keepalive_interval  : float = 30
+    logs_per_minute     : float = 1.0           # TimeLog_v2 events, per device
+    admin_per_minute    : float = 0.05          # AdminLog_v2 events, per device
+    photo_size          : int = 0               # LogImage bytes, 0 for none
+    photo_ratio         : float = 1.0           # Share of TimeLogs with a photo
+    users               : int = 200             # Users on each simulated device
+    stored_logs         : int = 1000            # Logs on each device before any event
+    latency_median_ms   : float = DEFAULT_LATENCY_MEDIAN_MS
+    latency_sigma       : float = DEFAULT_LATENCY_SIGMA
+    latency_per_kb_ms   : float = DEFAULT_LATENCY_PER_KB_MS
+    seed                : int = 1
+
+# The plain counters and connect_times are only touched from the event loop. app_commands and app_failures are also
+# updated from the command threads, and count() reads then writes, which the GIL alone does not make atomic : the
+# per-name counters and samples go through count() and sample(), under the lock.
+@dataclass
+class FleetStats:
+    connect_times       : List[float] = field(default_factory = list)   # Connect to login answered, seconds
+    connect_failures    : int = 0
+    register_failures   : int = 0
+    login_failures      : int = 0
+    disconnects         : int = 0
+    online              : int = 0
+    events_sent         : Dict[str, int] = field(default_factory = dict)
+    events_acked        : Dict[str, int] = field(default_factory = dict)
+    events_nacked       : Dict[str, int] = field(default_factory = dict)
+    event_rtts          : Dict[str, List[float]] = field(default_factory = dict)
+    device_commands     : Dict[str, List[float]] = field(default_factory = dict)   # Request to answer, on the device
+    app_commands        : Dict[str, List[float]] = field(default_factory = dict)   # Round trip through the broker
+    app_failures        : Dict[str, int] = field(default_factory = dict)
+    lock                : threading.Lock = field(default_factory = threading.Lock, repr = False)
+
+    def count(self, counters : Dict[str, int], name : str):
+        with self.lock:
+            counters[name] = counters.get(name, 0) + 1
+
+    def sample(self, samples : Dict[str, List[float]], name : str, value : float):
+        with self.lock:
+            samples.setdefault(name, []).append(value)
+
+# One M50 : registers, logs in, sends events on its own timers and answers the broker one command at a time, in order,
+# as the firmware does.
+class SimulatedDevice:
+    serial_no       : str
+    options         : FleetOptions
+    stats           : FleetStats
+    photo_text      : Optional[str]
+    random          : random.Random
+    next_trans_id   : int
+    first_log_id    : int
+    next_log_id     : int
+    pending_events  : Dict[Tuple[str, str], float]
+    keepalives      : Deque[float]
+    requests        : asyncio.Queue
+    sock            : Optional[ClientConnection]
+
+    def __init__(self, index : int, options : FleetOptions, stats : FleetStats, photo_text : Optional[str]):
+        super().__init__()
+
+        self.serial_no      = f"M50SIM{index:06d}"
+        self.options        = options
+        self.stats          = stats
+        self.photo_text     = photo_text
+        self.random         = random.Random(options.seed * 1000003 + index)
+        self.next_trans_id  = 1
+        self.first_log_id   = 1
+        self.next_log_id    = options.stored_logs + 1
+        self.pending_events = dict()
+        self.keepalives     = deque()
+        self.requests       = asyncio.Queue()
+        self.sock           = None
+
+    def latency(self, payload_size : int = 0) -> float:
+        median = self.options.latency_median_ms / 1000
+        if median <= 0:
+            return 0
+        return self.random.lognormvariate(math.log(median), self.options.latency_sigma) + payload_size / 1024 * self.options.latency_per_kb_ms / 1000
+
+    async def run(self, deadline : float):
+        start_time = time.monotonic()
+        try:
+            sock = await connect(self.options.url, max_size = None, ping_interval = None, open_timeout = 30)
+        except Exception:
+            self.stats.connect_failures += 1
+            return
+
+        self.sock = sock
+        tasks : List[asyncio.Task] = []
+        online = False
+        try:
+            if not await self.log_in():
+                return
+            self.stats.connect_times.append(time.monotonic() - start_time)
+            self.stats.online += 1
+            online = True
+
+            tasks = [
+                asyncio.create_task(self.answer_requests()),
+                asyncio.create_task(self.send_keepalives()),
+                asyncio.create_task(self.send_events("TimeLog_v2", self.options.logs_per_minute, self.time_log)),
+                asyncio.create_task(self.send_events("AdminLog_v2", self.options.admin_per_minute, self.admin_log)),
+            ]
+            try:
+                await asyncio.wait_for(self.receive(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            else:
+                self.stats.disconnects += 1
+
+        except Exception:
+            self.stats.disconnects += 1
+
+        finally:
+            if online:
+                self.stats.online -= 1
+            for task in tasks:
+                task.cancel()
+            await sock.close()
+
+    async def log_in(self) -> bool:
+        await self.sock.send(make_message(
+            (message_scanner.TAG_REQUEST, "Register"),
+            (xml_consts.TAG_DEVICE_SERIAL_NO, self.serial_no),
+            ("TerminalType", "attendance"),
+            ("ProductName", "M50"),
+            ("CloudId", f"sim-{self.serial_no.lower()}")))
+        fields = message_scanner.scan_message(await self.sock.recv(), ()).fields
+        token = fields.get(xml_consts.TAG_TOKEN)
+        if fields.get(xml_consts.TAG_RESULT) != xml_consts.RESULT_OK or not token:
+            self.stats.register_failures += 1
+            return False
+
+        await self.sock.send(make_message(
+            (message_scanner.TAG_REQUEST, "Login"),
+            (xml_consts.TAG_DEVICE_SERIAL_NO, self.serial_no),
+            (xml_consts.TAG_TOKEN, token)))
+        fields = message_scanner.scan_message(await self.sock.recv(), ()).fields
+        if fields.get(xml_consts.TAG_RESULT) != xml_consts.RESULT_OK:
+            self.stats.login_failures += 1
+            return False
+        return True
+
+    async def receive(self):
+        async for message in self.sock:
+            scanned = message_scanner.scan_message(message, ())
+            if scanned.kind == message_scanner.KIND_REQUEST:
+                self.requests.put_nowait((time.monotonic(), scanned.name, scanned.fields, len(message)))
+                continue
+
+            name = scanned.fields.get(xml_consts.TAG_RESPONSE)
+            if name == "KeepAlive":
+                if self.keepalives:
+                    self.stats.sample(self.stats.event_rtts, name, time.monotonic() - self.keepalives.popleft())
+                    self.stats.count(self.stats.events_acked, name)
+                continue
+
+            sent_time = self.pending_events.pop((name, scanned.fields.get(xml_consts.TAG_TRANS_ID)), None)
+            if sent_time is None:
+                continue
+            self.stats.sample(self.stats.event_rtts, name, time.monotonic() - sent_time)
+            if scanned.fields.get(xml_consts.TAG_RESULT) == xml_consts.RESULT_OK:
+                self.stats.count(self.stats.events_acked, name)
+            else:
+                self.stats.count(self.stats.events_nacked, name)
+
+    async def answer_requests(self):
+        while True:
+            received_time, name, fields, size = await self.requests.get()
+            response = self.respond(name, fields)
+            # Time spent queued behind earlier commands counts too.
+            await asyncio.sleep(self.latency(size + len(response)))
+            await self.sock.send(response)
+            self.stats.sample(self.stats.device_commands, name or "?", time.monotonic() - received_time)
+
+    async def send_keepalives(self):
+        # Devices that came online together do not keep their KeepAlives in step.
+        await asyncio.sleep(self.random.uniform(0, self.options.keepalive_interval))
+        while True:
+            self.keepalives.append(time.monotonic())
+            self.stats.count(self.stats.events_sent, "KeepAlive")
+            await self.sock.send(make_message((message_scanner.TAG_EVENT, "KeepAlive"), (xml_consts.TAG_DEVICE_SERIAL_NO, self.serial_no)))
+            await asyncio.sleep(self.options.keepalive_interval)
+
+    # Poisson arrivals at per_minute events a minute.
+    async def send_events(self, name : str, per_minute : float, build : Callable[[str], List[Tuple[str, Optional[str]]]]):
+        if per_minute <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.random.expovariate(per_minute / 60))
+            trans_id = str(self.next_trans_id)
+            self.next_trans_id += 1
+            self.pending_events[(name, trans_id)] = time.monotonic()
+            self.stats.count(self.stats.events_sent, name)
+            await self.sock.send(make_message(
+                (message_scanner.TAG_EVENT, name),
+                (xml_consts.TAG_DEVICE_SERIAL_NO, self.serial_no),
+                ("TerminalType", "attendance"),
+                (xml_consts.TAG_TRANS_ID, trans_id),
+                *build(trans_id)))
+
+    def time_log(self, trans_id : str) -> List[Tuple[str, Optional[str]]]:
+        log_id = self.next_log_id
+        self.next_log_id += 1
+        children = self.log_fields(log_id)
+        if self.photo_text is not None and self.random.random() < self.options.photo_ratio:
+            children[-1] = ("Photo", "Yes")
+            children.append((xml_consts.TAG_LOG_IMAGE, self.photo_text))
+        return children
+
+    def admin_log(self, trans_id : str) -> List[Tuple[str, Optional[str]]]:
+        return [
+            ("LogID", trans_id),
+            ("Time", device_time(time.time())),
+            ("AdminID", "1"),
+            ("UserID", str(self.random.randint(1, max(self.options.users, 1)))),
+            ("Action", "SetUser"),
+            ("Stat", "0")]
+
+    def log_fields(self, log_id : int) -> List[Tuple[str, Optional[str]]]:
+        # Stored logs are a minute apart, ending where the events start.
+        log_time = time.time() - (self.options.stored_logs - log_id) * 60 if log_id <= self.options.stored_logs else time.time()
+        return [
+            ("LogID", str(log_id)),
+            ("Time", device_time(log_time)),
+            ("UserID", str(log_id % max(self.options.users, 1) + 1)),
+            ("AttendStat", "DutyOn" if log_id % 2 else "DutyOff"),
+            ("Action", "Face"),
+            ("JobCode", "0"),
+            ("Photo", "No")]
+
+    def user_fields(self, user_id : int) -> List[Tuple[str, Optional[str]]]:
+        return [
+            ("UserID", str(user_id)),
+            ("Name", encode_utf16(f"User {user_id}\x00")),
+            ("Privilege", "Manager" if user_id == 1 else "User"),
+            ("Enabled", "Yes"),
+            ("Depart", str(user_id % 8)),
+            ("Card", encode_base64(user_id.to_bytes(4, "little"))),
+            ("FaceEnrolled", "Yes" if user_id % 3 else "No"),
+            ("Fingers", "1" if user_id % 4 == 0 else "0")]
+
+    # A stateful answer for what the broker walks or polls, a canned one for the rest.
+    def respond(self, name : Optional[str], fields : Dict[str, Optional[str]]) -> str:
+        ok = (xml_consts.TAG_RESULT, xml_consts.RESULT_OK)
+        fail = (xml_consts.TAG_RESULT, xml_consts.RESULT_FAIL)
+        user_id = _int(fields.get("UserID"))
+
+        match name:
+            case "GetUserData":
+                if 1 <= user_id <= self.options.users:
+                    return make_message(("Response", name), ok, *self.user_fields(user_id))
+                return make_message(("Response", name), fail, ("Reason", "No user"))
+
+            case "GetNextUserDataExt":
+                next_id = max(user_id + 1, 1)
+                if next_id > self.options.users:
+                    return make_message(("Response", name), fail, ("Reason", "No user"))
+                return make_message(("Response", name), ok, *self.user_fields(next_id),
+                                    ("More", "Yes" if next_id < self.options.users else "No"))
+
+            case "GetGlogPosInfo":
+                return make_message(("Response", name), ok, ("LogCount", str(self.next_log_id - self.first_log_id)),
+                                    ("MaxCount", str(MAX_LOG_COUNT)), ("StartPos", str(self.first_log_id)))
+
+            case "GetFirstGlog" | "GetNextGlog":
+                log_id = max(_int(fields.get("BeginLogPos")), self.first_log_id)
+                if log_id >= self.next_log_id:
+                    return make_message(("Response", name), fail, ("Reason", "No data"))
+                return make_message(("Response", name), ok, *self.log_fields(log_id))
+
+            case "DeleteGlogWithPos":
+                self.first_log_id = min(max(_int(fields.get("EndPos")) + 1, self.first_log_id), self.next_log_id)
+                return make_message(("Response", name), ok)
+
+            case "GetTime":
+                return make_message(("Response", name), ok, ("Time", device_time(time.time())))
+
+            case "GetFaceData" | "GetUserPhoto":
+                if self.photo_text is None or not 1 <= user_id <= self.options.users:
+                    return make_message(("Response", name), fail, ("Reason", "No data"))
+                tag = "FaceData" if name == "GetFaceData" else "PhotoData"
+                return make_message(("Response", name), ok, ("UserID", str(user_id)), (tag, self.photo_text))
+
+        canned = CANNED_RESPONSES.get(name, None)
+        if canned is not None:
+            return canned
+        return make_message(("Response", name), ok)
+
+def _int(text : Optional[str]) -> int:
+    try:
+        return int(text) if text else 0
+    except ValueError:
+        return 0
+
+# Fixture answers by the Response name the device gives them, for commands without a stateful answer above.
+CANNED_RESPONSES : Dict[str, str] = {
+    message_scanner.scan_message(message, ()).fields.get(xml_consts.TAG_RESPONSE) : message
+    for name, _, message in reversed(make_responses(16)) if "+" not in name
+}
+
+# What an application asks while the fleet is busy, with relative weights.
+APP_COMMANDS : List[Tuple[str, Callable[[random.Random, FleetOptions], messages.GenericRequest], int]] = [
+    ("GetUserData"          , lambda rnd, options: user_data.GetUserDataRequest(rnd.randint(1, max(options.users, 1))), 4),
+    ("GetGlogPosInfo"       , lambda rnd, options: log.GetGlogPosInfoRequest(), 3),
+    ("GetFirstGlog"         , lambda rnd, options: log.GetFirstGlogRequest(begin_pos = rnd.randint(1, max(options.stored_logs, 1))), 2),
+    ("GetDeviceStatusAll"   , lambda rnd, options: device_control.GetDeviceStatusAllRequest(), 1),
+    ("GetTime"              , lambda rnd, options: device_control.GetTimeRequest(), 1),
+]
+
+# Commands through the broker's application socket, the way an application sends them : blocking, one at a time on
+# each connection.
+def drive_commands(sock_name : str, rate : float, options : FleetOptions, stats : FleetStats, stop : threading.Event, seed : int):
+    rnd = random.Random(seed)
+    weights = [weight for _, _, weight in APP_COMMANDS]
+    client = Client(sock_name)
+    devices = []
+    refreshed = 0.0
+    try:
+        while not stop.wait(rnd.expovariate(rate)):
+            if time.monotonic() - refreshed > 5:
+                devices = client.get_all_online_devices()
+                refreshed = time.monotonic()
+            if not devices:
+                continue
+
+            name, build, _ = rnd.choices(APP_COMMANDS, weights)[0]
+            start_time = time.monotonic()
+            try:
+                build(rnd, options).transact(client, rnd.choice(devices).connection_id)
+            except Exception:
+                stats.count(stats.app_failures, name)
+                continue
+            stats.sample(stats.app_commands, name, time.monotonic() - start_time)
+    finally:
+        client.close()
+
+async def run_fleet(options : FleetOptions, stats : FleetStats, report_interval : float):
+    photo_text = encode_base64(random_bytes(options.photo_size)) if options.photo_size > 0 else None
+    start_time = time.monotonic()
+    deadline = start_time + options.duration
+
+    async def report():
+        last_sent = 0
+        while True:
+            await asyncio.sleep(report_interval)
+            sent = sum(stats.events_sent.values())
+            print(f"{time.monotonic() - start_time:7.1f}s  online {stats.online:>6}  "
+                  f"events/s {(sent - last_sent) / report_interval:>9.1f}  connect failures {stats.connect_failures}")
+            last_sent = sent
+
+    reporter = asyncio.create_task(report()) if report_interval > 0 else None
+    tasks : List[asyncio.Task] = []
+    for index in range(0, options.devices):
+        # Connections opened at connect_rate, as after a broker restart.
+        delay = start_time + index / options.connect_rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(SimulatedDevice(index, options, stats, photo_text).run(deadline)))
+
+    await asyncio.gather(*tasks)
+    if reporter is not None:
+        reporter.cancel()
+
+def print_latencies(title : str, samples : Dict[str, List[float]], failures : Optional[Dict[str, int]] = None):
+    if not samples and not failures:
+        return
+    print(f"\n{title:<22} {'count':>8} {'fail':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name in sorted(set(samples) | set(failures or ())):
+        values = samples.get(name, [])
+        print(f"{name:<22} {len(values):>8} {(failures or {}).get(name, 0):>6} "
+              + " ".join(f"{percentile(values, fraction) * 1000:>9.1f}" for fraction in (0.5, 0.9, 0.99, 1.0)))
+
+def print_report(stats : FleetStats, elapsed : float, ramp : float):
+    connected = len(stats.connect_times)
+    print(f"\nconnected {connected}, failed : connect {stats.connect_failures}, register {stats.register_failures}, "
+          f"login {stats.login_failures}, dropped {stats.disconnects}")
+    if connected:
+        print(f"connection rate {connected / max(ramp, 1e-9):.1f}/s, connect to login "
+              f"p50 {percentile(stats.connect_times, 0.5) * 1000:.1f} ms, p99 {percentile(stats.connect_times, 0.99) * 1000:.1f} ms")
+
+    print(f"\n{'event':<22} {'sent':>8} {'acked':>8} {'failed':>8} {'acked/s':>9}")
+    for name in sorted(stats.events_sent):
+        acked = stats.events_acked.get(name, 0)
+        print(f"{name:<22} {stats.events_sent[name]:>8} {acked:>8} {stats.events_nacked.get(name, 0):>8} {acked / elapsed:>9.1f}")
+
+    print_latencies("event ack", stats.event_rtts)
+    print_latencies("device command", stats.device_commands)
+    print_latencies("application command", stats.app_commands, stats.app_failures)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Simulated M50 fleet against a running broker. Its --webapp-url must accept the registrations, as stub_webapp.py does.")
+    parser.add_argument("--url"                 , type = str, default = DEFAULT_URL)
+    parser.add_argument("--devices"             , type = int, default = 1000)
+    parser.add_argument("--connect-rate"        , type = float, default = 200)
+    parser.add_argument("--duration"            , type = float, default = 60)
+    parser.add_argument("--keepalive-interval"  , type = float, default = 30)
+    parser.add_argument("--logs-per-minute"     , type = float, default = 1.0)
+    parser.add_argument("--admin-per-minute"    , type = float, default = 0.05)
+    parser.add_argument("--photo-size"          , type = int, default = 0)
+    parser.add_argument("--photo-ratio"         , type = float, default = 1.0)
+    parser.add_argument("--users"               , type = int, default = 200)
+    parser.add_argument("--stored-logs"         , type = int, default = 1000)
+    parser.add_argument("--latency-median-ms"   , type = float, default = DEFAULT_LATENCY_MEDIAN_MS)
+    parser.add_argument("--latency-sigma"       , type = float, default = DEFAULT_LATENCY_SIGMA)
+    parser.add_argument("--latency-per-kb-ms"   , type = float, default = DEFAULT_LATENCY_PER_KB_MS)
+    parser.add_argument("--sock-name"           , type = str, default = defaults.DEF_SOCK_NAME)
+    parser.add_argument("--command-rate"        , type = float, default = 0, help = "Application commands a second, 0 for none")
+    parser.add_argument("--command-clients"     , type = int, default = 4)
+    parser.add_argument("--report-interval"     , type = float, default = 5)
+    parser.add_argument("--seed"                , type = int, default = 1)
+    args = parser.parse_args()
+
+    options = FleetOptions(
+        url                 = args.url,
+        devices             = args.devices,
+        connect_rate        = args.connect_rate,
+        duration            = args.duration,
+        keepalive_interval  = args.keepalive_interval,
+        logs_per_minute     = args.logs_per_minute,
+        admin_per_minute    = args.admin_per_minute,
+        photo_size          = args.photo_size,
+        photo_ratio         = args.photo_ratio,
+        users               = args.users,
+        stored_logs         = args.stored_logs,
+        latency_median_ms   = args.latency_median_ms,
+        latency_sigma       = args.latency_sigma,
+        latency_per_kb_ms   = args.latency_per_kb_ms,
+        seed                = args.seed)
+    stats = FleetStats()
+
+    stop = threading.Event()
+    drivers : List[threading.Thread] = []
+    if args.command_rate > 0:
+        for client_no in range(0, args.command_clients):
+            drivers.append(threading.Thread(
+                target = drive_commands,
+                args = (args.sock_name, args.command_rate / args.command_clients, options, stats, stop, args.seed * 7919 + client_no),
+                daemon = True))
+            drivers[-1].start()
+
+    start_time = time.monotonic()
+    try:
+        asyncio.run(run_fleet(options, stats, args.report_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for driver in drivers:
+            driver.join()
+
+    print_report(stats, time.monotonic() - start_time, min(args.devices / args.connect_rate, args.duration))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import base64
+import datetime
+import inspect
+import os
+import random
+import sys
+from types import ModuleType
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from devicebroker import xml_consts
+from devicebroker.device_cmd import messages
+from devicebroker.device_cmd.m50 import (access_control, attendance_setting, clear_data, device_control, device_info, log, maintenance,
+                                         misc, network_setting, user_data)
+from devicebroker.xml_templates import render_element
+
+MODULES : Tuple[ModuleType, ...] = (
+    access_control, attendance_setting, clear_data, device_control, device_info, log, maintenance, misc, network_setting, user_data)
+
+# Binary payloads are random, but the same for every run.
+_random = random.Random(0x4D3530)
+
+def random_bytes(size : int) -> bytes:
+    return _random.randbytes(size)
+
+def encode_base64(data : bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+def encode_utf16(text : str) -> str:
+    return encode_base64(text.encode("utf-16-le"))
+
+# Messages as the device firmware writes them : flat children of Message, no declaration.
+def make_message(*children : Tuple[str, str | None]) -> str:
+    return f"<{xml_consts.TAG_MESSAGE}>" + "".join(render_element(tag, text) for tag, text in children) + f"</{xml_consts.TAG_MESSAGE}>"
+
+def make_user() -> user_data.UserInfo:
+    user = user_data.UserInfo()
+    user.user_id    = 1042
+    user.name       = "Alice <Admin> & Co"
+    user.privilege  = user_data.UserPrivilege.MANAGER
+    user.enabled    = True
+    user.department = 3
+    user.timesets   = [1, -1, 3, -1, -1]
+    user.period     = (datetime.date(2024, 1, 1), datetime.date(2025, 12, 31))
+    user.card       = 0xDEADBEEF
+    user.qr         = 5
+    user.password   = "1234"
+    return user
+
+def make_requests(binary_size : int = 64 * 1024) -> List[Tuple[str, messages.GenericRequest]]:
+    data = random_bytes(binary_size)
+    return [
+        ("GetAccessTimezone"            , access_control.GetAccessTimezoneRequest(3)),
+        ("SetAccessTimezone"            , access_control.SetAccessTimezoneRequest(2, [access_control.AccessTimeSection(800, 1800)] * 7)),
+        ("GetLockControlMode"           , access_control.GetLockControlModeRequest()),
+        ("SetLockControlMode"           , access_control.SetLockControlModeRequest(access_control.LockControlMode.Restart)),
+        ("GetDepartment"                , attendance_setting.GetDepartmentRequest(1)),
+        ("SetDepartment"                , attendance_setting.SetDepartmentRequest(2, "R&D <Lab>")),
+        ("GetProxyDepartment"           , attendance_setting.GetProxyDepartmentRequest(4)),
+        ("SetProxyDepartment"           , attendance_setting.SetProxyDepartmentRequest(5, "Sales")),
+        ("GetBellSettings"              , attendance_setting.GetBellSettingsRequest()),
+        ("SetBellSettings"              , attendance_setting.SetBellSettingsRequest(5, [attendance_setting.Bell(True, 0, i, 30) for i in range(0, 24)])),
+        ("GetAutoAttendanceSettings"    , attendance_setting.GetAutoAttendanceSettingsRequest()),
+        ("SetAutoAttendanceSettings"    , attendance_setting.SetAutoAttendanceSettingsRequest(
+                                            [attendance_setting.AutoAttendance(800, 1200, attendance_setting.AttendStatus.Out)])),
+        ("ClearAllData"                 , clear_data.ClearAllDataRequest()),
+        ("ClearUserData"                , clear_data.ClearUserDataRequest()),
+        ("TakeOffManager"               , clear_data.TakeOffManagerRequest()),
+        ("ClearAttendanceLog"           , clear_data.ClearAttendanceLogRequest()),
+        ("ClearManagementLog"           , clear_data.ClearManagementLogRequest()),
+        ("EnableDevice"                 , device_control.EnableDeviceRequest(True)),
+        ("GetTime"                      , device_control.GetTimeRequest()),
+        ("SetTime"                      , device_control.SetTimeRequest(datetime.datetime(2024, 5, 1, 8, 59, 12))),
+        ("GetDeviceStatus"              , device_control.GetDeviceStatusRequest(device_control.DeviceStatusParamType.FaceCount)),
+        ("GetDeviceStatusAll"           , device_control.GetDeviceStatusAllRequest()),
+        ("GetDeviceInfo"                , device_info.GetDeviceInfoRequest(device_info.DeviceInfoParamType.Language)),
+        ("SetDeviceInfo"                , device_info.SetDeviceInfoRequest(device_info.DeviceInfoParamType.SoundVolume, 7)),
+        ("GetDeviceInfoAll"             , device_info.GetDeviceInfoAllRequest()),
+        ("GetDeviceInfoExt"             , device_info.GetDeviceInfoExtRequest(device_info.DeviceInfoExtParamType.WebServerUrl)),
+        ("SetDeviceInfoExt"             , device_info.SetDeviceInfoExtRequest(device_info.DeviceInfoExtParamType.WebServerUrl, "http://host/a?b=1&c=2")),
+        ("GetFirstGlog"                 , log.GetFirstGlogRequest(1042, datetime.datetime(2024, 1, 1), datetime.datetime(2024, 12, 31))),
+        ("GetNextGlog"                  , log.GetNextGlogRequest(123457)),
+        ("GetGlogPosInfo"               , log.GetGlogPosInfoRequest()),
+        ("DeleteGlogWithPos"            , log.DeleteGlogWithPosRequest(123457)),
+        ("GetFirmwareVersion"           , maintenance.GetFirmwareVersionRequest()),
+        ("WriteFirmware"                , maintenance.WriteFirmwareRequest("http://host/firmware.bin")),
+        ("GetCenterScreenMessage"       , misc.GetCenterScreenMessageSettingRequest()),
+        ("SetCenterScreenMessage"       , misc.SetCenterScreenMessageSettingRequest(misc.CenterScreenMessageSetting("Welcome", 0xFFFFFF, 0x000000))),
+        ("GetVideoStreamingSetting"     , misc.GetVideoStreamingSettingRequest()),
+        ("SetVideoStreamingSetting"     , misc.SetVideoStreamingSettingRequest(misc.RtspSetting(True, misc.RtspResolution._960x540, misc.RtspBitrate._4))),
+        ("GetEthernetSetting"           , network_setting.GetEthernetSettingRequest()),
+        ("SetEthernetSetting"           , network_setting.SetEthernetSettingRequest(False, "10.0.0.5", "255.255.255.0", "10.0.0.1", 5005)),
+        ("GetWifiSetting"               , network_setting.GetWifiSettingRequest()),
+        ("SetWifiSetting"               , network_setting.SetWifiSettingRequest(True, "office", "s3cr&t", False, "10.0.0.5", "255.255.255.0", "10.0.0.1", 5005)),
+        ("GetUserData"                  , user_data.GetUserDataRequest(1042)),
+        ("GetFirstUserData"             , user_data.GetFirstUserDataRequest()),
+        ("GetNextUserData"              , user_data.GetNextUserDataRequest(1042)),
+        ("SetUserData"                  , user_data.SetUserDataRequest(make_user())),
+        ("DeleteUser"                   , user_data.DeleteUserRequest(1042)),
+        ("GetFaceData"                  , user_data.GetFaceDataRequest(1042)),
+        ("SetFaceData"                  , user_data.SetFaceDataRequest(1042, data, True)),
+        ("GetFingerprintData"           , user_data.GetFingerprintDataRequest(1042, 0)),
+        ("SetFingerprintData"           , user_data.SetFingerprintDataRequest(1042, 0, data[: 1024])),
+        ("GetUserPassword"              , user_data.GetUserPasswordRequest(1042)),
+        ("GetUserCard"                  , user_data.GetUserCardRequest(1042)),
+        ("GetUserQR"                    , user_data.GetUserQRRequest(1042)),
+        ("GetUserPhoto"                 , user_data.GetUserPhotoRequest(1042)),
+        ("SetUserPhoto"                 , user_data.SetUserPhotoRequest(1042, data)),
+        ("GetUserAttendOnlySetting"     , user_data.GetUserAttendOnlySettingRequest(1042)),
+        ("SetUserAttendOnlySetting"     , user_data.SetUserAttendOnlySettingRequest(1042, True)),
+        ("BeginRemoteEnroll"            , user_data.BeginRemoteEnrollRequest(1042, user_data.RemoteEnrollType.Face)),
+        ("ExitRemoteEnroll"             , user_data.ExitRemoteEnrollRequest()),
+        ("QueryRemoteEnrollStatus"      , user_data.QueryRemoteEnrollStatusRequest()),
+        ("EnrollFaceByPhoto"            , user_data.EnrollFaceByPhotoRequest(1042, data)),
+    ]
+
+def make_responses(binary_size : int = 64 * 1024) -> List[Tuple[str, type, str]]:
+    text = encode_base64(random_bytes(binary_size))
+    return [
+        ("GetAccessTimezone"        , access_control.GetAccessTimezoneResponse, make_message(
+                                        ("Response", "GetAccessTimeZone"), ("Result", "OK"), *[(f"TimeSection_{i}", "800,1800") for i in range(0, 7)])),
+        ("GetLockControlMode"       , access_control.GetLockControlModeResponse, make_message(
+                                        ("Response", "GetLockControlMode"), ("Result", "OK"), ("Mode", "3"))),
+        ("GetDepartment"            , attendance_setting.GetDepartmentResponse, make_message(
+                                        ("Response", "GetDepartment"), ("Result", "OK"), ("Name", encode_utf16("R&D\x00")))),
+        ("GetDepartment+fail"       , attendance_setting.GetDepartmentResponse, make_message(
+                                        ("Response", "GetDepartment"), ("Result", "Fail"), ("Reason", "No <such> department"))),
+        ("GetProxyDepartment"       , attendance_setting.GetProxyDepartmentResponse, make_message(
+                                        ("Response", "GetProxyDept"), ("Result", "OK"), ("Name", encode_utf16("Sales\x00")))),
+        ("GetBellSettings"          , attendance_setting.GetBellSettingsResponse, make_message(
+                                        ("Response", "GetBellTime"), ("Result", "OK"), ("BellRingTimes", "5"), ("BellCount", "24"),
+                                        *[(f"Bell_{i}", f"1,0,{i % 24},30") for i in range(0, 24)])),
+        ("GetAutoAttendanceSettings", attendance_setting.GetAutoAttendanceSettingsResponse, make_message(
+                                        ("Response", "GetAutoAttendance"), ("Result", "OK"), ("TimeSection_0", "800,1200,1"))),
+        ("GetTime"                  , device_control.GetTimeResponse, make_message(
+                                        ("Response", "GetTime"), ("Result", "OK"), ("Time", "2024-05-01-T08:59:12Z"))),
+        ("GetDeviceStatus"          , device_control.GetDeviceStatusResponse, make_message(
+                                        ("Response", "GetDeviceStatus"), ("Result", "OK"), ("Value", "12"))),
+        ("GetDeviceStatusAll"       , device_control.GetDeviceStatusAllResponse, make_message(
+                                        ("Response", "GetDeviceStatusAll"), ("Result", "OK"),
+                                        *[(param.name, str(param.value)) for param in device_control.DeviceStatusParamType])),
+        ("GetDeviceInfo"            , device_info.GetDeviceInfoResponse, make_message(
+                                        ("Response", "GetDeviceInfo"), ("Result", "OK"), ("Value", "1"))),
+        ("GetDeviceInfoAll"         , device_info.GetDeviceInfoAllResponse, make_message(
+                                        ("Response", "GetDeviceInfoAll"), ("Result", "OK"),
+                                        *[(param.name, str(param.value)) for param in device_info.DeviceInfoParamType])),
+        ("GetDeviceInfoExt"         , device_info.GetDeviceInfoExtResponse, make_message(
+                                        ("Response", "GetDeviceInfoExt"), ("Result", "OK"), ("Value1", "http://host/a?b=1&c=2"), ("Value3", None))),
+        ("GetGlog"                  , log.GetGlogResponse, make_message(
+                                        ("Response", "GetFirstGlog"), ("Result", "OK"), ("LogID", "123456"), ("UtcTimezoneMinutes", "60"),
+                                        ("Time", "2024-05-01-T08:59:12Z"), ("UserID", "1042"), ("AttendStat", "DutyOn"), ("Action", "Face"),
+                                        ("JobCode", "0"), ("Photo", "No"), ("BodyTemperature100", "3650"), ("AttendOnly", "No"), ("Expired", "No"))),
+        ("GetGlog+photo"            , log.GetGlogResponse, make_message(
+                                        ("Response", "GetNextGlog"), ("Result", "OK"), ("LogID", "123457"), ("Time", "2024-05-01-T09:00:00Z"),
+                                        ("UserID", "1042"), ("Photo", "Yes"), ("LogImage", text))),
+        ("GetGlogPosInfo"           , log.GetGlogPosInfoResponse, make_message(
+                                        ("Response", "GetGlogPosInfo"), ("Result", "OK"), ("LogCount", "10"), ("MaxCount", "100000"), ("StartPos", "3"))),
+        ("GetFirmwareVersion"       , maintenance.GetFirmwareVersionResponse, make_message(
+                                        ("Response", "GetFirmwareVersion"), ("Version", "1.2.3"), ("BuildNumber", "4567"))),
+        ("GetCenterScreenMessage"   , misc.GetCenterScreenMessageSettingResponse, make_message(
+                                        ("Response", "GetCenterScreenMsg"), ("center_screen_message", encode_utf16("Welcome\x00\x00")),
+                                        ("center_screen_message_color", "FFFFFFFF"), ("center_screen_message_border_color", "FF000000"),
+                                        ("verify_disable", "0"))),
+        ("GetVideoStreamingSetting" , misc.GetVideoStreamingSettingResponse, make_message(
+                                        ("Response", "GetVideoStreamSetting"), ("rtsp_enable", "1"), ("rtsp_resolution", "2"), ("rtsp_bitrate_mbps", "4"))),
+        ("GetEthernetSetting"       , network_setting.GetEthernetSettingResponse, make_message(
+                                        ("Response", "GetEthernetSetting"), ("Result", "OK"), ("DHCP", "No"), ("IP", "10.0.0.5"), ("Subnet", "255.255.255.0"),
+                                        ("DefaultGateway", "10.0.0.1"), ("Port", "5005"), ("MacAddress", "00:11:22:33:44:55"))),
+        ("GetWifiSetting"           , network_setting.GetWifiSettingResponse, make_message(
+                                        ("Response", "GetWiFiSetting"), ("Result", "OK"), ("Use", "Yes"), ("SSID", "office"), ("Key", "s3cr&t"),
+                                        ("DHCP", "No"), ("IP", "10.0.0.5"), ("Subnet", "255.255.255.0"), ("DefaultGateway", "10.0.0.1"), ("Port", "5005"))),
+        ("GetUserData"              , user_data.GetUserDataResponse, make_message(
+                                        ("Response", "GetUserData"), ("Result", "OK"), ("UserID", "1042"), ("Name", encode_utf16("Alice\x00")),
+                                        ("Privilege", "Manager"), ("Enabled", "Yes"), ("Depart", "3"), ("TimeSet1", "1"), ("TimeSet3", "3"),
+                                        ("UserPeriod_Used", "Yes"), ("UserPeriod_Start", str((24 << 16) | (1 << 8) | 1)),
+                                        ("UserPeriod_End", str((25 << 16) | (12 << 8) | 31)), ("Card", "7769qw=="), ("QR", "BQAAAA=="), ("PWD", "1234"),
+                                        ("FaceEnrolled", "No"), ("Fingers", "5"))),
+        ("GetUserData+face"         , user_data.GetUserDataResponse, make_message(
+                                        ("Response", "GetUserData"), ("Result", "OK"), ("UserID", "1042"), ("Name", encode_utf16("Alice\x00")),
+                                        ("FaceEnrolled", "Yes"), ("FaceData", text))),
+        ("GetNextUserData"          , user_data.GetNextUserDataResponse, make_message(
+                                        ("Response", "GetNextUserData"), ("Result", "OK"), ("UserID", "1043"), ("More", "Yes"))),
+        ("SetUserData"              , user_data.SetUserDataResponse, make_message(
+                                        ("Response", "SetUserData"), ("Result", "OK"), ("UserID", "1042"))),
+        ("GetFaceData"              , user_data.GetFaceDataResponse, make_message(
+                                        ("Response", "GetFaceData"), ("Result", "OK"), ("UserID", "1042"), ("FaceData", text))),
+        ("GetFingerprintData"       , user_data.GetFingerprintDataResponse, make_message(
+                                        ("Response", "GetFingerData"), ("Result", "OK"), ("UserID", "1042"), ("FingerNo", "0"),
+                                        ("Duress", "No"), ("FingerData", text[: 1368]))),
+        ("GetUserPassword"          , user_data.GetUserPasswordResponse, make_message(
+                                        ("Response", "GetUserPassword"), ("Result", "OK"), ("UserID", "1042"), ("Password", "1234"))),
+        ("GetUserCard"              , user_data.GetUserCardResponse, make_message(
+                                        ("Response", "GetUserCardNo"), ("Result", "OK"), ("UserID", "1042"), ("CardNo", "7769qw=="))),
+        ("GetUserQR"                , user_data.GetUserQRResponse, make_message(
+                                        ("Response", "GetUserQR"), ("Result", "OK"), ("UserID", "1042"), ("QR", "BQAAAA=="))),
+        ("GetUserPhoto"             , user_data.GetUserPhotoResponse, make_message(
+                                        ("Response", "GetUserPhoto"), ("Result", "OK"), ("UserID", "1042"), ("PhotoData", text))),
+        ("GetUserAttendOnlySetting" , user_data.GetUserAttendOnlySettingResponse, make_message(
+                                        ("Response", "GetUserAttendOnly"), ("Result", "OK"), ("UserID", "1042"), ("Value", "Yes"))),
+        ("BeginRemoteEnroll"        , user_data.BeginRemoteEnrollResponse, make_message(
+                                        ("Response", "BeginRemoteEnroll"), ("ResultCode", "Success"))),
+        ("ExitRemoteEnroll"         , user_data.ExitRemoteEnrollResponse, make_message(
+                                        ("Response", "ExitRemoteEnroll"), ("ResultCode", "SuccessExitRemoteEnroll"))),
+        ("QueryRemoteEnrollStatus"  , user_data.QueryRemoteEnrollStatusResponse, make_message(
+                                        ("Response", "QueryRemoteEnrollStatus"), ("ResultCode", "RemoteEnrollAlreadyStarted"))),
+        ("Generic"                  , messages.GenericResponse, make_message(
+                                        ("Response", "SetUserData"), ("Result", "Fail"), ("Reason", "Card & QR in use"))),
+    ]
+
+def make_log_event(photo_size : int = 0) -> str:
+    children = [
+        ("Event"                , "TimeLog_v2"),
+        ("MachineID"            , "1"),
+        ("LogID"                , "123456"),
+        ("UserID"               , "1042"),
+        ("Time"                 , "2024-05-01-T08:59:12Z"),
+        ("AttendStat"           , "DutyOn"),
+        ("Action"               , "Face"),
+        ("JobCode"              , "0"),
+        ("Photo"                , "Yes" if photo_size > 0 else "No"),
+        ("TransID"              , "77"),
+    ]
+    if photo_size > 0:
+        children.append(("LogImage", encode_base64(random_bytes(photo_size))))
+    return make_message(*children)
+
+# Frames as a worker receives them : what devices send on their own, and one large response.
+def make_frames(binary_size : int = 128 * 1024) -> List[Tuple[str, str]]:
+    return [
+        ("KeepAlive"        , make_message(("Event", "KeepAlive"), ("DeviceSerialNo", "M50A12345678"), ("DevTime", "2024-05-01-T08:59:12Z"))),
+        ("Register"         , make_message(("Request", "Register"), ("DeviceSerialNo", "M50A12345678"), ("TerminalType", "M50"),
+                                           ("ProductName", "M50"), ("CloudId", "cloud"))),
+        ("Login"            , make_message(("Request", "Login"), ("DeviceSerialNo", "M50A12345678"), ("Token", "0123456789abcdef"))),
+        ("TimeLog"          , make_log_event()),
+        ("TimeLog+photo"    , make_log_event(binary_size)),
+        ("Response"         , make_message(("Response", "GetUserPhoto"), ("Result", "OK"), ("UserID", "1042"),
+                                           ("PhotoData", encode_base64(random_bytes(binary_size))))),
+    ]
+
+# Request classes defined in the m50 modules, so a new command without a fixture is noticed.
+def request_classes() -> Dict[str, type]:
+    return {
+        f"{module.__name__}.{name}" : value
+        for module in MODULES
+        for name, value in vars(module).items()
+        if inspect.isclass(value) and value.__module__ == module.__name__ and issubclass(value, messages.GenericRequest)
+    }
+
+def response_classes() -> Dict[str, type]:
+    return {f"{cls.__module__}.{cls.__name__}" : cls for cls in (cls.response_type for cls in request_classes().values())}
+
+def check_coverage():
+    requests = {type(request) for _, request in make_requests(16)}
+    responses = {response_type for _, response_type, _ in make_responses(16)}
+    missing = [name for name, cls in request_classes().items() if cls not in requests]
+    missing += [name for name, cls in response_classes().items() if cls not in responses]
+    if len(missing) > 0:
+        raise AssertionError(f"No fixture for : {', '.join(missing)}")
@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+from dataclasses import asdict, dataclass, field, replace
+import hashlib
+import http
+import json
+import math
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from devicebroker.firmware_server import HttpError, read_request_head
+
+from timing import percentile
+
+ENDPOINTS : Tuple[str, ...] = ("check_registration", "check_login", "upload_log")
+
+DEFAULT_DRIP_SIZE       : int = 256
+DEFAULT_DRIP_SECONDS    : float = 10
+DRIP_TICK               : float = 0.25
+BASELINE                : str = "baseline"
+
+# How one endpoint answers. Latency is lognormal around the median, plus a fixed tail for tail_ratio of the requests
+# (a pause, a slow query); errors answer error_status; drips send the body a few bytes at a time over drip_seconds.
+@dataclass
+class Behaviour:
+    latency_median_ms   : float = 5.0
+    latency_sigma       : float = 0.5
+    tail_ratio          : float = 0.0
+    tail_ms             : float = 0.0
+    error_rate          : float = 0.0
+    error_status        : int = 503
+    drip_rate           : float = 0.0
+    drip_seconds        : float = DEFAULT_DRIP_SECONDS
+
+# A window of the run, in seconds from the start, with every endpoint's latency multiplied and its error and drip
+# rates replaced where given.
+@dataclass
+class Phase:
+    name            : str
+    start           : float
+    duration        : float
+    latency_factor  : float = 1
+    error_rate      : Optional[float] = None
+    drip_rate       : Optional[float] = None
+
+    # START:DURATION[:LATENCY_FACTOR[:ERROR_RATE[:DRIP_RATE]]]
+    @classmethod
+    def parse(cls, name : str, spec : str) -> 'Phase':
+        parts = spec.split(":")
+        if not 2 <= len(parts) <= 5:
+            raise ValueError(f"Bad phase {spec!r}, expected START:DURATION[:LATENCY_FACTOR[:ERROR_RATE[:DRIP_RATE]]]")
+        values = [float(part) if part else None for part in parts] + [None] * (5 - len(parts))
+        return cls(name, values[0], values[1], values[2] if values[2] is not None else 1, values[3], values[4])
+
+    def covers(self, elapsed : float) -> bool:
+        return self.start <= elapsed < self.start + self.duration
+
+    def apply(self, behaviour : Behaviour) -> Behaviour:
+        return replace(
+            behaviour,
+            latency_median_ms   = behaviour.latency_median_ms * self.latency_factor,
+            tail_ms             = behaviour.tail_ms * self.latency_factor,
+            error_rate          = self.error_rate if self.error_rate is not None else behaviour.error_rate,
+            drip_rate           = self.drip_rate if self.drip_rate is not None else behaviour.drip_rate)
+
+@dataclass
+class EndpointStats:
+    requests        : int = 0
+    statuses        : Dict[int, int] = field(default_factory = dict)
+    drips           : int = 0
+    bytes_in        : int = 0
+    bytes_out       : int = 0
+    in_flight       : int = 0
+    peak_in_flight  : int = 0
+    service_times   : List[float] = field(default_factory = list)     # Request read to last byte written, seconds
+
+    def summary(self) -> dict:
+        summary = asdict(self)
+        del summary["service_times"]
+        for name, fraction in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99), ("max_ms", 1.0)):
+            summary[name] = percentile(self.service_times, fraction) * 1000 if self.service_times else None
+        return summary
+
+@dataclass
+class Fate:
+    delay   : float
+    status  : int
+    drip    : bool
+
+# What the broker's workers expect from the webapp, answered by rules instead of a database : the token of a serial
+# number is derived from it, so registrations survive restarts of either side. Every decision is drawn from a
+# generator seeded by the request body and how often it was seen : a rerun gives the same requests the same errors
+# and delays however they interleave, while a retried upload gets a fresh draw.
+class StubWebapp:
+    host        : str
+    port        : int
+    behaviours  : Dict[str, Behaviour]
+    phases      : List[Phase]
+    seed        : int
+    server      : Optional[asyncio.AbstractServer]
+    start_time  : float
+    attempts    : Dict[bytes, int]
+    stats       : Dict[Tuple[str, str], EndpointStats]
+    writers     : Set[asyncio.StreamWriter]
+
+    def __init__(self, host : str, port : int, behaviours : Dict[str, Behaviour], phases : Optional[List[Phase]] = None, seed : int = 1):
+        super().__init__()
+
+        self.host       = host
+        self.port       = port
+        self.behaviours = behaviours
+        self.phases     = phases or []
+        self.seed       = seed
+        self.server     = None
+        self.start_time = time.monotonic()
+        self.attempts   = dict()
+        self.stats      = dict()
+        self.writers    = set()
+
+    def token_for(self, serial_no : str) -> str:
+        return hashlib.sha1(f"{self.seed}:{serial_no}".encode("utf-8")).hexdigest()[: 16]
+
+    def phase_at(self, elapsed : float) -> Optional[Phase]:
+        for phase in self.phases:
+            if phase.covers(elapsed):
+                return phase
+        return None
+
+    def phase_name(self, phase : Optional[Phase]) -> str:
+        return phase.name if phase is not None else BASELINE
+
+    def stats_for(self, phase : Optional[Phase], endpoint : str) -> EndpointStats:
+        key = (self.phase_name(phase), endpoint)
+        stats = self.stats.get(key, None)
+        if stats is None:
+            stats = self.stats[key] = EndpointStats()
+        return stats
+
+    def decide(self, endpoint : str, body : bytes, behaviour : Behaviour) -> Fate:
+        key = hashlib.blake2b(endpoint.encode("ascii") + b"\0" + body, digest_size = 16).digest()
+        attempt = self.attempts.get(key, 0)
+        self.attempts[key] = attempt + 1
+
+        rnd = random.Random(hashlib.blake2b(key + f"{self.seed}/{attempt}".encode("ascii"), digest_size = 8).digest())
+        delay = 0.0
+        if behaviour.latency_median_ms > 0:
+            delay = rnd.lognormvariate(math.log(behaviour.latency_median_ms / 1000), behaviour.latency_sigma)
+        if rnd.random() < behaviour.tail_ratio:
+            delay += behaviour.tail_ms / 1000
+        status = behaviour.error_status if rnd.random() < behaviour.error_rate else 200
+        return Fate(delay, status, rnd.random() < behaviour.drip_rate)
+
+    def answer(self, endpoint : str, target : str, body : bytes) -> Tuple[int, dict]:
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            return 400, {"reason" : "Bad JSON"}
+
+        match endpoint:
+            case "check_registration":
+                serial_no = data.get("sn", None)
+                if not serial_no:
+                    return 400, {"reason" : "No serial number"}
+                return 200, {"token" : self.token_for(serial_no)}
+
+            case "check_login":
+                serial_no = data.get("sn", None)
+                if not serial_no or data.get("token", None) != self.token_for(serial_no):
+                    return 401, {"reason" : "Fail"}
+                return 200, {}
+
+            case "upload_log":
+                if not parse_qs(urlsplit(target).query).get("type", None):
+                    return 400, {"reason" : "No log type"}
+                return 200, {}
+
+        return 404, {"reason" : "Not Found"}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve_connection, self.host, self.port)
+        self.start_time = time.monotonic()
+
+    async def run(self, cancellation : asyncio.Future):
+        await self.start()
+        async with self.server:
+            await cancellation
+            # Idle keep-alive connections see their end instead of being cancelled mid-read.
+            for writer in list(self.writers):
+                writer.close()
+            await asyncio.sleep(0)
+
+    async def serve_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        self.writers.add(writer)
+        try:
+            while await self.serve_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, TimeoutError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    # Returns whether the connection stays open for another request.
+    async def serve_request(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> bool:
+        try:
+            head = await read_request_head(reader)
+            if head is None:
+                return False
+            length = head.content_length()
+        except HttpError as ex:
+            await self.send(writer, ex.status, b"", False)
+            return False
+
+        method, target, keep_alive = head.method, head.target, head.keep_alive
+        body = await reader.readexactly(length)
+
+        path = urlsplit(target).path
+        if method == "GET" and path == "/stats":
+            await self.send(writer, 200, json.dumps(self.summary()).encode("utf-8"), keep_alive)
+            return keep_alive
+
+        endpoint = path.rpartition("/")[2]
+        if method != "POST" or path != f"/device/{endpoint}" or endpoint not in ENDPOINTS:
+            await self.send(writer, 404, b"", keep_alive)
+            return keep_alive
+
+        received_time = time.monotonic()
+        phase = self.phase_at(received_time - self.start_time)
+        behaviour = self.behaviours.get(endpoint, Behaviour())
+        if phase is not None:
+            behaviour = phase.apply(behaviour)
+        fate = self.decide(endpoint, body, behaviour)
+
+        stats = self.stats_for(phase, endpoint)
+        stats.requests += 1
+        stats.bytes_in += len(body)
+        stats.in_flight += 1
+        stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        try:
+            await asyncio.sleep(fate.delay)
+            if fate.status == 200:
+                status, answer = self.answer(endpoint, target, body)
+            else:
+                status, answer = fate.status, {"reason" : http.HTTPStatus(fate.status).phrase}
+            payload = json.dumps(answer).encode("utf-8")
+
+            if fate.drip:
+                stats.drips += 1
+                # Trailing whitespace keeps the body valid JSON.
+                payload = payload.ljust(DEFAULT_DRIP_SIZE)
+                await self.send(writer, status, payload, keep_alive, behaviour.drip_seconds)
+            else:
+                await self.send(writer, status, payload, keep_alive)
+
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.bytes_out += len(payload)
+            stats.service_times.append(time.monotonic() - received_time)
+        finally:
+            stats.in_flight -= 1
+
+        return keep_alive
+
+    async def send(self, writer : asyncio.StreamWriter, status : int, payload : bytes, keep_alive : bool, drip_seconds : float = 0):
+        head = "\r\n".join((
+            f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(payload)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        )) + "\r\n\r\n"
+        writer.write(head.encode("latin-1"))
+
+        if drip_seconds <= 0 or not payload:
+            writer.write(payload)
+            await writer.drain()
+            return
+
+        # Headers at once, then the body in even pieces : the client sees a live but crawling response.
+        ticks = max(int(drip_seconds / DRIP_TICK), 1)
+        piece = max(math.ceil(len(payload) / ticks), 1)
+        await writer.drain()
+        for offset in range(0, len(payload), piece):
+            await asyncio.sleep(DRIP_TICK)
+            writer.write(payload[offset : offset + piece])
+            await writer.drain()
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.start_time
+        return {
+            "elapsed"   : elapsed,
+            "phase"     : self.phase_name(self.phase_at(elapsed)),
+            "endpoints" : {f"{phase_name}/{endpoint}" : stats.summary() for (phase_name, endpoint), stats in sorted(self.stats.items())},
+        }
+
+def print_summary(webapp : StubWebapp):
+    print(f"\n{'phase':<14} {'endpoint':<20} {'requests':>9} {'errors':>7} {'drips':>6} {'peak':>5} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for (phase_name, endpoint), stats in sorted(webapp.stats.items()):
+        errors = sum(count for status, count in stats.statuses.items() if status >= 500)
+        print(f"{phase_name:<14} {endpoint:<20} {stats.requests:>9} {errors:>7} {stats.drips:>6} {stats.peak_in_flight:>5} "
+              + " ".join(f"{percentile(stats.service_times, fraction) * 1000:>9.1f}" for fraction in (0.5, 0.9, 0.99, 1.0)))
+
+async def report(webapp : StubWebapp, interval : float):
+    last_requests = 0
+    while True:
+        await asyncio.sleep(interval)
+        requests = sum(stats.requests for stats in webapp.stats.values())
+        in_flight = sum(stats.in_flight for stats in webapp.stats.values())
+        summary = webapp.summary()
+        print(f"{summary['elapsed']:7.1f}s  {summary['phase']:<14} requests/s {(requests - last_requests) / interval:>8.1f}  in flight {in_flight:>5}")
+        last_requests = requests
+
+async def serve(webapp : StubWebapp, duration : Optional[float], report_interval : float):
+    cancellation = asyncio.get_running_loop().create_future()
+    reporter = asyncio.create_task(report(webapp, report_interval)) if report_interval > 0 else None
+    if duration is not None:
+        asyncio.get_running_loop().call_later(duration, lambda: cancellation.done() or cancellation.set_result(None))
+    try:
+        await webapp.run(cancellation)
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+
+# NAME=VALUE[,NAME=VALUE...] for one endpoint, on top of the defaults : check_login=latency_median_ms=200,error_rate=0.1
+def parse_override(spec : str, behaviours : Dict[str, Behaviour]) -> Tuple[str, Behaviour]:
+    endpoint, _, settings = spec.partition("=")
+    if endpoint not in ENDPOINTS:
+        raise ValueError(f"Unknown endpoint {endpoint!r}, expected one of {', '.join(ENDPOINTS)}")
+
+    changes = dict()
+    for setting in filter(None, settings.split(",")):
+        name, _, value = setting.partition("=")
+        setting_field = Behaviour.__dataclass_fields__.get(name, None)
+        if setting_field is None:
+            raise ValueError(f"Unknown setting {name!r}")
+        changes[name] = setting_field.type(value)
+    return endpoint, replace(behaviours[endpoint], **changes)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Stub of the webapp the broker's workers post to; point the broker's --webapp-url at it.")
+    parser.add_argument("--host"                , type = str, default = "localhost")
+    parser.add_argument("--port"                , type = int, default = 8000)
+    parser.add_argument("--latency-median-ms"   , type = float, default = 5)
+    parser.add_argument("--latency-sigma"       , type = float, default = 0.5)
+    parser.add_argument("--tail-ratio"          , type = float, default = 0)
+    parser.add_argument("--tail-ms"             , type = float, default = 0)
+    parser.add_argument("--error-rate"          , type = float, default = 0)
+    parser.add_argument("--error-status"        , type = int, default = 503)
+    parser.add_argument("--drip-rate"           , type = float, default = 0)
+    parser.add_argument("--drip-seconds"        , type = float, default = DEFAULT_DRIP_SECONDS)
+    parser.add_argument("--endpoint"            , type = str, action = "append", default = [],
+                        help = "ENDPOINT=SETTING=VALUE[,SETTING=VALUE...], e.g. upload_log=error_rate=0.2")
+    parser.add_argument("--brownout"            , type = str, action = "append", default = [],
+                        help = "START:DURATION[:LATENCY_FACTOR[:ERROR_RATE[:DRIP_RATE]]], seconds from the start")
+    parser.add_argument("--duration"            , type = float, default = None)
+    parser.add_argument("--report-interval"     , type = float, default = 5)
+    parser.add_argument("--seed"                , type = int, default = 1)
+    args = parser.parse_args()
+
+    base = Behaviour(
+        latency_median_ms   = args.latency_median_ms,
+        latency_sigma       = args.latency_sigma,
+        tail_ratio          = args.tail_ratio,
+        tail_ms             = args.tail_ms,
+        error_rate          = args.error_rate,
+        error_status        = args.error_status,
+        drip_rate           = args.drip_rate,
+        drip_seconds        = args.drip_seconds)
+    behaviours = {endpoint : base for endpoint in ENDPOINTS}
+    for spec in args.endpoint:
+        endpoint, behaviour = parse_override(spec, behaviours)
+        behaviours[endpoint] = behaviour
+    phases = [Phase.parse(f"brownout {phase_no + 1}", spec) for phase_no, spec in enumerate(args.brownout)]
+
+    webapp = StubWebapp(args.host, args.port, behaviours, phases, args.seed)
+    try:
+        asyncio.run(serve(webapp, args.duration, args.report_interval))
+    except KeyboardInterrupt:
+        pass
+    print_summary(webapp)
+
+if __name__ == "__main__":
+    main()
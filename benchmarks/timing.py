@@ -0,0 +1,46 @@
+import math
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+# Best of a few runs, each long enough to drown the timer overhead. timeit.autorange() always runs for 0.2s,
+# which is far too long across a hundred fixtures.
+def measure(func : Callable[[], object], min_time : float, repeat : int = 1) -> float:
+    count = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(0, count):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        count *= 2
+
+    best = elapsed / count
+    for _ in range(1, repeat):
+        start = time.perf_counter()
+        for _ in range(0, count):
+            func()
+        best = min(best, (time.perf_counter() - start) / count)
+    return best
+
+# Peak memory while the call runs, and what its result still holds once it returns. A first call outside the trace
+# keeps one-off costs (imports, caches) out of the numbers.
+def measure_memory(func : Callable[[], object]) -> Tuple[int, int]:
+    func()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+        del result
+        return peak - base, current - base
+    finally:
+        tracemalloc.stop()
+
+# Nearest-rank percentile, fraction in [0, 1]; nan without samples.
+def percentile(values : List[float], fraction : float) -> float:
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[min(int(math.ceil(fraction * len(ordered))) - 1, len(ordered) - 1) if fraction > 0 else 0]
@@ -3,11 +3,25 @@ from concurrent.futures import ThreadPoolExecutor
 import logging
 import multiprocessing as mp
 import multiprocessing.connection as mpc
+import os
 import signal
+from typing import Optional
 from websockets.asyncio.server import serve
 
+from .autoscaler import Autoscaler
+from .blob_store import BlobStore
+from .clock_sync import DEFAULT_THRESHOLD as DEFAULT_CLOCK_THRESHOLD
+from .face_enrollment import DEFAULT_MAX_SIDE as DEFAULT_FACE_PHOTO_MAX_SIDE, PhotoPreparer
+from .firmware_server import FirmwareServer
 from .load_balancing import LoadBalancer
-from .worker import WorkerHost
+from .log_export import DEFAULT_MAX_PARALLEL, CursorStore
+from .log_store import LogStore
+from .status_poller import DEFAULT_MAX_INTERVAL as DEFAULT_STATUS_MAX_INTERVAL, DEFAULT_MIN_INTERVAL as DEFAULT_STATUS_MIN_INTERVAL
+from .status_store import StatusStore
+from .template_cache import TemplateCache
+from .user_sync import SyncStateStore
+from . import xml_backend
+from .worker import ThreadWorkerHost, WorkerHost
 
 LOG = logging.getLogger(__name__)
 
@@ -33,6 +47,15 @@ async def run_application_server(loadbalancer : LoadBalancer, sock_name : str):
                 tasks.add(task)
                 task.add_done_callback(tasks.discard)
 
+async def run_blob_gc(blob_store : BlobStore, interval : float):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, blob_store.collect_garbage)
+        except Exception as ex:
+            LOG.warning(f"Exception while collecting blobs : {ex}")
+        await asyncio.sleep(interval)
+
 async def wait_cancellation(cancellation : asyncio.Future):
     await cancellation
 
@@ -41,17 +64,64 @@ async def main(args):
     if num_workers <= 0:
         num_workers = mp.cpu_count()
 
-    # Create pipes
-    host_pipes, worker_pipes = zip(*(mp.Pipe() for _ in range(0, num_workers)))
+    max_workers : int = args.max_workers if args.max_workers > 0 else num_workers
+    min_workers : int = min(args.min_workers if args.min_workers > 0 else num_workers, max_workers)
+    num_workers = max(min_workers, min(max_workers, num_workers))
+
+    blob_store : Optional[BlobStore] = None
+    if args.blob_dir:
+        blob_store = BlobStore(
+            args.blob_dir,
+            max_age     = args.blob_max_age_days * 86400 if args.blob_max_age_days > 0 else None,
+            max_size    = int(args.blob_max_size_mb * 1024 * 1024) if args.blob_max_size_mb > 0 else None)
+
+    xml_backend.select(args.xml_backend)
+    LOG.info(f"Using the {xml_backend.current().name} XML backend")
+
+    cursor_store = CursorStore(args.log_cursor_file or None)
+    sync_state_store = SyncStateStore(args.sync_state_dir or None)
+
+    template_cache : Optional[TemplateCache] = None
+    if args.template_dir:
+        template_cache = TemplateCache(
+            BlobStore(
+                os.path.join(args.template_dir, "blobs"),
+                max_size = int(args.template_max_size_mb * 1024 * 1024) if args.template_max_size_mb > 0 else None),
+            os.path.join(args.template_dir, "index"))
+
+    log_store : Optional[LogStore] = LogStore(args.log_store_dir, blob_store) if args.log_store_dir else None
+
+    firmware_server : Optional[FirmwareServer] = None
+    firmware_url : Optional[str] = args.firmware_url or None
+    if args.firmware_dir:
+        firmware_server = FirmwareServer(args.firmware_dir, args.firmware_host or args.host, args.firmware_port)
+        if firmware_url is None:
+            firmware_url = f"http://{args.firmware_host or args.host}:{args.firmware_port}"
 
     # Create load balancer
-    loadbalancer = LoadBalancer(host_pipes)
+    loadbalancer = LoadBalancer(
+        blob_store, cursor_store, args.max_parallel_exports, sync_state_store, template_cache,
+        firmware_base_url   = firmware_url,
+        clock_sync_interval = args.clock_sync_interval,
+        clock_threshold     = args.clock_threshold,
+        clock_utc_offset    = args.clock_utc_offset_minutes * 60,
+        photo_preparer      = PhotoPreparer(args.face_photo_max_side, max_workers = args.face_photo_workers or None),
+        status_store        = StatusStore(args.status_dir or None, args.status_retention_days * 86400 if args.status_retention_days > 0 else None),
+        status_interval     = args.status_interval,
+        status_min_interval = args.status_min_interval,
+        status_max_interval = args.status_max_interval,
+        log_store           = log_store)
 
     # Spawn worker processes
-    worker_host = WorkerHost(worker_pipes, args.webapp_url)
+    if args.worker_mode == "thread":
+        worker_host = ThreadWorkerHost(args.webapp_url, blob_store, log_store is not None)
+    else:
+        worker_host = WorkerHost(args.webapp_url, blob_store, log_store is not None)
+    for _ in range(0, num_workers):
+        worker_id, pipe = worker_host.spawn()
+        loadbalancer.add_worker(worker_id, pipe)
 
-    for pipe in worker_pipes:
-        pipe.close()
+    autoscaler = Autoscaler(loadbalancer, worker_host, min_workers, max_workers, interval = args.autoscale_interval)
 
     cancellation = asyncio.Future()
     def sigint_handler(signum, frame):
@@ -64,13 +134,23 @@ async def main(args):
             tg.create_task(wait_cancellation(cancellation))
             tg.create_task(run_device_server(loadbalancer, args.host, args.port, cancellation))
             tg.create_task(run_application_server(loadbalancer, args.sock_name))
-            for i in range(0, num_workers):
-                tg.create_task(loadbalancer.receive_messages_from_worker(i))
+            if firmware_server is not None:
+                tg.create_task(firmware_server.run(cancellation))
+            if args.clock_sync_interval > 0:
+                tg.create_task(loadbalancer.clock_sync.run())
+            if args.status_interval > 0:
+                tg.create_task(loadbalancer.status_poller.run())
+            if max_workers > min_workers:
+                tg.create_task(autoscaler.run())
+            if blob_store is not None:
+                tg.create_task(run_blob_gc(blob_store, args.blob_gc_interval))
+            if template_cache is not None:
+                tg.create_task(run_blob_gc(template_cache.store, args.blob_gc_interval))
 
     finally:
-        for pipe in host_pipes:
-            pipe : mpc.Connection
-            pipe.close()
+        loadbalancer.face_enrollment.preparer.close()
+        for link in list(loadbalancer.workers.values()):
+            link.connection.close()
         worker_host.stop()
 
 if __name__ == "__main__":
@@ -78,11 +158,42 @@ if __name__ == "__main__":
     from . import defaults
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--host"        , type = str, default = "localhost")
-    parser.add_argument("--port"        , type = int, default = 8001)
-    parser.add_argument("--sock-name"   , type = str, default = defaults.DEF_SOCK_NAME)
-    parser.add_argument("--workers"     , type = int, default = 0)
-    parser.add_argument("--webapp-url"  , type = str, default = "http://localhost:8000")
+    parser.add_argument("--host"                , type = str, default = "localhost")
+    parser.add_argument("--port"                , type = int, default = 8001)
+    parser.add_argument("--sock-name"           , type = str, default = defaults.DEF_SOCK_NAME)
+    parser.add_argument("--workers"             , type = int, default = 0)
+    parser.add_argument("--worker-mode"         , type = str, default = "process", choices = ("process", "thread"))
+    parser.add_argument("--min-workers"         , type = int, default = 0)
+    parser.add_argument("--max-workers"         , type = int, default = 0)
+    parser.add_argument("--autoscale-interval"  , type = float, default = 5)
+    parser.add_argument("--webapp-url"          , type = str, default = "http://localhost:8000")
+    parser.add_argument("--blob-dir"            , type = str, default = "")
+    parser.add_argument("--blob-max-age-days"   , type = float, default = 0)
+    parser.add_argument("--blob-max-size-mb"    , type = float, default = 0)
+    parser.add_argument("--blob-gc-interval"    , type = float, default = 3600)
+    parser.add_argument("--log-cursor-file"     , type = str, default = "")
+    parser.add_argument("--max-parallel-exports", type = int, default = DEFAULT_MAX_PARALLEL)
+    parser.add_argument("--log-store-dir"       , type = str, default = "")
+    parser.add_argument("--sync-state-dir"      , type = str, default = "")
+    parser.add_argument("--template-dir"        , type = str, default = "")
+    parser.add_argument("--template-max-size-mb", type = float, default = 0)
+    parser.add_argument("--firmware-dir"        , type = str, default = "")
+    parser.add_argument("--firmware-host"       , type = str, default = "")
+    parser.add_argument("--firmware-port"       , type = int, default = 8003)
+    parser.add_argument("--firmware-url"        , type = str, default = "")
+    parser.add_argument("--clock-sync-interval" , type = float, default = 0)
+    parser.add_argument("--clock-threshold"     , type = float, default = DEFAULT_CLOCK_THRESHOLD)
+    parser.add_argument("--clock-utc-offset-minutes", type = float, default = 0)
+    parser.add_argument("--face-photo-max-side" , type = int, default = DEFAULT_FACE_PHOTO_MAX_SIDE)
+    parser.add_argument("--face-photo-workers"  , type = int, default = 0)
+    parser.add_argument("--status-interval"     , type = float, default = 0)
+    parser.add_argument("--status-min-interval" , type = float, default = DEFAULT_STATUS_MIN_INTERVAL)
+    parser.add_argument("--status-max-interval" , type = float, default = DEFAULT_STATUS_MAX_INTERVAL)
+    parser.add_argument("--status-dir"          , type = str, default = "")
+    parser.add_argument("--status-retention-days", type = float, default = 30)
+    # Parses and builds device_cmd messages in the balancer. Workers classify device frames with the flat scanner
+    # whatever is chosen here.
+    parser.add_argument("--xml-backend"         , type = str, default = os.environ.get(xml_backend.ENV_BACKEND, "stdlib"), choices = xml_backend.BACKEND_NAMES)
     args = parser.parse_args()
 
     logging.basicConfig(level = logging.DEBUG)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Optional
+
+from .load_balancing import STOP_TIMEOUT, LoadBalancer, WorkerLink
+from .worker import WorkerHost
+
+LOG = logging.getLogger(__name__)
+
+class Autoscaler:
+    loadbalancer        : LoadBalancer
+    worker_host         : WorkerHost
+    min_workers         : int
+    max_workers         : int
+    interval            : float
+    scale_up_backlog    : float
+    scale_down_backlog  : float
+    scale_up_latency    : float
+    scale_down_latency  : float
+    scale_down_rounds   : int
+    cooldown            : float
+    drain_timeout       : float
+
+    idle_rounds         : int
+    last_change_time    : Optional[float]
+
+    def __init__(
+        self,
+        loadbalancer        : LoadBalancer,
+        worker_host         : WorkerHost,
+        min_workers         : int,
+        max_workers         : int,
+        interval            : float = 5.0,
+        scale_up_backlog    : float = 16,
+        scale_down_backlog  : float = 1,
+        scale_up_latency    : float = 1.0,
+        scale_down_latency  : float = 0.25,
+        scale_down_rounds   : int   = 6,
+        cooldown            : float = 30.0,
+        drain_timeout       : float = 60.0
+    ):
+        super().__init__()
+
+        self.loadbalancer       = loadbalancer
+        self.worker_host        = worker_host
+        self.min_workers        = min_workers
+        self.max_workers        = max_workers
+        self.interval           = interval
+        self.scale_up_backlog   = scale_up_backlog
+        self.scale_down_backlog = scale_down_backlog
+        self.scale_up_latency   = scale_up_latency
+        self.scale_down_latency = scale_down_latency
+        self.scale_down_rounds  = scale_down_rounds
+        self.cooldown           = cooldown
+        self.drain_timeout      = drain_timeout
+
+        self.idle_rounds        = 0
+        self.last_change_time   = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.evaluate()
+            except Exception as ex:
+                LOG.warning(f"Exception while autoscaling workers : {ex}")
+
+    async def evaluate(self):
+        looper = asyncio.get_running_loop()
+
+        active = self.loadbalancer.active_workers()
+        if len(active) == 0:
+            return
+
+        backlog = sum(max(link.backlog, 0) for link in active) / len(active)
+        latency = max(link.webapp_latency for link in active)
+
+        # Latency only counts while there is work queued; an idle worker keeps its last measurement.
+        overloaded  = backlog > self.scale_up_backlog or (backlog >= 1 and latency > self.scale_up_latency)
+        underloaded = backlog < self.scale_down_backlog and (backlog == 0 or latency < self.scale_down_latency)
+
+        self.idle_rounds = self.idle_rounds + 1 if underloaded else 0
+
+        if self.last_change_time is not None and looper.time() - self.last_change_time < self.cooldown:
+            return
+
+        if overloaded and len(active) < self.max_workers:
+            LOG.info(f"Scaling up : {len(active)} workers, backlog {backlog:.1f}, webapp latency {latency:.3f}s")
+            await self.add_worker()
+
+        elif self.idle_rounds >= self.scale_down_rounds and len(active) > self.min_workers:
+            LOG.info(f"Scaling down : {len(active)} workers, backlog {backlog:.1f}, webapp latency {latency:.3f}s")
+            self.idle_rounds = 0
+            await self.retire_worker(min(active, key = lambda link: (link.client_count, link.backlog)))
+
+    async def add_worker(self):
+        looper = asyncio.get_running_loop()
+
+        worker_id, pipe = await looper.run_in_executor(None, self.worker_host.spawn)
+        self.loadbalancer.add_worker(worker_id, pipe)
+        self.last_change_time = looper.time()
+
+    async def retire_worker(self, link : WorkerLink):
+        looper = asyncio.get_running_loop()
+
+        self.last_change_time = looper.time()
+        await self.loadbalancer.retire_worker(link.worker_id, self.drain_timeout)
+        await looper.run_in_executor(None, self.worker_host.join, link.worker_id, STOP_TIMEOUT)
+        self.last_change_time = looper.time()
@@ -0,0 +1,135 @@
+import binascii
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from typing import List, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+
+_DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+_TEMP_SUFFIX    = ".tmp"
+_TEMP_MAX_AGE   = 3600
+
+class BlobStore:
+    root_dir    : str
+    max_age     : Optional[float]
+    max_size    : Optional[int]
+
+    def __init__(self, root_dir : str, max_age : Optional[float] = None, max_size : Optional[int] = None):
+        super().__init__()
+
+        self.root_dir   = root_dir
+        self.max_age    = max_age
+        self.max_size   = max_size
+
+    @staticmethod
+    def is_valid_digest(digest : str) -> bool:
+        return isinstance(digest, str) and _DIGEST_PATTERN.fullmatch(digest) is not None
+
+    def path_for(self, digest : str) -> str:
+        if not self.is_valid_digest(digest):
+            raise ValueError(f"Invalid blob digest : {digest!r}")
+        return os.path.join(self.root_dir, digest[:2], digest)
+
+    def put(self, data : bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+
+        try:
+            # Already stored : refresh the timestamp so retention counts from the latest use.
+            os.utime(path)
+            return digest
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}{_TEMP_SUFFIX}"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        return digest
+
+    def put_base64(self, text : str) -> str:
+        return self.put(binascii.a2b_base64(text))
+
+    def contains(self, digest : str) -> bool:
+        return self.is_valid_digest(digest) and os.path.isfile(self.path_for(digest))
+
+    # With touch, a read counts as a use for retention, for stores used as a cache.
+    def get(self, digest : str, touch : bool = False) -> Optional[bytes]:
+        if not self.is_valid_digest(digest):
+            return None
+        try:
+            with open(self.path_for(digest), "rb") as f:
+                data = f.read()
+            if touch:
+                os.utime(self.path_for(digest))
+            return data
+        except FileNotFoundError:
+            return None
+
+    def collect_garbage(self) -> Tuple[int, int]:
+        now = time.time()
+        entries : List[Tuple[float, int, str]] = []
+        removed_count : int = 0
+        removed_bytes : int = 0
+
+        try:
+            subdirs = [x.path for x in os.scandir(self.root_dir) if x.is_dir()]
+        except FileNotFoundError:
+            return 0, 0
+
+        for subdir in subdirs:
+            for entry in os.scandir(subdir):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                age = now - stat.st_mtime
+                if entry.name.endswith(_TEMP_SUFFIX):
+                    expired = age > _TEMP_MAX_AGE
+                else:
+                    expired = self.max_age is not None and age > self.max_age
+
+                if expired:
+                    if self._remove(entry.path):
+                        removed_count += 1
+                        removed_bytes += stat.st_size
+                elif not entry.name.endswith(_TEMP_SUFFIX):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        if self.max_size is not None:
+            total_size = sum(size for _, size, _ in entries)
+            if total_size > self.max_size:
+                entries.sort()
+                for _, size, path in entries:
+                    if total_size <= self.max_size:
+                        break
+                    if self._remove(path):
+                        removed_count += 1
+                        removed_bytes += size
+                    total_size -= size
+
+        if removed_count > 0:
+            LOG.info(f"Removed {removed_count} blobs ({removed_bytes} bytes) from {self.root_dir}")
+
+        return removed_count, removed_bytes
+
+    def _remove(self, path : str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
@@ -1,15 +1,101 @@
+from collections import deque
 from dataclasses import dataclass
+import datetime
 import multiprocessing.connection as mpc
-from typing import List, Optional
+from typing import Any, Deque, List, Optional, Tuple
 
 from . import commands
 
+DEFAULT_READ_SIZE       : int = 64
+DEFAULT_USER_WINDOW     : int = 8
+DEFAULT_ENROLL_PARALLEL : int = 16
+DEFAULT_CONFIG_PARALLEL : int = 32
+
 @dataclass
 class Device:
     connection_id   : int
     attributes      : dict
     device_id       : str
 
+# Records the broker produces next to a device, fetched a batch at a time. The broker keeps reading the device
+# while the application works through a batch.
+class RemoteStream:
+    client      : 'Client'
+    stream_id   : Optional[int]
+    read_size   : int
+    buffer      : Deque[Any]
+    done        : bool
+    error       : Optional[str]
+    produced    : int
+    total       : Optional[int]
+
+    def __init__(self, client : 'Client', stream_id : int, read_size : int = DEFAULT_READ_SIZE):
+        super().__init__()
+
+        self.client     = client
+        self.stream_id  = stream_id
+        self.read_size  = read_size
+        self.buffer     = deque()
+        self.done       = False
+        self.error      = None
+        self.produced   = 0
+        self.total      = None
+
+    def __iter__(self) -> 'RemoteStream':
+        return self
+
+    def __next__(self) -> Any:
+        while not self.buffer:
+            # The error can come with the last records : it is raised once they have all been handed out.
+            if self.done:
+                if self.error is not None:
+                    raise Exception(self.error)
+                raise StopIteration
+            items, self.done, self.error, (self.produced, self.total) = self.client.read_stream(self.stream_id, self.read_size)
+            self.buffer.extend(items)
+        return self.buffer.popleft()
+
+    def close(self):
+        if self.stream_id is not None:
+            self.client.close_stream(self.stream_id)
+            self.stream_id = None
+
+    def __enter__(self) -> 'RemoteStream':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# TimeLog records of one device, oldest first, starting after the last commit.
+class LogExport(RemoteStream):
+    device_id           : str
+    delete_on_commit    : bool
+    filtered            : bool
+    last_log_id         : Optional[int]
+
+    def __init__(self, client : 'Client', stream_id : int, device_id : str, delete_on_commit : bool, filtered : bool = False, read_size : int = DEFAULT_READ_SIZE):
+        super().__init__(client, stream_id, read_size)
+
+        self.device_id          = device_id
+        self.delete_on_commit   = delete_on_commit
+        self.filtered           = filtered
+        self.last_log_id        = None
+
+    def __next__(self) -> Any:
+        record = super().__next__()
+        self.last_log_id = record.log_id
+        return record
+
+    # Call once the records handed out so far are safely stored. Defaults to the last record handed out.
+    def commit(self, log_id : Optional[int] = None):
+        if log_id is None:
+            log_id = self.last_log_id
+        if log_id is None:
+            return
+        if self.filtered:
+            raise ValueError("A filtered export cannot be committed : the cursor covers every record of the device")
+        self.client.commit_log_export(self.device_id, log_id, self.delete_on_commit)
+
 class Client:
     def __init__(self, address : str):
         super().__init__()
@@ -44,14 +130,185 @@ class Client:
         else:
             return Device(connection_id = connection_id, attributes = attribs, device_id = device_id)
 
-    def execute_command(self, connection_id : int, request : str) -> str:
-        self.connection.send(( commands.SEND_AND_RECEIVE, connection_id, request ))
+    # With cached, settings reads (GetDeviceInfo, GetEthernetSetting, ...) may be answered from the broker's cache.
+    # Writes always reach the device and drop what they change from the cache.
+    def execute_command(self, connection_id : int, request : str | bytes, cached : bool = False) -> str:
+        self.connection.send(( commands.SEND_AND_RECEIVE, connection_id, request, cached ))
         succeeded, error_msg, response = self.connection.recv()
         if not succeeded:
             raise Exception(error_msg)
         
         return response
 
+    # A parsed settings response, from the broker's cache unless cached is False.
+    def get_device_settings(self, device_id : str, request : Any, cached : bool = True) -> Any:
+        self.connection.send(( commands.GET_DEVICE_SETTINGS, device_id, request, cached ))
+        succeeded, error_msg, response = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+        return response
+
+    def get_log_photo(self, digest : str) -> Optional[bytes]:
+        self.connection.send(( commands.GET_LOG_PHOTO, digest ))
+        data, = self.connection.recv()
+        return data
+
+    # Streams every log of a device through the broker, which runs the GetFirstGlog / GetNextGlog walk itself.
+    # With resume, the walk starts after the last commit for this device. The cursor is the device's : exports filtered
+    # by user or time neither resume nor commit, and resume defaults to whether the export is unfiltered.
+    def export_logs(
+        self,
+        device_id           : str,
+        user_id             : Optional[int] = None,
+        start_time          : Optional[datetime.datetime] = None,
+        end_time            : Optional[datetime.datetime] = None,
+        resume              : Optional[bool] = None,
+        delete_on_commit    : bool = False
+    ) -> LogExport:
+        filtered = user_id is not None or start_time is not None or end_time is not None
+        if filtered and (resume or delete_on_commit):
+            raise ValueError("Filtered exports cannot resume or delete on commit")
+        if resume is None:
+            resume = not filtered
+
+        self.connection.send(( commands.OPEN_LOG_EXPORT, device_id, user_id, start_time, end_time, resume ))
+        stream_id, = self.connection.recv()
+        return LogExport(self, stream_id, device_id, delete_on_commit, filtered)
+
+    # Streams every user of a device through the broker, which runs the GetFirstUserData / GetNextUserData walk itself
+    # and fetches the requested extras of several users at once. The stream's produced and total follow progress.
+    # With cached, templates the broker's cache says the device holds are not downloaded again. The cache does not see
+    # enrollment done at the terminal, so backups should leave it off.
+    def iter_users(
+        self,
+        device_id       : str,
+        faces           : bool = False,
+        fingerprints    : bool = False,
+        cards           : bool = False,
+        photos          : bool = False,
+        window          : int = DEFAULT_USER_WINDOW,
+        cached          : bool = False
+    ) -> RemoteStream:
+        self.connection.send(( commands.OPEN_USER_EXPORT, device_id, faces, fingerprints, cards, photos, window, cached ))
+        stream_id, = self.connection.recv()
+        return RemoteStream(self, stream_id)
+
+    # Pushes to the device only what differs from the users it was last synced with, and removes users missing from
+    # the list. Streams one result per changed user. With full, what the broker remembers of the device is ignored.
+    def sync_users(self, device_id : str, users : List[Any], prune : bool = True, full : bool = False, window : int = DEFAULT_USER_WINDOW) -> RemoteStream:
+        self.connection.send(( commands.OPEN_USER_SYNC, device_id, users, prune, full, window ))
+        stream_id, = self.connection.recv()
+        return RemoteStream(self, stream_id)
+
+    # EnrollFaceByPhoto of every (user ID, photo) on every device. A photo is either its bytes or the path of a file on
+    # the broker host; the broker shrinks each one once and streams a FaceEnrollResult per user and device.
+    def enroll_faces(self, device_ids : List[str], photos : List[Tuple[int, bytes | str]], max_parallel : int = DEFAULT_ENROLL_PARALLEL) -> RemoteStream:
+        self.connection.send(( commands.OPEN_FACE_ENROLLMENT, device_ids, photos, max_parallel ))
+        stream_id, = self.connection.recv()
+        return RemoteStream(self, stream_id)
+
+    # Brings every device of the groups (fleet_config.ConfigGroup) to the settings its groups declare, sending only the
+    # Set requests whose setting differs. Streams a DeviceConfigResult per device; with dry_run nothing is sent.
+    def push_config(self, groups : List[Any], dry_run : bool = False, fresh : bool = False, max_parallel : int = DEFAULT_CONFIG_PARALLEL) -> RemoteStream:
+        self.connection.send(( commands.OPEN_CONFIG_PUSH, groups, dry_run, fresh, max_parallel ))
+        stream_id, = self.connection.recv()
+        return RemoteStream(self, stream_id)
+
+    # Face and fingerprint templates of one user, from one device to others. Returns a TemplateCopyResult per target.
+    def copy_user_templates(self, source_device_id : str, user_id : int, target_device_ids : List[str]) -> List[Any]:
+        self.connection.send(( commands.COPY_USER_TEMPLATES, source_device_id, user_id, target_device_ids ))
+        succeeded, error_msg, results = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+        return results
+
+    # Upgrades the devices a wave at a time, starting with canary of them. image is either a full URL or the name of a
+    # file in the broker's firmware directory. Options are those of FirmwareRollouts.start. Returns the rollout ID.
+    def start_firmware_rollout(self, image : str, target_version : str, device_ids : List[str], **options) -> int:
+        self.connection.send(( commands.START_FIRMWARE_ROLLOUT, image, target_version, device_ids, options ))
+        succeeded, error_msg, rollout_id = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+        return rollout_id
+
+    # Progress of a rollout, with the state of every device in it.
+    def get_firmware_rollout(self, rollout_id : int) -> Optional[Any]:
+        self.connection.send(( commands.GET_FIRMWARE_ROLLOUT, rollout_id ))
+        rollout, = self.connection.recv()
+        return rollout
+
+    def abort_firmware_rollout(self, rollout_id : int) -> bool:
+        self.connection.send(( commands.ABORT_FIRMWARE_ROLLOUT, rollout_id ))
+        aborted, = self.connection.recv()
+        return aborted
+
+    # Measures the device's clock skew now, and sets its clock if it is beyond the broker's threshold or if forced.
+    # Returns a SkewMeasurement.
+    def sync_device_clock(self, device_id : str, force : bool = False) -> Any:
+        self.connection.send(( commands.SYNC_DEVICE_CLOCK, device_id, force ))
+        succeeded, error_msg, measurement = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+        return measurement
+
+    # Recent SkewMeasurements of a device, oldest first.
+    def get_clock_history(self, device_id : str) -> List[Any]:
+        self.connection.send(( commands.GET_CLOCK_HISTORY, device_id ))
+        history, = self.connection.recv()
+        return history
+
+    # StatusSamples the broker's poller stored for a device, oldest first. start and end are UNIX times; with limit,
+    # only the last ones.
+    def get_status_history(self, device_id : str, start : Optional[float] = None, end : Optional[float] = None, limit : Optional[int] = None) -> List[Any]:
+        self.connection.send(( commands.GET_STATUS_HISTORY, device_id, start, end, limit ))
+        succeeded, error_msg, samples = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+        return samples
+
+    # Every user of a device as a UserTable, columns filled by the broker as it walks the users, so a large device
+    # crosses the connection as a few arrays rather than one pickled UserInfo per user. Cards and QR codes
+    # as the user records carry them; no templates or photos.
+    def get_user_table(self, device_id : str) -> Any:
+        self.connection.send(( commands.GET_USER_TABLE, device_id ))
+        succeeded, error_msg, table = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+        return table
+
+    # Logs kept by the broker's log store, from every device unless device_ids says otherwise, oldest first. start_time
+    # and end_time are device local times, end excluded; with limit, only the last ones. Photos are only sent with
+    # photos. Returns log_store.StoredLog records.
+    def query_stored_logs(
+        self,
+        device_ids  : Optional[List[str]] = None,
+        user_id     : Optional[int] = None,
+        start_time  : Optional[datetime.datetime] = None,
+        end_time    : Optional[datetime.datetime] = None,
+        limit       : Optional[int] = None,
+        photos      : bool = False
+    ) -> List[Any]:
+        self.connection.send(( commands.QUERY_STORED_LOGS, device_ids, user_id, start_time, end_time, limit, photos ))
+        succeeded, error_msg, logs = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+        return logs
+
+    def commit_log_export(self, device_id : str, log_id : int, delete : bool = False):
+        self.connection.send(( commands.COMMIT_LOG_EXPORT, device_id, log_id, delete ))
+        succeeded, error_msg = self.connection.recv()
+        if not succeeded:
+            raise Exception(error_msg)
+
+    # Records, whether the stream has ended, its error if it failed, and (records produced, expected total).
+    def read_stream(self, stream_id : int, max_items : int = DEFAULT_READ_SIZE) -> Tuple[List[Any], bool, Optional[str], Tuple[int, Optional[int]]]:
+        self.connection.send(( commands.READ_STREAM, stream_id, max_items ))
+        return self.connection.recv()
+
+    def close_stream(self, stream_id : int):
+        self.connection.send(( commands.CLOSE_STREAM, stream_id ))
+        self.connection.recv()
+
     def __enter__(self) -> 'Client':
         return self
 
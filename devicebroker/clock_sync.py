@@ -0,0 +1,173 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import datetime
+import logging
+import random
+import statistics
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from .device_cmd.m50 import device_control
+from .streams import ExecuteRequest
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL        : float = 3600
+DEFAULT_THRESHOLD       : float = 2
+DEFAULT_SAMPLES         : int = 6
+DEFAULT_MAX_PARALLEL    : int = 16
+DEFAULT_HISTORY         : int = 96
+
+# Samples slower than this many times the fastest one waited in some queue : their timing says little.
+_RTT_OUTLIER_FACTOR     : float = 2
+
+@dataclass
+class SkewMeasurement:
+    time            : float             # Broker wall time of the measurement
+    skew            : float             # Device clock minus reference, in seconds
+    uncertainty     : float             # Half width of the interval skew is known to lie in
+    rtt             : float             # Fastest GetTime round trip
+    corrected       : bool = False
+    residual        : Optional[float] = None    # Skew measured again after SetTime
+    error           : Optional[str] = None
+
+# Device clock minus reference from (sent, received, device time) samples, all in seconds. A device answering D
+# read its clock somewhere between sent and received, and its clock only shows whole seconds, so each sample bounds
+# the skew to (D - received, D + 1 - sent). Samples spread over a second cut the interval down to about the round
+# trip; when they disagree (a clock stepping unevenly), the median of their midpoints is used instead.
+def estimate_skew(samples : List[Tuple[float, float, float]]) -> Tuple[float, float]:
+    low  = max(device - received for sent, received, device in samples)
+    high = min(device + 1 - sent for sent, received, device in samples)
+    if low <= high:
+        return (low + high) / 2, (high - low) / 2
+
+    midpoints = [device + 0.5 - (sent + received) / 2 for sent, received, device in samples]
+    return statistics.median(midpoints), 0.5 + max(received - sent for sent, received, _ in samples) / 2
+
+# Keeps device clocks within threshold of the broker's. Devices are measured in a random order spread over the whole
+# interval, so the fleet never gets its GetTime burst at once, and only devices found beyond threshold are set.
+class ClockSync:
+    execute         : ExecuteRequest
+    online_devices  : Callable[[], List[str]]
+    interval        : float
+    threshold       : float
+    samples         : int
+    utc_offset      : datetime.timedelta
+    semaphore       : asyncio.Semaphore
+    history         : Dict[str, Deque[SkewMeasurement]]
+    history_size    : int
+
+    def __init__(
+        self,
+        execute         : ExecuteRequest,
+        online_devices  : Callable[[], List[str]],
+        interval        : float = DEFAULT_INTERVAL,
+        threshold       : float = DEFAULT_THRESHOLD,
+        samples         : int = DEFAULT_SAMPLES,
+        utc_offset      : float = 0,
+        max_parallel    : int = DEFAULT_MAX_PARALLEL,
+        history_size    : int = DEFAULT_HISTORY
+    ):
+        super().__init__()
+
+        self.execute        = execute
+        self.online_devices = online_devices
+        self.interval       = interval
+        self.threshold      = threshold
+        self.samples        = samples
+        self.utc_offset     = datetime.timedelta(seconds = utc_offset)
+        self.semaphore      = asyncio.Semaphore(max_parallel)
+        self.history        = dict()
+        self.history_size   = history_size
+
+    # What the device clocks should show, as naive datetimes like the ones devices send.
+    def reference_now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo = None) + self.utc_offset
+
+    # Seconds on the reference clock, on the same scale as device_seconds.
+    def reference_seconds(self) -> float:
+        return time.time() + self.utc_offset.total_seconds()
+
+    @staticmethod
+    def device_seconds(value : datetime.datetime) -> float:
+        return value.replace(tzinfo = datetime.timezone.utc).timestamp()
+
+    async def run(self):
+        while True:
+            cycle_start = time.monotonic()
+            device_ids = self.online_devices()
+            random.shuffle(device_ids)
+
+            tasks = [asyncio.create_task(self.sync_later(device_id, random.uniform(0, self.interval))) for device_id in device_ids]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            await asyncio.sleep(max(self.interval - (time.monotonic() - cycle_start), 0))
+
+    async def sync_later(self, device_id : str, delay : float):
+        await asyncio.sleep(delay)
+        try:
+            await self.sync_device(device_id)
+        except Exception as ex:
+            LOG.warning(f"Clock sync of device {device_id} failed : {ex}")
+
+    async def measure(self, device_id : str) -> SkewMeasurement:
+        samples : List[Tuple[float, float, float]] = []
+        for sample_no in range(0, self.samples):
+            if sample_no > 0:
+                # Spread over a bit more than a second, so some sample sees the device clock tick.
+                await asyncio.sleep(1.1 / self.samples)
+
+            sent = self.reference_seconds()
+            response = await self.execute(device_id, device_control.GetTimeRequest())
+            received = self.reference_seconds()
+            if not response.has_succeeded():
+                raise Exception(f"GetTime failed : {response.fail_reason or response.result}")
+            samples.append((sent, received, self.device_seconds(response.time)))
+
+        fastest = min(received - sent for sent, received, _ in samples)
+        samples = [sample for sample in samples if sample[1] - sample[0] <= max(fastest * _RTT_OUTLIER_FACTOR, 0.05)]
+
+        skew, uncertainty = estimate_skew(samples)
+        return SkewMeasurement(time.time(), skew, uncertainty, fastest)
+
+    async def set_clock(self, device_id : str, rtt : float):
+        # SetTime only carries whole seconds : send it so that it lands just as that second starts on the reference.
+        now = self.reference_seconds()
+        target = int(now + rtt / 2) + 1
+        await asyncio.sleep(max(target - now - rtt / 2, 0))
+
+        response = await self.execute(device_id, device_control.SetTimeRequest(
+            datetime.datetime.fromtimestamp(target, datetime.timezone.utc).replace(tzinfo = None)))
+        if not response.has_succeeded():
+            raise Exception(f"SetTime failed : {response.fail_reason or response.result}")
+
+    async def sync_device(self, device_id : str, force : bool = False) -> SkewMeasurement:
+        async with self.semaphore:
+            measurement = await self.measure(device_id)
+
+            # Only corrected when the skew is beyond doubt, or when asked to.
+            if force or abs(measurement.skew) - measurement.uncertainty > self.threshold:
+                try:
+                    await self.set_clock(device_id, measurement.rtt)
+                    measurement.corrected = True
+                    # SetTime is not acknowledged with the clock it ended up at : look again.
+                    measurement.residual = (await self.measure(device_id)).skew
+                except Exception as ex:
+                    measurement.error = str(ex)
+
+        LOG.info(f"Device {device_id} clock skew {measurement.skew:+.2f}s ±{measurement.uncertainty:.2f}s" +
+                 (f", corrected to {measurement.residual:+.2f}s" if measurement.residual is not None else ""))
+
+        history = self.history.get(device_id, None)
+        if history is None:
+            history = self.history[device_id] = deque(maxlen = self.history_size)
+        history.append(measurement)
+        return measurement
+
+    def get_history(self, device_id : str) -> List[SkewMeasurement]:
+        return list(self.history.get(device_id, ()))
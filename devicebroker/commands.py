@@ -4,14 +4,37 @@ from typing import Final
 CLIENT_CONNECTED        : Final[int]    = 1
 MESSAGE_FROM_CLIENT     : Final[int]    = 2
 CLIENT_DISCONNECTED     : Final[int]    = 3
+STOP_WORKER             : Final[int]    = 4
 
 # Commands from worker to load balancer
 ASSIGN_DEVICE_ID        : Final[int]    = 101
 SEND_MESSAGE_TO_CLIENT  : Final[int]    = 102
 RESPONSE_FROM_DEVICE    : Final[int]    = 103
+WORKER_STATS            : Final[int]    = 104
+WORKER_STOPPED          : Final[int]    = 105
+LOG_FROM_DEVICE         : Final[int]    = 106
 
 # Commands from application to load balancer
 FIND_DEVICE_BY_ID       : Final[int]    = 201
 SEND_AND_RECEIVE        : Final[int]    = 202
 GET_ALL_ONLINE_DEVICES  : Final[int]    = 203
 GET_CONNECTION_INFO     : Final[int]    = 204
+GET_LOG_PHOTO           : Final[int]    = 205
+OPEN_LOG_EXPORT         : Final[int]    = 206
+COMMIT_LOG_EXPORT       : Final[int]    = 207
+READ_STREAM             : Final[int]    = 208
+CLOSE_STREAM            : Final[int]    = 209
+OPEN_USER_EXPORT        : Final[int]    = 210
+OPEN_USER_SYNC          : Final[int]    = 211
+COPY_USER_TEMPLATES     : Final[int]    = 212
+GET_DEVICE_SETTINGS     : Final[int]    = 213
+START_FIRMWARE_ROLLOUT  : Final[int]    = 214
+GET_FIRMWARE_ROLLOUT    : Final[int]    = 215
+ABORT_FIRMWARE_ROLLOUT  : Final[int]    = 216
+SYNC_DEVICE_CLOCK       : Final[int]    = 217
+GET_CLOCK_HISTORY       : Final[int]    = 218
+OPEN_FACE_ENROLLMENT    : Final[int]    = 219
+OPEN_CONFIG_PUSH        : Final[int]    = 220
+GET_STATUS_HISTORY      : Final[int]    = 221
+GET_USER_TABLE          : Final[int]    = 222
+QUERY_STORED_LOGS       : Final[int]    = 223
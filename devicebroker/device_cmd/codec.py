@@ -0,0 +1,515 @@
+import base64
+import binascii
+import datetime
+import functools
+import operator
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from xml.etree import ElementTree
+
+from .. import xml_backend
+from ..xml_templates import escape_text
+
+_MISSING = object()
+
+# A missing field is its default. Text that does not decode is a ValueError, except in optional fields, which fall
+# back to the default the same way parse_int(doc, tag, None) did.
+_DECODE_ERRORS = (ValueError, TypeError, LookupError)
+
+_MAX_CACHED_TAGS = 64
+
+# Binary fields are base64-encoded in slices of this many bytes, so encoding never holds more than one slice
+# of temporary output. A multiple of 3 keeps the slices free of padding.
+BASE64_CHUNK_SIZE = 57 * 1024
+
+# The text of a binary field, left in place inside the raw message until someone asks for the bytes.
+class Base64Text:
+    message : str
+    start   : int
+    end     : int
+
+    def __init__(self, message : str, start : int, end : int):
+        super().__init__()
+
+        self.message    = message
+        self.start      = start
+        self.end        = end
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __str__(self) -> str:
+        return self.message[self.start : self.end]
+
+    def decode(self) -> bytes:
+        return binascii.a2b_base64(self.message[self.start : self.end])
+
+class Codec:
+    decode  : Callable[[Optional[str]], Any]
+    encode  : Callable[[Any], Optional[str]]
+    escape  : bool
+    write   : Optional[Callable[[bytearray, Any], None]]
+
+    def __init__(
+        self,
+        decode  : Callable[[Optional[str]], Any],
+        encode  : Callable[[Any], Optional[str]],
+        escape  : bool = True,
+        write   : Optional[Callable[[bytearray, Any], None]] = None
+    ):
+        super().__init__()
+
+        self.decode = decode
+        self.encode = encode
+        # Codecs that only ever produce digits or base64 can skip XML escaping.
+        self.escape = escape
+        # Writes the encoded text of a non-empty value straight into an output buffer.
+        self.write  = write
+
+def _decode_bool(text : Optional[str]) -> bool:
+    return text == "Yes" or text == "True" or text == "Y" or text == "T"
+
+def _decode_base64(text : str | Base64Text) -> bytes:
+    if isinstance(text, Base64Text):
+        return text.decode()
+    # a2b_base64 reads an ASCII str in place; b64decode would copy it to bytes first.
+    return binascii.a2b_base64(text)
+
+# Text that is already base64, such as a field forwarded from a response with raw_text(), goes out as it is.
+def _encode_base64(value : bytes | str | Base64Text) -> str:
+    if isinstance(value, (str, Base64Text)):
+        return escape_text(str(value))
+    return base64.b64encode(value).decode("ascii")
+
+def _write_base64(buf : bytearray, value : bytes | str | Base64Text):
+    if isinstance(value, (str, Base64Text)):
+        buf += escape_text(str(value)).encode("utf-8")
+        return
+
+    view = memoryview(value).cast("B")
+    for offset in range(0, len(view), BASE64_CHUNK_SIZE):
+        buf += binascii.b2a_base64(view[offset : offset + BASE64_CHUNK_SIZE], newline = False)
+
+def _decode_utf16(text : str) -> str:
+    result = binascii.a2b_base64(text).decode("utf-16")
+    if len(result) > 0 and result[-1] == '\x00':
+        result = result[: -1]
+    return result
+
+def _encode_utf16(value : str) -> str:
+    return base64.b64encode(value.encode("utf-16-le")).decode("ascii")
+
+def _decode_base64_uint(text : str) -> Optional[int]:
+    data = binascii.a2b_base64(text)
+    if len(data) == 0:
+        return None
+    return int.from_bytes(data, "little")
+
+def _encode_base64_uint32(value : int) -> str:
+    if value < 0 or value >= (1 << 32):
+        raise ValueError("Value should be an unsigned 4-byte integer.")
+    return base64.b64encode(value.to_bytes(4, "little")).decode("ascii")
+
+# An empty element is no time, as parse_datetime had it.
+def _decode_datetime(text : Optional[str]) -> Optional[datetime.datetime]:
+    if text is None:
+        return None
+
+    date_portion_end = text.find("-T")
+    if date_portion_end < 0 or not text.endswith("Z"):
+        raise ValueError("Malformed datetime string.")
+
+    year, month, day = text[: date_portion_end].split("-")
+    hour, minute, second = text[date_portion_end + 2 : -1].split(":")
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+
+def _encode_datetime(value : datetime.datetime) -> str:
+    return f"{value.year:04d}-{value.month:02d}-{value.day:02d}-T{value.hour:02d}:{value.minute:02d}:{value.second:02d}Z"
+
+def _decode_packed_date(text : str) -> datetime.date:
+    value = int(text)
+    return datetime.date(2000 + (value >> 16), (value >> 8) & 0xFF, value & 0xFF)
+
+def _encode_packed_date(value : datetime.date) -> str:
+    return str(((value.year - 2000) << 16) | (value.month << 8) | value.day)
+
+STR             = Codec(lambda text: text, lambda value: value)
+INT             = Codec(int, str, escape = False)
+INT_BOOL        = Codec(lambda text: bool(int(text)), lambda value: str(int(value)), escape = False)
+BOOL            = Codec(_decode_bool, lambda value: "Yes" if value else "No", escape = False)
+BASE64          = Codec(_decode_base64, _encode_base64, escape = False, write = _write_base64)
+BASE64_UINT32   = Codec(_decode_base64_uint, _encode_base64_uint32, escape = False)
+UTF16_STRING    = Codec(_decode_utf16, _encode_utf16, escape = False)
+DATETIME        = Codec(_decode_datetime, _encode_datetime, escape = False)
+PACKED_DATE     = Codec(_decode_packed_date, _encode_packed_date, escape = False)
+
+def enum_name(enum_type : type) -> Codec:
+    return Codec(lambda text: enum_type[text], lambda value: value.name)
+
+def enum_value(enum_type : type) -> Codec:
+    return Codec(lambda text: enum_type(int(text)), lambda value: str(value.value), escape = False)
+
+# The text itself is left out : binary fields can be megabytes long.
+def malformed(tag : str, ex : Exception) -> ValueError:
+    return ValueError(f"Malformed {tag} field : {type(ex).__name__}")
+
+class Field:
+    tag             : str
+    codec           : Codec
+    name            : Optional[str]
+    getter          : Callable[[Any], Any]
+    default         : Any
+    default_factory : Optional[Callable[[], Any]]
+    optional        : bool
+    lazy            : bool
+    constant        : bool
+
+    open_tag        : str
+    close_tag       : str
+    empty_tag       : str
+    open_bytes      : bytes
+    close_bytes     : bytes
+    empty_bytes     : bytes
+
+    def __init__(
+        self,
+        tag             : str,
+        codec           : Codec,
+        attr            : str | Callable[[Any], Any] | None = None,
+        default         : Any = None,
+        default_factory : Optional[Callable[[], Any]] = None,
+        optional        : bool = False,
+        value           : Any = _MISSING,
+        lazy            : bool = False
+    ):
+        super().__init__()
+
+        self.tag                = tag
+        self.codec              = codec
+        self.default            = default
+        self.default_factory    = default_factory
+        # Left out when rendering a None value, and decoded leniently.
+        self.optional           = optional
+        # Parsed into a Deferred, for attributes declared as Lazy.
+        self.lazy               = lazy
+
+        # Renders the same for every request, so templates can bake it in.
+        self.constant = value is not _MISSING
+
+        self.name = None
+        if value is not _MISSING:
+            self.getter = lambda source: value
+        elif callable(attr):
+            self.getter = attr
+        elif attr is not None:
+            self.getter = operator.attrgetter(attr)
+            if "." not in attr:
+                self.name = attr
+        else:
+            self.getter = lambda source: None
+
+        self.open_tag       = f"<{tag}>"
+        self.close_tag      = f"</{tag}>"
+        self.empty_tag      = f"<{tag} />"
+        self.open_bytes     = self.open_tag.encode("utf-8")
+        self.close_bytes    = self.close_tag.encode("utf-8")
+        self.empty_bytes    = self.empty_tag.encode("utf-8")
+
+    def make_default(self) -> Any:
+        if self.default_factory is not None:
+            return self.default_factory()
+        return self.default
+
+    def decode_text(self, text : Any) -> Any:
+        if text is _MISSING:
+            return self.make_default()
+        try:
+            return self.codec.decode(text)
+        except _DECODE_ERRORS as ex:
+            if self.optional:
+                return self.make_default()
+            raise malformed(self.tag, ex) from ex
+
+    def decode(self, fields : Dict[str, Optional[str]]) -> Any:
+        return self.decode_text(fields.get(self.tag, _MISSING))
+
+    # Keeps the text for a Lazy attribute to decode on first read. A missing field is just the default.
+    def defer(self, fields : Dict[str, Optional[str]]) -> Any:
+        text = fields.get(self.tag, _MISSING)
+        if text is _MISSING:
+            return self.make_default()
+        return Deferred(self, text)
+
+    def encode_text(self, value : Any) -> Optional[str]:
+        text = self.codec.encode(value)
+        if text and self.codec.escape:
+            text = escape_text(text)
+        return text
+
+    def render_into(self, parts : List[str], source : Any):
+        value = self.getter(source)
+        if value is None and self.optional:
+            return
+
+        # Same output as ElementTree.tostring : a missing or empty text collapses into a self-closing tag.
+        text = self.encode_text(value)
+        if text:
+            parts.append(self.open_tag)
+            parts.append(text)
+            parts.append(self.close_tag)
+        else:
+            parts.append(self.empty_tag)
+
+    def write_into(self, buf : bytearray, source : Any):
+        value = self.getter(source)
+        if value is None and self.optional:
+            return
+
+        if value and self.codec.write is not None:
+            buf += self.open_bytes
+            self.codec.write(buf, value)
+            buf += self.close_bytes
+            return
+
+        text = self.encode_text(value)
+        if text:
+            buf += self.open_bytes
+            buf += text.encode("utf-8")
+            buf += self.close_bytes
+        else:
+            buf += self.empty_bytes
+
+    def append_to(self, root : ElementTree.Element, source : Any):
+        value = self.getter(source)
+        if value is None and self.optional:
+            return
+        xml_backend.sub_element(root, self.tag, self.codec.encode(value))
+
+class Repeated(Field):
+    tag_format  : str
+    count       : Optional[int]
+    start       : int
+    tag_cache   : Dict[int, List[str]]
+
+    def __init__(
+        self,
+        tag_format      : str,
+        codec           : Codec,
+        attr            : str | Callable[[Any], Any] | None = None,
+        count           : Optional[int] = None,
+        start           : int = 0,
+        default         : Any = None,
+        default_factory : Optional[Callable[[], Any]] = None,
+        optional        : bool = False
+    ):
+        super().__init__(tag_format.format(start), codec, attr, default, default_factory, optional)
+
+        self.tag_format = tag_format
+        self.count      = count
+        self.start      = start
+        self.tag_cache  = dict()
+
+    def decode(self, fields : Dict[str, Optional[str]], count : Optional[int] = None) -> List[Any]:
+        if count is None:
+            count = self.count
+
+        result = []
+        if count is None:
+            # Open-ended : read until the first gap.
+            index = self.start
+            while (text := fields.get(self.tag_format.format(index), _MISSING)) is not _MISSING:
+                result.append(self.decode_text(text))
+                index += 1
+        else:
+            for tag in self.tags(count):
+                result.append(self.decode_text(fields.get(tag, _MISSING)))
+        return result
+
+    def tags(self, count : int) -> List[str]:
+        tags = self.tag_cache.get(count)
+        if tags is None:
+            tags = [self.tag_format.format(index) for index in range(self.start, self.start + count)]
+            # Counts can come from the device; only keep the small ones around.
+            if count <= _MAX_CACHED_TAGS:
+                self.tag_cache[count] = tags
+        return tags
+
+    def render_into(self, parts : List[str], source : Any):
+        values = self.getter(source)
+        for tag, value in zip(self.tags(len(values)), values):
+            if value is None and self.optional:
+                continue
+
+            text = self.encode_text(value)
+            if text:
+                parts.append(f"<{tag}>{text}</{tag}>")
+            else:
+                parts.append(f"<{tag} />")
+
+    def write_into(self, buf : bytearray, source : Any):
+        parts = []
+        self.render_into(parts, source)
+        for part in parts:
+            buf += part.encode("utf-8")
+
+    def append_to(self, root : ElementTree.Element, source : Any):
+        values = self.getter(source)
+        for tag, value in zip(self.tags(len(values)), values):
+            if value is None and self.optional:
+                continue
+            xml_backend.sub_element(root, tag, self.codec.encode(value))
+
+# Field text waiting to be decoded. Lazy attributes hold one of these until they are first read.
+class Deferred:
+    field   : Field
+    text    : Any
+
+    def __init__(self, field : Field, text : Any):
+        super().__init__()
+
+        self.field  = field
+        self.text   = text
+
+    def resolve(self) -> Any:
+        return self.field.decode_text(self.text)
+
+# An attribute decoded on first read. The value lives in the "_<name>" slot, or instance attribute for classes
+# without __slots__, as a Deferred until then.
+class Lazy:
+    codec   : Codec
+    default : Any
+    name    : str
+    slot    : str
+
+    def __init__(self, codec : Codec, default : Any = None):
+        super().__init__()
+
+        self.codec      = codec
+        self.default    = default
+
+    def __set_name__(self, owner : type, name : str):
+        self.name = name
+        self.slot = f"_{name}"
+
+    def __get__(self, instance : Any, owner : Optional[type] = None) -> Any:
+        if instance is None:
+            return self
+
+        value = getattr(instance, self.slot, self.default)
+        if isinstance(value, Deferred):
+            value = value.resolve()
+            setattr(instance, self.slot, value)
+        return value
+
+    def __set__(self, instance : Any, value : Any):
+        setattr(instance, self.slot, value)
+
+    # The field text as received, without decoding it. Values set or already decoded are encoded again.
+    def raw(self, instance : Any) -> Any:
+        value = getattr(instance, self.slot, self.default)
+        if isinstance(value, Deferred):
+            return value.text
+        if value is None:
+            return None
+        return self.codec.encode(value)
+
+# Raw text of a Lazy attribute. For base64 fields it can be handed straight to a request, which sends it as is.
+def raw_text(target : Any, name : str) -> Any:
+    return getattr(type(target), name).raw(target)
+
+class Schema:
+    fields      : tuple
+    decoders    : tuple
+
+    def __init__(self, *fields : Field):
+        super().__init__()
+        self.fields = fields
+
+        # Flattened once so parsing a message is a plain loop over tuples, without per-field method calls.
+        self.decoders = tuple(
+            (field.name, field.tag, functools.partial(Deferred, field) if field.lazy else field.codec.decode, field.default, field.default_factory, field.optional)
+            for field in fields
+            if field.name is not None and not isinstance(field, Repeated)
+        )
+
+    def extend(self, *fields : Field) -> 'Schema':
+        return Schema(*self.fields, *fields)
+
+    def decode(self, fields : Dict[str, Optional[str]]) -> Dict[str, Any]:
+        return {field.name : field.decode(fields) for field in self.fields}
+
+    def parse_into(self, target : Any, fields : Dict[str, Optional[str]]):
+        for name, tag, decode, default, default_factory, optional in self.decoders:
+            text = fields.get(tag, _MISSING)
+            if text is not _MISSING:
+                try:
+                    setattr(target, name, decode(text))
+                    continue
+                except _DECODE_ERRORS as ex:
+                    if not optional:
+                        raise malformed(tag, ex) from ex
+            setattr(target, name, default if default_factory is None else default_factory())
+
+        for field in self.fields:
+            if isinstance(field, Repeated) and field.name is not None:
+                setattr(target, field.name, field.decode(fields))
+
+    def render_into(self, parts : List[str], source : Any):
+        for field in self.fields:
+            field.render_into(parts, source)
+
+    def write_into(self, buf : bytearray, source : Any):
+        for field in self.fields:
+            field.write_into(buf, source)
+
+    def append_to(self, root : ElementTree.Element, source : Any):
+        for field in self.fields:
+            field.append_to(root, source)
+
+# One pass over the children instead of one find() per field. The first occurrence of a tag wins, like find().
+def collect_fields(doc : ElementTree.Element) -> Dict[str, Optional[str]]:
+    return {child.tag : child.text for child in reversed(doc)}
+
+# Cuts the text of the given binary fields out of a raw message before it is parsed, so the parser never copies
+# it and the bytes are only decoded if a caller asks for them. Base64 never needs escaping; a field whose text
+# contains an entity is left to the parser.
+def split_binary_fields(message : str, tags : Tuple[str, ...]) -> Tuple[str, Dict[str, Base64Text]]:
+    spans : List[Tuple[int, int, str]] = []
+    for tag in tags:
+        open_tag = f"<{tag}>"
+        start = message.find(open_tag)
+        if start < 0:
+            continue
+        start += len(open_tag)
+        end = message.find(f"</{tag}>", start)
+        if end < 0 or message.find("&", start, end) >= 0:
+            continue
+        spans.append((start, end, tag))
+
+    if len(spans) == 0:
+        return message, dict()
+
+    spans.sort()
+    pieces : List[str] = []
+    binary_fields : Dict[str, Base64Text] = dict()
+    pos = 0
+    for start, end, tag in spans:
+        if start < pos:
+            continue
+        pieces.append(message[pos : start])
+        binary_fields[tag] = Base64Text(message, start, end)
+        pos = end
+    pieces.append(message[pos :])
+
+    return "".join(pieces), binary_fields
+
+def collect_message_fields(message : str, binary_tags : Tuple[str, ...] = ()) -> Dict[str, Any]:
+    skeleton, binary_fields = split_binary_fields(message, binary_tags)
+    fields : Dict[str, Any] = dict()
+    for tag, text in xml_backend.current().iter_children(skeleton):
+        if tag not in fields:
+            fields[tag] = text
+    for tag, text in binary_fields.items():
+        # Only direct children of <Message> count, the same as with collect_fields().
+        if tag in fields and fields[tag] is None:
+            fields[tag] = text
+    return fields
@@ -1,52 +1,54 @@
 from dataclasses import dataclass
 from enum import Enum
 from typing import List, Optional
-from xml.etree import ElementTree
 
 from devicebroker.device_cmd.m50 import device_limits
 
-from .. import messages
+from .. import codec, messages
 
 @dataclass
 class AccessTimeSection:
     start_time  : int   = 0
     end_time    : int   = 0
 
-class GetAccessTimezoneResponse(messages.GenericResponse):
-    time_sections : List[AccessTimeSection]
-
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+def decode_time_section(text : Optional[str]) -> AccessTimeSection:
+    section = AccessTimeSection()
+    if text:
+        try:
+            start, end = text.split(',')
+            section.start_time  = int(start.strip())
+            section.end_time    = int(end.strip())
+        except ValueError:
+            pass
+    return section
 
-        self.time_sections = list()
-        for i in range(0, device_limits.TIMESECTION_COUNT_PER_TIMEZONE):
-            section = AccessTimeSection()
+TIME_SECTION = codec.Codec(decode_time_section, lambda section: f"{section.start_time},{section.end_time}", escape = False)
 
-            data = messages.parse_str(doc, f"TimeSection_{i}")
-            if data:
-                try:
-                    start, end = data.split(',')
-                    section.start_time  = int(start.strip())
-                    section.end_time    = int(end.strip())
-                except ValueError:
-                    pass
+class GetAccessTimezoneResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Repeated("TimeSection_{}", TIME_SECTION, "time_sections", count = device_limits.TIMESECTION_COUNT_PER_TIMEZONE, default_factory = AccessTimeSection),
+    )
 
-            self.time_sections.append(section)
+    time_sections : List[AccessTimeSection]
 
 class GetAccessTimezoneRequest(messages.GenericRequest):
     response_type = GetAccessTimezoneResponse
+    schema = codec.Schema(
+        codec.Field("TimeZoneNo", codec.INT, "timezone_no"),
+    )
+
     timezone_no : int
 
     def __init__(self, timezone_no : int):
         super().__init__("GetAccessTimeZone")
         self.timezone_no = timezone_no
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("TimeZoneNo", self.timezone_no))
-        return result
-
 class SetAccessTimezoneRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("TimeZoneNo", codec.INT, "timezone_no"),
+        codec.Repeated("TimeSection_{}", TIME_SECTION, "time_sections"),
+    )
+
     timezone_no     : int
     time_sections   : List[AccessTimeSection]
 
@@ -55,13 +57,6 @@ class SetAccessTimezoneRequest(messages.GenericRequest):
         self.timezone_no    = timezone_no
         self.time_sections  = time_sections
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("TimeZoneNo", self.timezone_no))
-        for i, section in enumerate(self.time_sections):
-            result.append(messages.make_text_node(f"TimeSection_{i}", f"{section.start_time},{section.end_time}"))
-        return result
-
 class LockControlMode(Enum):
     ForceOpen       = 1
     ForceClose      = 2
@@ -72,11 +67,11 @@ class LockControlMode(Enum):
     IllegalOpen     = 7
 
 class GetLockControlModeResponse(messages.GenericResponse):
-    mode : LockControlMode
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Mode", codec.enum_value(LockControlMode), "mode"),
+    )
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.mode = LockControlMode(messages.parse_int(doc, "Mode"))
+    mode : Optional[LockControlMode]
 
 class GetLockControlModeRequest(messages.GenericRequest):
     response_type = GetLockControlModeResponse
@@ -85,13 +80,12 @@ class GetLockControlModeRequest(messages.GenericRequest):
         super().__init__("LockControlStatus")
 
 class SetLockControlModeRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("Mode", codec.enum_value(LockControlMode), "mode"),
+    )
+
     mode : LockControlMode
 
     def __init__(self, mode : LockControlMode):
         super().__init__("LockControl")
         self.mode = mode
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("Mode", self.mode.value))
-        return result
@@ -1,33 +1,36 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional
-from xml.etree import ElementTree
+from typing import Dict, List, Optional
 
 from devicebroker.device_cmd.m50 import device_limits
 
-from .. import messages
+from .. import codec, messages
 
 class GetDepartmentResponse(messages.GenericResponse):
-    name : str
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Name", codec.UTF16_STRING, "name", default = ""),
+    )
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.name = messages.parse_base64_string(doc, "Name")
+    name : str
 
 class GetDepartmentRequest(messages.GenericRequest):
     response_type = GetDepartmentResponse
+    schema = codec.Schema(
+        codec.Field("DeptNo", codec.INT, "depart_no"),
+    )
+
     depart_no : int
 
     def __init__(self, depart_no : int):
         super().__init__("GetDepartment")
         self.depart_no = depart_no
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("DeptNo", self.depart_no))
-        return result
-
 class SetDepartmentRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("DeptNo", codec.INT, "depart_no"),
+        codec.Field("Data", codec.UTF16_STRING, "name"),
+    )
+
     depart_no   : int
     name        : str
 
@@ -36,33 +39,31 @@ class SetDepartmentRequest(messages.GenericRequest):
         self.depart_no  = depart_no
         self.name       = name
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("DeptNo", self.depart_no))
-        result.append(messages.make_base64_node("Data", self.name.encode(encoding = "unicodelittleunmarked")))
-        return result
-
 class GetProxyDepartmentResponse(messages.GenericResponse):
-    name : str
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Name", codec.UTF16_STRING, "name", default = ""),
+    )
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.name = messages.parse_base64_string(doc, "Name")
+    name : str
 
 class GetProxyDepartmentRequest(messages.GenericRequest):
     response_type = GetProxyDepartmentResponse
+    schema = codec.Schema(
+        codec.Field("ProxyNo", codec.INT, "depart_no"),
+    )
+
     depart_no : int
 
     def __init__(self, depart_no : int):
         super().__init__("GetProxyDept")
         self.depart_no = depart_no
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("ProxyNo", self.depart_no))
-        return result
-
 class SetProxyDepartmentRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("ProxyNo", codec.INT, "depart_no"),
+        codec.Field("Data", codec.UTF16_STRING, "name"),
+    )
+
     depart_no   : int
     name        : str
 
@@ -71,12 +72,6 @@ class SetProxyDepartmentRequest(messages.GenericRequest):
         self.depart_no  = depart_no
         self.name       = name
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("ProxyNo", self.depart_no))
-        result.append(messages.make_base64_node("Data", self.name.encode(encoding = "unicodelittleunmarked")))
-        return result
-    
 @dataclass
 class Bell:
     valid       : bool = False
@@ -84,32 +79,35 @@ class Bell:
     hour        : int  = 0
     minute      : int  = 0
 
-class GetBellSettingsResponse(messages.GenericResponse):
-    ring_times  : int
-    bells       : List[Bell]
+def decode_bell(text : Optional[str]) -> Bell:
+    bell = Bell()
+    if text:
+        try:
+            valid, bell_type, hour, minute = text.split(',')
+            bell.valid      = bool(int(valid.strip()))
+            bell.bell_type  = int(bell_type.strip())
+            bell.hour       = int(hour.strip())
+            bell.minute     = int(minute.strip())
+        except ValueError:
+            pass
+    return bell
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+BELL = codec.Codec(decode_bell, lambda bell: f"{int(bell.valid)},{bell.bell_type},{bell.hour},{bell.minute}", escape = False)
 
-        self.ring_times = messages.parse_int(doc, "BellRingTimes")
-        count = messages.parse_int(doc, "BellCount")
+_BELL_COUNT = codec.Field("BellCount", codec.INT, default = 0)
+_BELLS      = codec.Repeated("Bell_{}", BELL, default_factory = Bell)
 
-        self.bells = list()
-        for i in range(0, count):
-            bell : Bell = Bell()
+class GetBellSettingsResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("BellRingTimes", codec.INT, "ring_times", default = 0),
+    )
 
-            data = messages.parse_str(doc, f"Bell_{i}");
-            if data:
-                try:
-                    valid, bell_type, hour, minute = data.split(',')
-                    bell.valid      = bool(int(valid.strip()))
-                    bell.bell_type  = int(bell_type.strip())
-                    bell.hour       = int(hour.strip())
-                    bell.minute     = int(minute.strip())
-                except ValueError:
-                    pass
+    ring_times  : int
+    bells       : List[Bell]
 
-            self.bells.append(bell)
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
+        self.bells = _BELLS.decode(fields, _BELL_COUNT.decode(fields))
 
 class GetBellSettingsRequest(messages.GenericRequest):
     response_type = GetBellSettingsResponse
@@ -117,6 +115,13 @@ class GetBellSettingsRequest(messages.GenericRequest):
         super().__init__("GetBellTime")
 
 class SetBellSettingsRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("BellRingTimes", codec.INT, "ring_times"),
+        codec.Field("BellPeriod", codec.INT, value = 0),
+        codec.Field("BellCount", codec.INT, lambda request: len(request.bells)),
+        codec.Repeated("Bell_{}", BELL, "bells"),
+    )
+
     ring_times  : int
     bells       : List[Bell]
 
@@ -125,15 +130,6 @@ class SetBellSettingsRequest(messages.GenericRequest):
         self.ring_times = ring_times
         self.bells      = bells
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("BellRingTimes", self.ring_times))
-        result.append(messages.make_int_node("BellPeriod", 0))
-        result.append(messages.make_int_node("BellCount", len(self.bells)))
-        for i, bell in enumerate(self.bells):
-            result.append(messages.make_text_node(f"Bell_{i}", f"{int(bell.valid)},{bell.bell_type},{bell.hour},{bell.minute}"))
-        return result
-
 class AttendStatus(Enum):
     DutyOn        = 0
     DutyOff       = 1
@@ -148,26 +144,26 @@ class AutoAttendance:
     end_time    : int = 0
     status      : AttendStatus = AttendStatus.DutyOn
 
-class GetAutoAttendanceSettingsResponse(messages.GenericResponse):
-    time_sections : List[AutoAttendance]
+def decode_auto_attendance(text : Optional[str]) -> AutoAttendance:
+    item = AutoAttendance()
+    if text:
+        try:
+            start, end, status = text.split(',')
+            item.start_time = int(start.strip())
+            item.end_time   = int(end.strip())
+            item.status     = AttendStatus(int(status.strip()))
+        except ValueError:
+            pass
+    return item
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+AUTO_ATTENDANCE = codec.Codec(decode_auto_attendance, lambda item: f"{item.start_time},{item.end_time},{item.status.value}", escape = False)
 
-        self.time_sections = list()
+class GetAutoAttendanceSettingsResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Repeated("TimeSection_{}", AUTO_ATTENDANCE, "time_sections", count = device_limits.NUM_TR_TIMESECTIONS, default_factory = AutoAttendance),
+    )
 
-        for i in range(0, device_limits.NUM_TR_TIMESECTIONS):
-            item = AutoAttendance()
-            data = messages.parse_str(doc, f"TimeSection_{i}")
-            if data:
-                try:
-                    start, end, status = data.split(',')
-                    item.start_time = int(start.strip())
-                    item.end_time   = int(end.strip())
-                    item.status     = AttendStatus(int(status.strip()))
-                except ValueError:
-                    pass
-            self.time_sections.append(item)
+    time_sections : List[AutoAttendance]
 
 class GetAutoAttendanceSettingsRequest(messages.GenericRequest):
     response_type = GetAutoAttendanceSettingsResponse
@@ -175,14 +171,12 @@ class GetAutoAttendanceSettingsRequest(messages.GenericRequest):
         super().__init__("GetAutoAttendance")
 
 class SetAutoAttendanceSettingsRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Repeated("TimeSection_{}", AUTO_ATTENDANCE, "time_sections"),
+    )
+
     time_sections : List[AutoAttendance]
 
     def __init__(self, time_sections : List[AutoAttendance]):
         super().__init__("SetAutoAttendance")
         self.time_sections = time_sections
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        for i, section in enumerate(self.time_sections):
-            result.append(messages.make_text_node(f"TimeSection_{i}", f"{section.start_time},{section.end_time},{section.status.value}"))
-        return result
@@ -1,28 +1,29 @@
 import datetime
 from enum import Enum
 from typing import Dict, Optional
-from xml.etree import ElementTree
 
-from .. import messages
+from .. import codec, messages
 
 class EnableDeviceRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("Enable", codec.BOOL, "enable"),
+    )
+
     enable : bool
 
     def __init__(self, enable : bool):
         super().__init__("EnableDevice")
         self.enable = enable
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_boolean_node("Enable", self.enable))
-        return result
-
 class GetTimeResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Time", codec.DATETIME, "time"),
+    )
+
     time : datetime.datetime
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.time = messages.parse_datetime(doc, "Time")
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
         if self.time is None:
             raise ValueError("Malformed datetime string.")
 
@@ -32,17 +33,16 @@ class GetTimeRequest(messages.GenericRequest):
         super().__init__("GetTime")
 
 class SetTimeRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("Time", codec.DATETIME, "time"),
+    )
+
     time : datetime.datetime
 
     def __init__(self, time : datetime.datetime):
         super().__init__("SetTime")
         self.time = time
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_datetime_node("Time", self.time))
-        return result
-    
 class DeviceStatusParamType(Enum):
     ManagerCount    = 1
     UserCount       = 2
@@ -66,34 +66,35 @@ class AlarmFlag(Enum):
     LogOverflow     = 16
 
 class GetDeviceStatusResponse(messages.GenericResponse):
-    param_value : Optional[int]
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Value", codec.INT, "param_value", optional = True),
+    )
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.param_value = messages.parse_int(doc, "Value", None)
+    param_value : Optional[int]
 
 class GetDeviceStatusRequest(messages.GenericRequest):
     response_type = GetDeviceStatusResponse
+    schema = codec.Schema(
+        codec.Field("ParamName", codec.enum_name(DeviceStatusParamType), "param"),
+    )
+
     param : DeviceStatusParamType
 
     def __init__(self, param : DeviceStatusParamType):
         super().__init__("GetDeviceStatus")
         self.param = param
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_text_node("ParamName", self.param.name))
-        return result
+_DEVICE_STATUS_FIELDS = [(param, codec.Field(param.name, codec.INT, optional = True)) for param in DeviceStatusParamType]
 
 class GetDeviceStatusAllResponse(messages.GenericResponse):
     device_status : Dict[DeviceStatusParamType, int]
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
 
         self.device_status = dict()
-        for param in DeviceStatusParamType:
-            val = messages.parse_int(doc, param.name, None)
+        for param, field in _DEVICE_STATUS_FIELDS:
+            val = field.decode(fields)
             if val is not None:
                 self.device_status[param] = val
 
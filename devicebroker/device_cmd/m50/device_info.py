@@ -1,8 +1,6 @@
 from enum import Enum
 from typing import Dict, List, Optional
-from xml.etree import ElementTree
-
-from .. import messages
+from .. import codec, messages
 
 class DeviceInfoParamType(Enum):
     ManagersNumber                      = 1
@@ -83,26 +81,30 @@ class VerifyMode(Enum):
 
 
 class GetDeviceInfoResponse(messages.GenericResponse):
-    param_value : Optional[int] = None
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Value", codec.INT, "param_value", optional = True),
+    )
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.param_value = messages.parse_int(doc, "Value", None)
+    param_value : Optional[int] = None
 
 class GetDeviceInfoRequest(messages.GenericRequest):
     response_type = GetDeviceInfoResponse
+    schema = codec.Schema(
+        codec.Field("ParamName", codec.enum_name(DeviceInfoParamType), "param"),
+    )
+
     param : DeviceInfoParamType
 
     def __init__(self, param : DeviceInfoParamType):
         super().__init__("GetDeviceInfo")
         self.param = param
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_text_node("ParamName", self.param.name))
-        return result
-
 class SetDeviceInfoRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("ParamName", codec.enum_name(DeviceInfoParamType), "param"),
+        codec.Field("Value", codec.INT, "value"),
+    )
+
     param : DeviceInfoParamType
     value : int
 
@@ -111,21 +113,17 @@ class SetDeviceInfoRequest(messages.GenericRequest):
         self.param = param
         self.value = value
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_text_node("ParamName", self.param.name))
-        result.append(messages.make_int_node("Value", self.value))
-        return result
+_DEVICE_INFO_FIELDS = [(param, codec.Field(param.name, codec.INT, optional = True)) for param in DeviceInfoParamType]
 
 class GetDeviceInfoAllResponse(messages.GenericResponse):
     device_info : Dict[DeviceInfoParamType, int]
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
 
         self.device_info = dict()
-        for param in DeviceInfoParamType:
-            val = messages.parse_int(doc, param.name, None)
+        for param, field in _DEVICE_INFO_FIELDS:
+            val = field.decode(fields)
             if val is not None:
                 self.device_info[param] = val
 
@@ -145,35 +143,42 @@ class DeviceInfoExtParamType(Enum):
     GPS             = 7
 
 class GetDeviceInfoExtResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Value1", codec.STR, "value1", default = ""),
+        codec.Field("Value2", codec.STR, "value2", default = ""),
+        codec.Field("Value3", codec.STR, "value3", default = ""),
+        codec.Field("Value4", codec.STR, "value4", default = ""),
+        codec.Field("Value5", codec.STR, "value5", default = ""),
+    )
+
     value1 : str
     value2 : str
     value3 : str
     value4 : str
     value5 : str
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.value1 = messages.parse_str(doc, "Value1")
-        self.value2 = messages.parse_str(doc, "Value2")
-        self.value3 = messages.parse_str(doc, "Value3")
-        self.value4 = messages.parse_str(doc, "Value4")
-        self.value5 = messages.parse_str(doc, "Value5")
-
 class GetDeviceInfoExtRequest(messages.GenericRequest):
     response_type = GetDeviceInfoExtResponse
+    schema = codec.Schema(
+        codec.Field("ParamName", codec.enum_name(DeviceInfoExtParamType), "param"),
+    )
+
     param   : DeviceInfoExtParamType
 
     def __init__(self, param : DeviceInfoExtParamType):
         super().__init__("GetDeviceInfoExt")
         self.param = param
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_text_node("ParamName", self.param.name))
-        return result
-
 class SetDeviceInfoExtRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("ParamName", codec.enum_name(DeviceInfoExtParamType), "param"),
+        codec.Field("Value1", codec.STR, "value1", optional = True),
+        codec.Field("Value2", codec.STR, "value2", optional = True),
+        codec.Field("Value3", codec.STR, "value3", optional = True),
+        codec.Field("Value4", codec.STR, "value4", optional = True),
+        codec.Field("Value5", codec.STR, "value5", optional = True),
+    )
+
     param   : DeviceInfoExtParamType
     value1  : Optional[str] = None
     value2  : Optional[str] = None
@@ -197,18 +202,3 @@ class SetDeviceInfoExtRequest(messages.GenericRequest):
         self.value3 = value3
         self.value4 = value4
         self.value5 = value5
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_text_node("ParamName", self.param.name))
-        if self.value1 is not None:
-            result.append(messages.make_text_node("Value1", self.value1))
-        if self.value2 is not None:
-            result.append(messages.make_text_node("Value2", self.value2))
-        if self.value3 is not None:
-            result.append(messages.make_text_node("Value3", self.value3))
-        if self.value4 is not None:
-            result.append(messages.make_text_node("Value4", self.value4))
-        if self.value5 is not None:
-            result.append(messages.make_text_node("Value5", self.value5))
-        return result
@@ -1,103 +1,115 @@
 import datetime
-from typing import Optional
-from xml.etree import ElementTree
+from typing import Dict, Optional
 
-from .. import messages
+from .. import codec, messages
 
 class TimeLog:
+    __slots__ = ("log_id", "timezone_offset", "time", "user_id", "attend_status", "action", "jobcode", "_photo",
+                 "body_temperature", "attend_only", "expired", "latitude", "longitude")
+
     log_id              : int
     timezone_offset     : Optional[int]
-    time                : datetime.datetime
+    time                : Optional[datetime.datetime]
     user_id             : Optional[int]
     attend_status       : str
     action              : str
     jobcode             : int
-    photo               : Optional[bytes]
+    photo               : Optional[bytes]   = codec.Lazy(codec.BASE64)
     body_temperature    : Optional[float]
     attend_only         : bool
     expired             : bool
     latitude            : Optional[str]
     longitude           : Optional[str]
 
+# Temperatures travel as hundredths of a degree.
+HUNDREDTHS = codec.Codec(lambda text: int(text) / 100, lambda value: str(round(value * 100)), escape = False)
+
+_TIME_LOG_SCHEMA = codec.Schema(
+    codec.Field("LogID",              codec.INT,      "log_id",           default = 0),
+    codec.Field("UtcTimezoneMinutes", codec.INT,      "timezone_offset",  optional = True),
+    codec.Field("Time",               codec.DATETIME, "time",             optional = True),
+    codec.Field("UserID",             codec.INT,      "user_id",          optional = True),
+    codec.Field("AttendStat",         codec.STR,      "attend_status",    default = ""),
+    codec.Field("Action",             codec.STR,      "action",           default = ""),
+    codec.Field("JobCode",            codec.INT,      "jobcode",          default = 0),
+    codec.Field("BodyTemperature100", HUNDREDTHS,     "body_temperature", optional = True),
+    codec.Field("AttendOnly",         codec.BOOL,     "attend_only",      default = False),
+    codec.Field("Expired",            codec.BOOL,     "expired",          default = False),
+    codec.Field("Latitude",           codec.STR,      "latitude",         optional = True),
+    codec.Field("Longitude",          codec.STR,      "longitude",        optional = True),
+)
+
+_PHOTO      = codec.Field("Photo", codec.BOOL, default = False)
+_LOG_IMAGE  = codec.Field("LogImage", codec.BASE64, default = b"", lazy = True)
+
+# From GetGlog responses and TimeLog events alike : both carry the same fields.
+def decode_time_log(fields : Dict[str, Optional[str]]) -> TimeLog:
+    record = TimeLog()
+    _TIME_LOG_SCHEMA.parse_into(record, fields)
+
+    # The image is only kept when the device says there is one, and only decoded when read.
+    if _PHOTO.decode(fields):
+        record.photo = _LOG_IMAGE.defer(fields)
+    else:
+        record.photo = None
+    return record
+
 class GetGlogResponse(messages.GenericResponse):
+    __slots__ = ("log", )
+
+    binary_tags = ("LogImage", )
+
     log : TimeLog
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.log = TimeLog()
-        self.log.log_id             = messages.parse_int(doc, "LogID")
-        self.log.timezone_offset    = messages.parse_int(doc, "UtcTimezoneMinutes", None)
-        self.log.time               = messages.parse_datetime(doc, "Time")
-        self.log.user_id            = messages.parse_int(doc, "UserID", None)
-        self.log.attend_status      = messages.parse_str(doc, "AttendStat")
-        self.log.action             = messages.parse_str(doc, "Action")
-        self.log.jobcode            = messages.parse_int(doc, "JobCode")
-        
-        if messages.parse_bool(doc, "Photo"):
-            self.log.photo = messages.parse_base64(doc, "LogImage")
-        else:
-            self.log.photo = None
-
-        if (body_temp := messages.parse_int(doc, "BodyTemperature100", None)) is not None:
-            self.log.body_temperature = body_temp / 100
-        else:
-            self.log.body_temperature = None
-
-        self.log.attend_only        = messages.parse_bool(doc, "AttendOnly")
-        self.log.expired            = messages.parse_bool(doc, "Expired")
-        self.log.latitude           = messages.parse_str(doc, "Latitude", None)
-        self.log.longitude          = messages.parse_str(doc, "Longitude", None)
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
+        self.log = decode_time_log(fields)
 
 class GetFirstGlogRequest(messages.GenericRequest):
     response_type = GetGlogResponse
+    schema = codec.Schema(
+        codec.Field("BeginLogPos", codec.INT, "begin_pos"),
+        codec.Field("UserID", codec.INT, "user_id", optional = True),
+        codec.Field("StartTime", codec.DATETIME, "start_time", optional = True),
+        codec.Field("EndTime", codec.DATETIME, "end_time", optional = True),
+    )
 
     user_id     : Optional[int]
     start_time  : Optional[datetime.datetime]
     end_time    : Optional[datetime.datetime]
+    begin_pos   : int
 
-    def __init__(self, user_id : Optional[int] = None, start_time : Optional[datetime.datetime] = None, end_time : Optional[datetime.datetime] = None):
+    def __init__(self, user_id : Optional[int] = None, start_time : Optional[datetime.datetime] = None, end_time : Optional[datetime.datetime] = None, begin_pos : int = 0):
         super().__init__("GetFirstGlog")
 
         self.user_id    = user_id
         self.start_time = start_time
         self.end_time   = end_time
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("BeginLogPos", 0))
-        if self.user_id is not None:
-            result.append(messages.make_int_node("UserID", self.user_id))
-        if self.start_time is not None:
-            result.append(messages.make_datetime_node("StartTime", self.start_time))
-        if self.end_time is not None:
-            result.append(messages.make_datetime_node("EndTime", self.end_time))
-        return result
+        self.begin_pos  = begin_pos
 
 class GetNextGlogRequest(messages.GenericRequest):
     response_type = GetGlogResponse
+    schema = codec.Schema(
+        codec.Field("BeginLogPos", codec.INT, "pos_begin"),
+    )
+
     pos_begin : int
 
     def __init__(self, pos_begin : int):
         super().__init__("GetNextGlog")
         self.pos_begin = pos_begin
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("BeginLogPos", self.pos_begin))
-        return result
-
 class GetGlogPosInfoResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("LogCount", codec.INT, "log_count", default = 0),
+        codec.Field("MaxCount", codec.INT, "max_count", default = 0),
+        codec.Field("StartPos", codec.INT, "start_pos", default = 0),
+    )
+
     log_count   : int
     max_count   : int
     start_pos   : int
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.log_count  = messages.parse_int(doc, "LogCount")
-        self.max_count  = messages.parse_int(doc, "MaxCount")
-        self.start_pos  = messages.parse_int(doc, "StartPos")
-
 class GetGlogPosInfoRequest(messages.GenericRequest):
     response_type = GetGlogPosInfoResponse
 
@@ -105,13 +117,12 @@ class GetGlogPosInfoRequest(messages.GenericRequest):
         super().__init__("GetGlogPosInfo")
 
 class DeleteGlogWithPosRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("EndPos", codec.INT, "end_pos"),
+    )
+
     end_pos : int
 
     def __init__(self, end_pos : int):
         super().__init__("DeleteGlogWithPos")
         self.end_pos = end_pos
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("EndPos", self.end_pos))
-        return result
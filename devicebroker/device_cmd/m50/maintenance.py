@@ -1,13 +1,17 @@
 from xml.etree import ElementTree
-from .. import messages
+from .. import codec, messages
 
 class GetFirmwareVersionResponse:
+    schema = codec.Schema(
+        codec.Field("Version", codec.STR, "version", default = ""),
+        codec.Field("BuildNumber", codec.STR, "build_number", default = ""),
+    )
+
     version         : str
     build_number    : str
 
     def parse(self, doc : ElementTree.Element):
-        self.version = messages.parse_str(doc, "Version")
-        self.build_number = messages.parse_str(doc, "BuildNumber")
+        self.schema.parse_into(self, codec.collect_fields(doc))
 
 class GetFirmwareVersionRequest(messages.GenericRequest):
     response_type = GetFirmwareVersionResponse
@@ -16,15 +20,13 @@ class GetFirmwareVersionRequest(messages.GenericRequest):
         super().__init__("GetFirmwareVersion")
 
 class WriteFirmwareRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("Size", codec.INT, lambda request: len(request.url)),
+        codec.Field("Data", codec.BASE64, lambda request: request.url.encode("utf-8")),
+    )
+
     url : str
 
     def __init__(self, url : str):
         super().__init__("FirmwareUpgradeHttp")
         self.url = url
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        encoded = self.url.encode("utf-8")
-        result.append(messages.make_int_node("Size", len(self.url)))
-        result.append(messages.make_base64_node("Data", encoded))
-        return result
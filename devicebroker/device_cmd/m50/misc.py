@@ -3,7 +3,7 @@ from enum import Enum
 from typing import Final
 from xml.etree import ElementTree
 
-from .. import messages
+from .. import codec, messages
 
 CENTER_SCREEN_MSG_LEN : Final[int] = 100
 
@@ -14,20 +14,30 @@ class CenterScreenMessageSetting:
     border_color    : int   = 0
     disable_verify  : bool  = False
 
+# Colors travel as ARGB hex with the alpha channel forced to opaque.
+ARGB_COLOR = codec.Codec(lambda text: int(text, 16) & 0xFFFFFF, lambda value: f"FF{value:06X}", escape = False)
+
+def pad_center_screen_message(message : str) -> str:
+    if len(message) > CENTER_SCREEN_MSG_LEN:
+        return message[:CENTER_SCREEN_MSG_LEN]
+    return message + "\x00" * (CENTER_SCREEN_MSG_LEN - len(message))
+
 class GetCenterScreenMessageSettingResponse:
+    schema = codec.Schema(
+        codec.Field("center_screen_message", codec.UTF16_STRING, "message", default = ""),
+        codec.Field("center_screen_message_color", ARGB_COLOR, "color", default = 0),
+        codec.Field("center_screen_message_border_color", ARGB_COLOR, "border_color", default = 0),
+        codec.Field("verify_disable", codec.INT_BOOL, "disable_verify", default = False),
+    )
+
     setting : CenterScreenMessageSetting
 
     def parse(self, doc : ElementTree.Element):
-        message = messages.parse_base64_string(doc, "center_screen_message")
-        if (index := message.find('\x00')) >= 0:
-            message = message[: index]
+        self.setting = CenterScreenMessageSetting()
+        self.schema.parse_into(self.setting, codec.collect_fields(doc))
 
-        self.setting = CenterScreenMessageSetting(
-            message         = message,
-            color           = messages.parse_int(doc, "center_screen_message_color", default = 0, base = 16) & 0xFFFFFF,
-            border_color    = messages.parse_int(doc, "center_screen_message_border_color", default = 0, base = 16) & 0xFFFFFF,
-            disable_verify  = bool(messages.parse_int(doc, "verify_disable"))
-        )
+        if (index := self.setting.message.find('\x00')) >= 0:
+            self.setting.message = self.setting.message[: index]
 
 class GetCenterScreenMessageSettingRequest(messages.GenericRequest):
     response_type = GetCenterScreenMessageSettingResponse
@@ -36,27 +46,19 @@ class GetCenterScreenMessageSettingRequest(messages.GenericRequest):
         super().__init__("GetCenterScreenMessage")
 
 class SetCenterScreenMessageSettingRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("center_screen_message", codec.UTF16_STRING, lambda request: pad_center_screen_message(request.setting.message)),
+        codec.Field("center_screen_message_color", ARGB_COLOR, "setting.color"),
+        codec.Field("center_screen_message_border_color", ARGB_COLOR, "setting.border_color"),
+        codec.Field("verify_disable", codec.INT_BOOL, "setting.disable_verify"),
+    )
+
     setting : CenterScreenMessageSetting
 
     def __init__(self, setting : CenterScreenMessageSetting):
         super().__init__("SetCenterScreenMessage")
         self.setting = setting
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        
-        message = self.setting.message
-        if len(message) > CENTER_SCREEN_MSG_LEN:
-            message = message[:CENTER_SCREEN_MSG_LEN]
-        else:
-            message = message + "\x00" * (CENTER_SCREEN_MSG_LEN - len(message))
-        result.append(messages.make_base64_node("center_screen_message", message.encode(encoding = "unicodelittleunmarked")))
-
-        result.append(messages.make_text_node("center_screen_message_color", f"FF{self.setting.color:06X}"))
-        result.append(messages.make_text_node("center_screen_message_border_color", f"FF{self.setting.border_color:06X}"))
-        result.append(messages.make_int_node("verify_disable", int(self.setting.disable_verify)))
-        return result
-
 class RtspResolution(Enum):
     _1920x1080  = 0
     _1280x720   = 1
@@ -93,13 +95,17 @@ class RtspSetting:
     bitrate     : RtspBitrate = RtspBitrate(0)
 
 class GetVideoStreamingSettingResponse:
+    schema = codec.Schema(
+        codec.Field("rtsp_enable", codec.INT_BOOL, "enabled", default = False),
+        codec.Field("rtsp_resolution", codec.enum_value(RtspResolution), "resolution", default = RtspResolution(0)),
+        codec.Field("rtsp_bitrate_mbps", codec.enum_value(RtspBitrate), "bitrate", default = RtspBitrate(0)),
+    )
+
     setting : RtspSetting
 
     def parse(self, doc : ElementTree.Element):
         self.setting = RtspSetting()
-        self.setting.enabled    = bool(messages.parse_int(doc, "rtsp_enable"))
-        self.setting.resolution = RtspResolution(messages.parse_int(doc, "rtsp_resolution"))
-        self.setting.bitrate    = RtspBitrate(messages.parse_int(doc, "rtsp_bitrate_mbps"))
+        self.schema.parse_into(self.setting, codec.collect_fields(doc))
 
 class GetVideoStreamingSettingRequest(messages.GenericRequest):
     response_type = GetVideoStreamingSettingResponse
@@ -108,15 +114,14 @@ class GetVideoStreamingSettingRequest(messages.GenericRequest):
         super().__init__("GetVideoStreamSetting")
 
 class SetVideoStreamingSettingRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("rtsp_enable", codec.INT_BOOL, "setting.enabled"),
+        codec.Field("rtsp_resolution", codec.enum_value(RtspResolution), "setting.resolution"),
+        codec.Field("rtsp_bitrate_mbps", codec.enum_value(RtspBitrate), "setting.bitrate"),
+    )
+
     setting : RtspSetting
 
     def __init__(self, setting : RtspSetting):
         super().__init__("SetVideoStreamSetting")
         self.setting = setting
-
-    def to_xml(self) -> ElementTree.Element:
-        doc = super().to_xml()
-        doc.append(messages.make_int_node("rtsp_enable", int(self.setting.enabled)))
-        doc.append(messages.make_int_node("rtsp_resolution", self.setting.resolution.value))
-        doc.append(messages.make_int_node("rtsp_bitrate_mbps", self.setting.bitrate.value))
-        return doc
@@ -1,9 +1,20 @@
 from typing import Optional
-from xml.etree import ElementTree
 
-from .. import messages
+from .. import codec, messages
 
 class GetEthernetSettingResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("DHCP",                     codec.BOOL, "use_dhcp",              default = False),
+        codec.Field("IP",                       codec.STR,  "ip_address",            default = ""),
+        codec.Field("Subnet",                   codec.STR,  "subnet_mask",           default = ""),
+        codec.Field("DefaultGateway",           codec.STR,  "gateway",               default = ""),
+        codec.Field("Port",                     codec.INT,  "port",                  optional = True),
+        codec.Field("MacAddress",               codec.STR,  "mac_address",           default = ""),
+        codec.Field("IP_from_dhcp",             codec.STR,  "ip_address_from_dhcp",  default = ""),
+        codec.Field("Subnet_from_dhcp",         codec.STR,  "subnet_mask_from_dhcp", default = ""),
+        codec.Field("DefaultGateway_from_dhcp", codec.STR,  "gateway_from_dhcp",     default = ""),
+    )
+
     use_dhcp                : bool
     ip_address              : str
     subnet_mask             : str
@@ -14,19 +25,6 @@ class GetEthernetSettingResponse(messages.GenericResponse):
     subnet_mask_from_dhcp   : str
     gateway_from_dhcp       : str
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.use_dhcp               = messages.parse_bool(doc, "DHCP")
-        self.ip_address             = messages.parse_str(doc, "IP")
-        self.subnet_mask            = messages.parse_str(doc, "Subnet")
-        self.gateway                = messages.parse_str(doc, "DefaultGateway")
-        self.port                   = messages.parse_int(doc, "Port", None)
-        self.mac_address            = messages.parse_str(doc, "MacAddress")
-        self.ip_address_from_dhcp   = messages.parse_str(doc, "IP_from_dhcp")
-        self.subnet_mask_from_dhcp  = messages.parse_str(doc, "Subnet_from_dhcp")
-        self.gateway_from_dhcp      = messages.parse_str(doc, "DefaultGateway_from_dhcp")
-
 class GetEthernetSettingRequest(messages.GenericRequest):
     response_type = GetEthernetSettingResponse
 
@@ -34,6 +32,14 @@ class GetEthernetSettingRequest(messages.GenericRequest):
         super().__init__("GetEthernetSetting")
 
 class SetEthernetSettingRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("DHCP",             codec.BOOL, "use_dhcp"),
+        codec.Field("IP",               codec.STR,  "ip_address"),
+        codec.Field("Subnet",           codec.STR,  "subnet_mask"),
+        codec.Field("DefaultGateway",   codec.STR,  "gateway"),
+        codec.Field("Port",             codec.INT,  "port"),
+    )
+
     use_dhcp                : bool
     ip_address              : str
     subnet_mask             : str
@@ -49,16 +55,21 @@ class SetEthernetSettingRequest(messages.GenericRequest):
         self.gateway        = gateway
         self.port           = port
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_boolean_node("DHCP", self.use_dhcp))
-        result.append(messages.make_text_node("IP", self.ip_address))
-        result.append(messages.make_text_node("Subnet", self.subnet_mask))
-        result.append(messages.make_text_node("DefaultGateway", self.gateway))
-        result.append(messages.make_int_node("Port", self.port))
-        return result
-
 class GetWifiSettingResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("Use",                      codec.BOOL, "use_wifi",              default = False),
+        codec.Field("SSID",                     codec.STR,  "ssid",                  default = ""),
+        codec.Field("Key",                      codec.STR,  "key",                   default = ""),
+        codec.Field("DHCP",                     codec.BOOL, "use_dhcp",              default = False),
+        codec.Field("IP",                       codec.STR,  "ip_address",            default = ""),
+        codec.Field("Subnet",                   codec.STR,  "subnet_mask",           default = ""),
+        codec.Field("DefaultGateway",           codec.STR,  "gateway",               default = ""),
+        codec.Field("Port",                     codec.INT,  "port",                  optional = True),
+        codec.Field("IP_from_dhcp",             codec.STR,  "ip_address_from_dhcp",  default = ""),
+        codec.Field("Subnet_from_dhcp",         codec.STR,  "subnet_mask_from_dhcp", default = ""),
+        codec.Field("DefaultGateway_from_dhcp", codec.STR,  "gateway_from_dhcp",     default = ""),
+    )
+
     use_wifi                : bool
     ssid                    : str
     key                     : str
@@ -71,21 +82,6 @@ class GetWifiSettingResponse(messages.GenericResponse):
     subnet_mask_from_dhcp   : str
     gateway_from_dhcp       : str
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.use_wifi               = messages.parse_bool(doc, "Use")
-        self.ssid                   = messages.parse_str(doc, "SSID")
-        self.key                    = messages.parse_str(doc, "Key")
-        self.use_dhcp               = messages.parse_bool(doc, "DHCP")
-        self.ip_address             = messages.parse_str(doc, "IP")
-        self.subnet_mask            = messages.parse_str(doc, "Subnet")
-        self.gateway                = messages.parse_str(doc, "DefaultGateway")
-        self.port                   = messages.parse_int(doc, "Port", None)
-        self.ip_address_from_dhcp   = messages.parse_str(doc, "IP_from_dhcp")
-        self.subnet_mask_from_dhcp  = messages.parse_str(doc, "Subnet_from_dhcp")
-        self.gateway_from_dhcp      = messages.parse_str(doc, "DefaultGateway_from_dhcp")
-
 class GetWifiSettingRequest(messages.GenericRequest):
     response_type = GetWifiSettingResponse
 
@@ -93,6 +89,17 @@ class GetWifiSettingRequest(messages.GenericRequest):
         super().__init__("GetWiFiSetting")
 
 class SetWifiSettingRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        codec.Field("Use",              codec.BOOL, "use_wifi"),
+        codec.Field("SSID",             codec.STR,  "ssid"),
+        codec.Field("Key",              codec.STR,  "key"),
+        codec.Field("DHCP",             codec.BOOL, "use_dhcp"),
+        codec.Field("IP",               codec.STR,  "ip_address"),
+        codec.Field("Subnet",           codec.STR,  "subnet_mask"),
+        codec.Field("DefaultGateway",   codec.STR,  "gateway"),
+        codec.Field("Port",             codec.INT,  "port"),
+    )
+
     use_wifi                : bool
     ssid                    : str
     key                     : str
@@ -113,15 +120,3 @@ class SetWifiSettingRequest(messages.GenericRequest):
         self.subnet_mask    = subnet_mask
         self.gateway        = gateway
         self.port           = port
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_boolean_node("Use", self.use_wifi))
-        result.append(messages.make_text_node("SSID", self.ssid))
-        result.append(messages.make_text_node("Key", self.key))
-        result.append(messages.make_boolean_node("DHCP", self.use_dhcp))
-        result.append(messages.make_text_node("IP", self.ip_address))
-        result.append(messages.make_text_node("Subnet", self.subnet_mask))
-        result.append(messages.make_text_node("DefaultGateway", self.gateway))
-        result.append(messages.make_int_node("Port", self.port))
-        return result
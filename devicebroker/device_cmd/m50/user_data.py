@@ -1,10 +1,10 @@
 from dataclasses import dataclass
 import datetime
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from xml.etree import ElementTree
 
-from .. import messages
+from .. import codec, messages
 from . import device_limits
 
 class UserPrivilege(Enum):
@@ -12,246 +12,257 @@ class UserPrivilege(Enum):
     MANAGER         = 2
     ADMINISTRATOR   = 3
 
+TIMESET_COUNT : int = 5
+
+# Slotted, with every container made per instance : a device can hold tens of thousands of users.
 class UserFaceInfo:
-    enrolled        : bool              = False
-    data            : Optional[bytes]   = None
+    __slots__ = ("enrolled", "_data")
+
+    enrolled        : bool
+    data            : Optional[bytes]   = codec.Lazy(codec.BASE64)
+
+    def __init__(self, enrolled : bool = False, data : Optional[bytes] = None):
+        super().__init__()
+
+        self.enrolled   = enrolled
+        self.data       = data
 
 class UserFingerprintInfo:
-    enrolled        : bool              = False
-    duress          : bool              = False
-    data            : Optional[bytes]   = None
+    __slots__ = ("enrolled", "duress", "data")
+
+    enrolled        : bool
+    duress          : bool
+    data            : Optional[bytes]
+
+    def __init__(self, enrolled : bool = False, duress : bool = False, data : Optional[bytes] = None):
+        super().__init__()
+
+        self.enrolled   = enrolled
+        self.duress     = duress
+        self.data       = data
 
 class UserInfo:
-    user_id         : int                       = 0
-    name            : str                       = ""
-    privilege       : UserPrivilege             = UserPrivilege.STANDARD_USER
-    enabled         : bool                      = False
-    department      : int                       = 0
-    timesets        : List[int]                 = [-1] * 5
-    period          : Optional[Tuple[datetime.date, datetime.date]] = None
-    card            : Optional[int]             = None
-    qr              : Optional[int]             = None
-    password        : Optional[str]             = None
-    face            : UserFaceInfo              = UserFaceInfo()
-    fingerprints    : List[UserFingerprintInfo] = [UserFingerprintInfo() for _ in range(0, device_limits.MAX_FINGERS_PER_USER)]
-
-def make_privilege_node(tag : str, value : UserPrivilege):
+    __slots__ = ("user_id", "name", "privilege", "enabled", "department", "timesets", "period", "card", "qr", "password",
+                 "face", "fingerprints", "photo")
+
+    user_id         : int
+    name            : str
+    privilege       : UserPrivilege
+    enabled         : bool
+    department      : int
+    timesets        : List[int]
+    period          : Optional[Tuple[datetime.date, datetime.date]]
+    card            : Optional[int]
+    qr              : Optional[int]
+    password        : Optional[str]
+    face            : UserFaceInfo
+    fingerprints    : List[UserFingerprintInfo]
+    photo           : Optional[bytes]
+
+    def __init__(self):
+        super().__init__()
+
+        self.user_id        = 0
+        self.name           = ""
+        self.privilege      = UserPrivilege.STANDARD_USER
+        self.enabled        = False
+        self.department     = 0
+        self.timesets       = [-1] * TIMESET_COUNT
+        self.period         = None
+        self.card           = None
+        self.qr             = None
+        self.password       = None
+        self.face           = UserFaceInfo()
+        self.fingerprints   = [UserFingerprintInfo() for _ in range(0, device_limits.MAX_FINGERS_PER_USER)]
+        self.photo          = None
+
+def decode_privilege(text : Optional[str]) -> UserPrivilege:
+    match text:
+        case "Administrator":
+            return UserPrivilege.ADMINISTRATOR
+        case "Manager":
+            return UserPrivilege.MANAGER
+        case "User" | _:
+            return UserPrivilege.STANDARD_USER
+
+def encode_privilege(value : UserPrivilege) -> str:
     match value:
         case UserPrivilege.ADMINISTRATOR:
-            priv_str = "Administrator"
+            return "Administrator"
         case UserPrivilege.MANAGER:
-            priv_str = "Manager"
+            return "Manager"
         case UserPrivilege.STANDARD_USER | _:
-            priv_str = "User"
-    return messages.make_text_node(tag, priv_str)
-
-def parse_base64_encoded_uint(doc : ElementTree.Element, tag : str) -> Optional[int]:
-    bin_data = messages.parse_base64(doc, tag)
-    if len(bin_data) == 0:
-        return None
-    else:
-        value = 0
-        for i, x in enumerate(bin_data):
-            value |= x << (i * 8)
-        return value
+            return "User"
+
+PRIVILEGE = codec.Codec(decode_privilege, encode_privilege, escape = False)
+
+_USER_SCHEMA = codec.Schema(
+    codec.Field("UserID",    codec.INT,           "user_id",    default = 0),
+    codec.Field("Name",      codec.UTF16_STRING,  "name",       default = ""),
+    codec.Field("Privilege", PRIVILEGE,           "privilege",  default = UserPrivilege.STANDARD_USER),
+    codec.Field("Enabled",   codec.BOOL,          "enabled",    default = False),
+    codec.Field("Depart",    codec.INT,           "department", default = 0),
+    codec.Field("Card",      codec.BASE64_UINT32, "card"),
+    codec.Field("QR",        codec.BASE64_UINT32, "qr"),
+    codec.Field("PWD",       codec.STR,           "password",   optional = True),
+)
+
+_TIMESETS       = codec.Repeated("TimeSet{}", codec.INT, start = 1, default = -1)
+_PERIOD_USED    = codec.Field("UserPeriod_Used", codec.BOOL, default = False)
+_PERIOD_START   = codec.Field("UserPeriod_Start", codec.PACKED_DATE)
+_PERIOD_END     = codec.Field("UserPeriod_End", codec.PACKED_DATE)
+_FACE_ENROLLED  = codec.Field("FaceEnrolled", codec.BOOL, default = False)
+_FACE_DATA      = codec.Field("FaceData", codec.BASE64, default = b"", lazy = True)
+_FINGERS        = codec.Field("Fingers", codec.INT, default = 0)
 
 class GetUserDataResponse(messages.GenericResponse):
+    __slots__ = ("user", )
+
+    binary_tags = ("FaceData", )
+
     user : Optional[UserInfo]
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
 
         if not self.has_succeeded():
             self.user = None
             return
 
         self.user = UserInfo()
-        self.user.user_id       = messages.parse_int(doc, "UserID")
-        self.user.name          = messages.parse_base64_string(doc, "Name")
-
-        match messages.parse_str(doc, "Privilege"):
-            case "Administrator":
-                self.user.privilege = UserPrivilege.ADMINISTRATOR
-            case "Manager":
-                self.user.privilege = UserPrivilege.MANAGER
-            case "User" | _:
-                self.user.privilege = UserPrivilege.STANDARD_USER
-
-        self.user.enabled       = messages.parse_bool(doc, "Enabled")
-        self.user.department    = messages.parse_int(doc, "Depart")
-
-        for i in range(0, len(self.user.timesets)):
-            self.user.timesets[i] = messages.parse_int(doc, f"TimeSet{i+1}", -1)
-
-        self.user.period = None
-        if messages.parse_bool(doc, "UserPeriod_Used", False):
-            temp = messages.parse_int(doc, "UserPeriod_Start")
-            start_date = datetime.date(2000 + (temp >> 16), (temp >> 8) & 0xFF, (temp & 0xFF))
+        _USER_SCHEMA.parse_into(self.user, fields)
+        self.user.timesets = _TIMESETS.decode(fields, TIMESET_COUNT)
 
-            temp = messages.parse_int(doc, "UserPeriod_End")
-            end_date = datetime.date(2000 + (temp >> 16), (temp >> 8) & 0xFF, (temp & 0xFF))
+        if _PERIOD_USED.decode(fields):
+            start_date  = _PERIOD_START.decode(fields)
+            end_date    = _PERIOD_END.decode(fields)
+            if start_date is not None and end_date is not None:
+                self.user.period = (start_date, end_date)
 
-            self.user.period = (start_date, end_date)
-
-        self.user.card      = parse_base64_encoded_uint(doc, "Card")
-        self.user.qr        = parse_base64_encoded_uint(doc, "QR")
-        self.user.password  = messages.parse_str(doc, "PWD", None)
-
-        self.user.face.enrolled = messages.parse_bool(doc, "FaceEnrolled")
+        self.user.face.enrolled = _FACE_ENROLLED.decode(fields)
         if self.user.face.enrolled:
-            self.user.face.data = messages.parse_base64(doc, "FaceData")
+            self.user.face.data = _FACE_DATA.defer(fields)
         else:
             self.user.face.data = None
 
-        bitmask = messages.parse_int(doc, "Fingers")
+        bitmask = _FINGERS.decode(fields)
         for i in range(0, device_limits.MAX_FINGERS_PER_USER):
             fp = self.user.fingerprints[i]
             fp.enrolled = ((bitmask >> (i * 2)) & 1) != 0
             fp.duress   = fp.enrolled and ((bitmask >> (i * 2 + 1)) & 1) != 0
             fp.data     = None
 
+_USER_ID = codec.Field("UserID", codec.INT, "user_id")
+
 class GetUserDataRequest(messages.GenericRequest):
     response_type = GetUserDataResponse
+    schema = codec.Schema(_USER_ID)
 
     def __init__(self, user_id : int):
         super().__init__("GetUserData")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_text_node("UserID", str(self.user_id)))
-        return result
-
 class GetNextUserDataResponse(GetUserDataResponse):
-    has_more : bool
+    __slots__ = ("has_more", )
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.has_more = messages.parse_bool(doc, "More")
+    schema = GetUserDataResponse.schema.extend(
+        codec.Field("More", codec.BOOL, "has_more", default = False),
+    )
+
+    has_more : bool
 
 class GetNextUserDataRequest(messages.GenericRequest):
     response_type = GetNextUserDataResponse
+    schema = codec.Schema(_USER_ID)
 
     def __init__(self, user_id : int):
         super().__init__("GetNextUserDataExt")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_text_node("UserID", str(self.user_id)))
-        return result
-
 class GetFirstUserDataRequest(GetNextUserDataRequest):
     def __init__(self):
         super().__init__(0)
 
 class SetUserDataResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+    )
+
     user_id : int
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-        self.user_id = messages.parse_int(doc, "UserID")
+def encode_user_name(name : Optional[str]) -> Optional[bytes]:
+    if name is None or name == "":
+        return None
+
+    if len(name) > device_limits.MAX_NAME_LEN//2:
+        name = name[: device_limits.MAX_NAME_LEN//2]
+    data = name.encode(encoding = "unicodelittleunmarked")
+    return data + (b'\x00' * (device_limits.MAX_NAME_LEN + 2 - len(data)))
+
+# Devices expect a placeholder of 2000-01-01 when the validity period is unused.
+_NO_PERIOD = (datetime.date(2000, 1, 1), datetime.date(2000, 1, 1))
 
 class SetUserDataRequest(messages.GenericRequest):
     response_type = SetUserDataResponse
+    schema = codec.Schema(
+        codec.Field("UserID",           codec.INT,           "user.user_id"),
+        codec.Field("Type",             codec.STR,           value = "Set"),
+        codec.Field("Name",             codec.BASE64,        lambda request: encode_user_name(request.user.name), optional = True),
+        codec.Field("Depart",           codec.INT,           "user.department"),
+        codec.Field("Privilege",        PRIVILEGE,           "user.privilege"),
+        codec.Field("Enabled",          codec.BOOL,          "user.enabled"),
+        codec.Repeated("TimeSet{}",     codec.INT,           lambda request: [x if x >= 0 else None for x in request.user.timesets], start = 1, optional = True),
+        codec.Field("UserPeriod_Used",  codec.BOOL,          lambda request: request.user.period is not None),
+        codec.Field("UserPeriod_Start", codec.PACKED_DATE,   lambda request: (request.user.period or _NO_PERIOD)[0]),
+        codec.Field("UserPeriod_End",   codec.PACKED_DATE,   lambda request: (request.user.period or _NO_PERIOD)[1]),
+        codec.Field("Card",             codec.BASE64_UINT32, "user.card", optional = True),
+        codec.Field("QR",               codec.BASE64_UINT32, "user.qr", optional = True),
+        codec.Field("PWD",              codec.STR,           "user.password", optional = True),
+    )
 
     def __init__(self, user : UserInfo):
         super().__init__("SetUserData")
         self.user = user
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user.user_id))
-        result.append(messages.make_text_node("Type", "Set"))
-
-        # Encode name
-        name = self.user.name
-        if name is not None and name != "":
-            if len(name) > device_limits.MAX_NAME_LEN//2:
-                name = name[: device_limits.MAX_NAME_LEN//2]
-            name = name.encode(encoding = "unicodelittleunmarked")
-            name = name + (b'\x00' * (device_limits.MAX_NAME_LEN + 2 - len(name)))
-            result.append(messages.make_base64_node("Name", name))
-
-        result.append(messages.make_int_node("Depart", self.user.department))
-        result.append(make_privilege_node("Privilege", self.user.privilege))
-        result.append(messages.make_boolean_node("Enabled", self.user.enabled))
-
-        for i, value in enumerate(self.user.timesets):
-            if value >= 0:
-                result.append(messages.make_int_node(f"TimeSet{i + 1}", value))
-
-        period_valid = self.user.period is not None
-        result.append(messages.make_boolean_node("UserPeriod_Used", period_valid))
-        if period_valid:
-            period_start, period_end = self.user.period
-            result.append(messages.make_int_node("UserPeriod_Start", ((period_start.year - 2000) << 16) | (period_start.month << 8) | period_start.day))
-            result.append(messages.make_int_node("UserPeriod_End"  , ((period_end  .year - 2000) << 16) | (period_end  .month << 8) | period_end  .day))
-        else:
-            result.append(messages.make_int_node("UserPeriod_Start", 0x0101))
-            result.append(messages.make_int_node("UserPeriod_End"  , 0x0101))
-
-        if self.user.card is not None:
-            if self.user.card < 0 or self.user.card >= (1 << 32):
-                raise ValueError("Card number should be an unsigned 4-byte integer.")
-
-            result.append(messages.make_base64_node("Card", bytes([
-                self.user.card & 0xff,
-                (self.user.card >> 8) & 0xff,
-                (self.user.card >> 16) & 0xff,
-                (self.user.card >> 24) & 0xff])))
-
-        if self.user.qr is not None:
-            if self.user.qr < 0 or self.user.qr >= (1 << 32):
-                raise ValueError("QR must be an unsigned 4-byte integer.")
-
-            result.append(messages.make_base64_node("QR", bytes([
-                self.user.qr & 0xff,
-                (self.user.qr >> 8) & 0xff,
-                (self.user.qr >> 16) & 0xff,
-                (self.user.qr >> 24) & 0xff])))
-
-        if self.user.password is not None:
-            result.append(messages.make_text_node("PWD", self.user.password))
-
-        return result
-
 class DeleteUserRequest(messages.GenericRequest):
     response_type = SetUserDataResponse
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("Type", codec.STR, value = "Delete"),
+    )
 
     def __init__(self, user_id : int):
         super().__init__("SetUserData")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        result.append(messages.make_text_node("Type", "Delete"))
-        return result
-
 class GetFaceDataResponse(messages.GenericResponse):
-    user_id : int
-    face    : bytes
+    __slots__ = ("user_id", "_face")
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+    binary_tags = ("FaceData", )
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+        codec.Field("FaceData", codec.BASE64, "face", default = b"", lazy = True),
+    )
 
-        self.user_id = messages.parse_int(doc, "UserID")
-        self.face = messages.parse_base64(doc, "FaceData")
+    user_id : int
+    face    : bytes = codec.Lazy(codec.BASE64)
 
 class GetFaceDataRequest(messages.GenericRequest):
     response_type = GetFaceDataResponse
+    schema = codec.Schema(_USER_ID)
 
     def __init__(self, user_id : int):
         super().__init__("GetFaceData")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        return result
-
 class SetFaceDataRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("FaceData", codec.BASE64, "face_data", optional = True),
+        codec.Field("Privilege", PRIVILEGE, "privilege", optional = True),
+        codec.Field("DuplicationCheck", codec.BOOL, "check_duplication"),
+    )
+
     user_id             : int
     face_data           : Optional[bytes]
     check_duplication   : bool
@@ -265,46 +276,45 @@ class SetFaceDataRequest(messages.GenericRequest):
         self.check_duplication  = check_duplication
         self.privilege          = privilege
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        if self.face_data is not None:
-            result.append(messages.make_base64_node("FaceData", self.face_data))
-        if self.privilege is not None:
-            result.append(make_privilege_node("Privilege", self.privilege))
-        result.append(messages.make_boolean_node("DuplicationCheck", self.check_duplication))
-        return result
-
 class GetFingerprintDataResponse(messages.GenericResponse):
+    __slots__ = ("user_id", "finger_no", "_fingerprint_data", "is_duress")
+
+    binary_tags = ("FingerData", )
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+        codec.Field("FingerNo", codec.INT, "finger_no", default = 0),
+        codec.Field("FingerData", codec.BASE64, "fingerprint_data", default = b"", lazy = True),
+        codec.Field("Duress", codec.BOOL, "is_duress", default = False),
+    )
+
     user_id             : int
     finger_no           : int
-    fingerprint_data    : bytes
+    fingerprint_data    : bytes = codec.Lazy(codec.BASE64)
     is_duress           : bool
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.user_id            = messages.parse_int(doc, "UserID")
-        self.finger_no          = messages.parse_int(doc, "FingerNo")
-        self.fingerprint_data   = messages.parse_base64(doc, "FingerData")
-        self.is_duress          = messages.parse_bool(doc, "Duress")
-
 class GetFingerprintDataRequest(messages.GenericRequest):
     response_type       = GetFingerprintDataResponse
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("FingerNo", codec.INT, "finger_no"),
+        codec.Field("FingerOnly", codec.INT, value = 1),
+    )
 
     def __init__(self, user_id : int, finger_no : int):
         super().__init__("GetFingerData")
         self.user_id    = user_id
         self.finger_no  = finger_no
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        result.append(messages.make_int_node("FingerNo", self.finger_no))
-        result.append(messages.make_int_node("FingerOnly", 1))
-        return result
-
 class SetFingerprintDataRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("FingerNo", codec.INT, "finger_no"),
+        codec.Field("FingerData", codec.BASE64, "fingerprint_data", optional = True),
+        codec.Field("Duress", codec.INT_BOOL, "is_duress"),
+        codec.Field("DuplicationCheck", codec.INT_BOOL, "check_duplication"),
+        codec.Field("Privilege", PRIVILEGE, "privilege", optional = True),
+    )
+
     user_id             : int
     finger_no           : int
     fingerprint_data    : Optional[bytes]
@@ -323,115 +333,102 @@ class SetFingerprintDataRequest(messages.GenericRequest):
         self.check_duplication  = check_duplication
         self.privilege          = privilege
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        result.append(messages.make_int_node("FingerNo", self.finger_no))
-        if self.fingerprint_data is not None:
-            result.append(messages.make_base64_node("FingerData", self.fingerprint_data))
-        result.append(messages.make_int_node("Duress", int(self.is_duress)))
-        result.append(messages.make_int_node("DuplicationCheck", int(self.check_duplication)))
-        if self.privilege is not None:
-            result.append(make_privilege_node("Privilege", self.privilege))
-        return result
-
 class GetUserPasswordResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+        codec.Field("Password", codec.STR, "password", default = ""),
+    )
+
     user_id     : int
     password    : str
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.user_id    = messages.parse_int(doc, "UserID")
-        self.password   = messages.parse_str(doc, "Password")
-
 class GetUserPasswordRequest(messages.GenericRequest):
     response_type = GetUserPasswordResponse
+    schema = codec.Schema(_USER_ID)
+
     user_id     : int
 
     def __init__(self, user_id : int):
         super().__init__("GetUserPassword")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        return result
-
 class GetUserCardResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+        codec.Field("CardNo", codec.BASE64_UINT32, "card"),
+    )
+
     user_id     : int
     card        : Optional[int]
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.user_id    = messages.parse_int(doc, "UserID")
-        self.card       = parse_base64_encoded_uint(doc, "CardNo")
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
         if self.card == 0:
             self.card = None
 
 class GetUserCardRequest(messages.GenericRequest):
     response_type = GetUserCardResponse
+    schema = codec.Schema(_USER_ID)
+
     user_id     : int
 
     def __init__(self, user_id : int):
         super().__init__("GetUserCardNo")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        return result
-
 class GetUserQRResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+        codec.Field("QR", codec.BASE64_UINT32, "qr"),
+    )
+
     user_id     : int
     qr          : Optional[int]
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.user_id    = messages.parse_int(doc, "UserID")
-        self.qr         = parse_base64_encoded_uint(doc, "QR")
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        super().parse_fields(fields)
         if self.qr == 0:
             self.qr = None
 
 class GetUserQRRequest(messages.GenericRequest):
     response_type = GetUserQRResponse
+    schema = codec.Schema(_USER_ID)
+
     user_id     : int
 
     def __init__(self, user_id : int):
         super().__init__("GetUserQR")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        return result
-
 class GetUserPhotoResponse(messages.GenericResponse):
-    user_id     : int
-    photo       : bytes
+    __slots__ = ("user_id", "_photo")
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
+    binary_tags = ("PhotoData", )
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+        codec.Field("PhotoData", codec.BASE64, "photo", default = b"", lazy = True),
+    )
 
-        self.user_id    = messages.parse_int(doc, "UserID")
-        self.photo      = messages.parse_base64(doc, "PhotoData")
+    user_id     : int
+    photo       : bytes = codec.Lazy(codec.BASE64)
 
 class GetUserPhotoRequest(messages.GenericRequest):
     response_type = GetUserPhotoResponse
+    schema = codec.Schema(_USER_ID)
+
     user_id     : int
 
     def __init__(self, user_id : int):
         super().__init__("GetUserPhoto")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        return result
-
 class SetUserPhotoRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("PhotoSize", codec.INT, lambda request: len(request.photo) if request.photo else 0),
+        codec.Field("PhotoData", codec.BASE64, lambda request: request.photo or None, optional = True),
+    )
+
     user_id : int
     photo   : Optional[bytes]
 
@@ -441,30 +438,18 @@ class SetUserPhotoRequest(messages.GenericRequest):
         self.user_id = user_id
         self.photo = photo
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-
-        if self.photo is not None and len(self.photo) > 0:
-            result.append(messages.make_int_node("PhotoSize", len(self.photo)))
-            result.append(messages.make_base64_node("PhotoData", self.photo))
-        else:
-            result.append(messages.make_int_node("PhotoSize", 0))
-
-        return result
-
 class GetUserAttendOnlySettingResponse(messages.GenericResponse):
+    schema = messages.GenericResponse.schema.extend(
+        codec.Field("UserID", codec.INT, "user_id", default = 0),
+        codec.Field("Value", codec.BOOL, "value", default = False),
+    )
+
     user_id     : int
     value       : bool
 
-    def parse(self, doc : ElementTree.Element):
-        super().parse(doc)
-
-        self.user_id    = messages.parse_int(doc, "UserID")
-        self.value      = messages.parse_bool(doc, "Value")
-
 class GetUserAttendOnlySettingRequest(messages.GenericRequest):
     response_type = GetUserAttendOnlySettingResponse
+    schema = codec.Schema(_USER_ID)
 
     user_id : int
 
@@ -472,12 +457,12 @@ class GetUserAttendOnlySettingRequest(messages.GenericRequest):
         super().__init__("GetUserAttendOnly")
         self.user_id = user_id
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        return result
-
 class SetUserAttendOnlySettingRequest(messages.GenericRequest):
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("Value", codec.BOOL, "value"),
+    )
+
     user_id : int
     value   : bool
 
@@ -486,12 +471,6 @@ class SetUserAttendOnlySettingRequest(messages.GenericRequest):
         self.user_id = user_id
         self.value = value
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        result.append(messages.make_boolean_node("Value", self.value))
-        return result
-
 class BeginRemoteEnrollResult(Enum):
     Success                     = 0
     InvalidBackup               = 1
@@ -508,14 +487,14 @@ class BeginRemoteEnrollResult(Enum):
     Unknown                     = 12
 
 class BeginRemoteEnrollResponse:
+    schema = codec.Schema(
+        codec.Field("ResultCode", codec.enum_name(BeginRemoteEnrollResult), "result_code", default = BeginRemoteEnrollResult.Unknown),
+    )
+
     result_code : BeginRemoteEnrollResult
 
     def parse(self, doc : ElementTree.Element):
-        val = messages.parse_str(doc, "ResultCode")
-        try:
-            self.result_code = BeginRemoteEnrollResult[val]
-        except:
-            self.result_code = BeginRemoteEnrollResult.Unknown
+        self.schema.parse_into(self, codec.collect_fields(doc))
 
     def has_succeeded(self) -> bool:
         return self.result_code == BeginRemoteEnrollResult.Success
@@ -528,6 +507,11 @@ class RemoteEnrollType(Enum):
 
 class BeginRemoteEnrollRequest(messages.GenericRequest):
     response_type = BeginRemoteEnrollResponse
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("Backup", codec.STR, lambda request: "RemoteEnroll" + request.enroll_type.name),
+        codec.Field("FingerNo", codec.INT, "fp_no", optional = True),
+    )
 
     user_id     : int
     enroll_type : RemoteEnrollType
@@ -539,28 +523,20 @@ class BeginRemoteEnrollRequest(messages.GenericRequest):
         self.enroll_type    = enroll_type
         self.fp_no          = fp_no
 
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        result.append(messages.make_text_node("Backup", "RemoteEnroll" + self.enroll_type.name))
-        if self.fp_no is not None:
-            result.append(messages.make_text_node("FingerNo", self.fp_no))
-        return result
-
 class ExitRemoteEnrollResult(Enum):
     SuccessExitRemoteEnroll = 0
     NotStartedRemoteEnroll  = 1
     Unknown                 = 2
 
 class ExitRemoteEnrollResponse:
+    schema = codec.Schema(
+        codec.Field("ResultCode", codec.enum_name(ExitRemoteEnrollResult), "result_code", default = ExitRemoteEnrollResult.Unknown),
+    )
+
     result_code : ExitRemoteEnrollResult
 
     def parse(self, doc : ElementTree.Element):
-        val = messages.parse_str(doc, "ResultCode")
-        try:
-            self.result_code = ExitRemoteEnrollResult[val]
-        except:
-            self.result_code = ExitRemoteEnrollResult.Unknown
+        self.schema.parse_into(self, codec.collect_fields(doc))
 
     def has_succeeded(self) -> bool:
         return self.result_code == ExitRemoteEnrollResult.SuccessExitRemoteEnroll
@@ -577,14 +553,14 @@ class RemoteEnrollStatus(Enum):
     Unknown                     = 2
 
 class QueryRemoteEnrollStatusResponse:
+    schema = codec.Schema(
+        codec.Field("ResultCode", codec.enum_name(RemoteEnrollStatus), "result_code", default = RemoteEnrollStatus.Unknown),
+    )
+
     result_code : RemoteEnrollStatus
 
     def parse(self, doc : ElementTree.Element):
-        val = messages.parse_str(doc, "ResultCode")
-        try:
-            self.result_code = RemoteEnrollStatus[val]
-        except:
-            self.result_code = RemoteEnrollStatus.Unknown
+        self.schema.parse_into(self, codec.collect_fields(doc))
 
     def has_succeeded(self) -> bool:
         return self.result_code != RemoteEnrollStatus.Unknown
@@ -597,6 +573,12 @@ class QueryRemoteEnrollStatusRequest(messages.GenericRequest):
 
 class EnrollFaceByPhotoRequest(messages.GenericRequest):
     response_type = messages.GenericResponse
+    schema = codec.Schema(
+        _USER_ID,
+        codec.Field("PhotoSize", codec.INT, lambda request: len(request.photo_data)),
+        codec.Field("PhotoData", codec.BASE64, "photo_data"),
+    )
+
     user_id     : int
     photo_data  : bytes
 
@@ -604,10 +586,3 @@ class EnrollFaceByPhotoRequest(messages.GenericRequest):
         super().__init__("EnrollFaceByPhoto")
         self.user_id    = user_id
         self.photo_data = photo_data
-
-    def to_xml(self) -> ElementTree.Element:
-        result = super().to_xml()
-        result.append(messages.make_int_node("UserID", self.user_id))
-        result.append(messages.make_int_node("PhotoSize", len(self.photo_data)))
-        result.append(messages.make_base64_node("PhotoData", self.photo_data))
-        return result
@@ -1,21 +1,39 @@
 import base64
+import binascii
 import datetime
-from typing import Optional, TypeVar
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 from xml.etree import ElementTree
 
+from .. import xml_backend
 from ..client import Client
+from ..xml_templates import escape_text
+from . import codec
 
 class GenericResponse:
+    __slots__ = ("result", "fail_reason")
+
+    schema = codec.Schema(
+        codec.Field("Result", codec.STR, "result"),
+        codec.Field("Reason", codec.STR, "fail_reason"),
+    )
+
+    # Large base64 fields that are decoded straight from the raw message, and only when read.
+    binary_tags : Tuple[str, ...] = ()
+
     result      : str
     fail_reason : Optional[str]
 
     def parse(self, doc : ElementTree.Element):
-        self.result = doc.findtext("Result")
+        self.parse_fields(codec.collect_fields(doc))
+
+    def parse_message(self, message : str):
+        self.parse_fields(codec.collect_message_fields(message, self.binary_tags))
+
+    def parse_fields(self, fields : Dict[str, Optional[str]]):
+        self.schema.parse_into(self, fields)
         if not self.result:
             self.result = "OK"
 
-        self.fail_reason = parse_str(doc, "Reason", None)
-
     def has_succeeded(self) -> bool:
         return self.result == "OK"
 
@@ -46,7 +64,7 @@ def parse_base64(node : ElementTree.Element, tag : str) -> bytes:
     elem = node.find(tag)
     if elem is None:
         return b""
-    return base64.b64decode(elem.text)
+    return binascii.a2b_base64(elem.text)
 
 def parse_base64_string(node : ElementTree.Element, tag : str) -> str:
     data = parse_base64(node, tag)
@@ -79,9 +97,7 @@ def parse_datetime(node : ElementTree.Element, tag : str, default : _T = None) -
         return default
 
 def make_text_node(tag : str, value : str) -> ElementTree.Element:
-    res = ElementTree.Element(tag)
-    res.text = value
-    return res
+    return xml_backend.current().element(tag, value)
 
 def make_base64_node(tag : str, value : bytes) -> ElementTree.Element:
     return make_text_node(tag, base64.b64encode(value).decode("ascii"))
@@ -96,22 +112,120 @@ def make_datetime_node(tag : str, value : datetime.datetime) -> ElementTree.Elem
     return make_text_node(tag, f"{value.year:04d}-{value.month:02d}-{value.day:02d}-T{value.hour:02d}:{value.minute:02d}:{value.second:02d}Z")
 
 
+# The serialized form of a request, split once into literal text and the fields that differ between instances.
+# Requests made only of constant fields render to one cached string; the others append their variable fields
+# between a precomputed prefix and suffix.
+class RequestTemplate:
+    prefix      : str
+    suffix      : str
+    steps       : Tuple[Callable[[List[str], Any], None], ...]
+    byte_prefix : bytes
+    byte_suffix : bytes
+    byte_steps  : Tuple[Callable[[bytearray, Any], None], ...]
+    text        : Optional[str]
+    data        : Optional[bytes]
+
+    def __init__(self, cmd : str, schema : codec.Schema):
+        super().__init__()
+
+        literals : List[str] = []
+        variable : List[codec.Field] = []
+        parts = ["<Message><Request>", escape_text(cmd), "</Request>"]
+        for field in schema.fields:
+            if field.constant:
+                field.render_into(parts, None)
+                continue
+            literals.append("".join(parts))
+            variable.append(field)
+            parts = []
+        parts.append("</Message>")
+        literals.append("".join(parts))
+
+        steps       : List[Callable[[List[str], Any], None]] = []
+        byte_steps  : List[Callable[[bytearray, Any], None]] = []
+        for literal, field in zip(literals[1 : -1], variable[1 :]):
+            # Constant fields sandwiched between variable ones. Rare enough that a closure per literal is fine.
+            if literal:
+                data = literal.encode("utf-8")
+                steps.append(lambda parts, source, literal = literal: parts.append(literal))
+                byte_steps.append(lambda buf, source, data = data: buf.extend(data))
+            steps.append(field.render_into)
+            byte_steps.append(field.write_into)
+        if variable:
+            steps.insert(0, variable[0].render_into)
+            byte_steps.insert(0, variable[0].write_into)
+
+        self.prefix         = literals[0]
+        self.suffix         = literals[-1]
+        self.steps          = tuple(steps)
+        self.byte_prefix    = self.prefix.encode("utf-8")
+        self.byte_suffix    = self.suffix.encode("utf-8")
+        self.byte_steps     = tuple(byte_steps)
+        self.text           = None if variable else self.prefix
+        self.data           = None if variable else self.byte_prefix
+
+    def render(self, source : Any) -> str:
+        if self.text is not None:
+            return self.text
+
+        parts = [self.prefix]
+        for step in self.steps:
+            step(parts, source)
+        parts.append(self.suffix)
+        return "".join(parts)
+
+    def write(self, source : Any) -> bytearray:
+        if self.data is not None:
+            return bytearray(self.data)
+
+        buf = bytearray(self.byte_prefix)
+        for step in self.byte_steps:
+            step(buf, source)
+        buf += self.byte_suffix
+        return buf
+
+_request_templates : Dict[Tuple[codec.Schema, str], RequestTemplate] = dict()
+
+def request_template(cmd : str, schema : codec.Schema) -> RequestTemplate:
+    template = _request_templates.get((schema, cmd), None)
+    if template is None:
+        template = RequestTemplate(cmd, schema)
+        _request_templates[(schema, cmd)] = template
+    return template
+
 class GenericRequest:
     response_type = GenericResponse
+    schema = codec.Schema()
 
     def __init__(self, cmd : str):
         self.cmd = cmd
 
     def to_xml(self) -> ElementTree.Element:
-        res = ElementTree.Element("Message")
-        res.append(make_text_node("Request", self.cmd))
+        res = xml_backend.current().element("Message")
+        xml_backend.sub_element(res, "Request", self.cmd)
+        self.schema.append_to(res, self)
         return res
 
     def to_str(self) -> str:
-        return ElementTree.tostring(self.to_xml(), encoding = "unicode")
-
-    def transact(self, client : Client, connection_id : int) -> GenericResponse:
-        xml_resp = ElementTree.fromstring(client.execute_command(connection_id, self.to_str()))
+        if type(self).to_xml is not GenericRequest.to_xml:
+            # Subclasses that still build their own tree.
+            return xml_backend.current().tostring(self.to_xml())
+        return request_template(self.cmd, self.schema).render(self)
+
+    # UTF-8 encoded to_str(), written straight into one buffer. Binary fields skip the intermediate str. For hashing
+    # and storing requests : devices only take text frames, so the broker sends to_str().
+    def to_bytes(self) -> bytearray:
+        if type(self).to_xml is not GenericRequest.to_xml:
+            return bytearray(self.to_str().encode("utf-8"))
+        return request_template(self.cmd, self.schema).write(self)
+
+    def transact(self, client : Client, connection_id : int, cached : bool = False) -> GenericResponse:
+        return self.parse_response(client.execute_command(connection_id, self.to_str(), cached))
+
+    def parse_response(self, response : str) -> GenericResponse:
         result = self.response_type()
-        result.parse(xml_resp)
+        if isinstance(result, GenericResponse):
+            result.parse_message(response)
+        else:
+            result.parse(xml_backend.current().parse(response))
         return result
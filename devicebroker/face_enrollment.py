@@ -0,0 +1,218 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import io
+import logging
+import multiprocessing as mp
+import os
+from typing import AsyncGenerator, Deque, Dict, List, Optional, Tuple
+
+from .device_cmd.m50 import user_data
+from .streams import ExecuteRequest, StreamProgress
+from .template_cache import FACE_SLOT, TemplateCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIDE        : int = 640
+DEFAULT_QUALITY         : int = 85
+DEFAULT_CACHE_SIZE      : int = 256 * 1024 * 1024
+DEFAULT_MAX_PARALLEL    : int = 16
+DEFAULT_LOOKAHEAD       : int = 4
+
+# A photo is either its bytes, or the path of a file on the broker host, which keeps multi-MB images off the
+# application connection.
+Photo = bytes | str
+
+@dataclass
+class FaceEnrollResult:
+    device_id   : str
+    user_id     : int
+    result_code : user_data.BeginRemoteEnrollResult
+    reason      : Optional[str] = None
+
+    def has_succeeded(self) -> bool:
+        return self.result_code == user_data.BeginRemoteEnrollResult.Success
+
+# EXIF orientation tag; 1 is upright.
+_ORIENTATION : int = 0x0112
+
+# Runs in a pool process. The photo is turned upright, flattened to RGB and shrunk to max_side, the most a device
+# makes use of, as a JPEG. An upright RGB JPEG already within max_side goes out as it is, and so does every photo
+# without Pillow.
+def prepare_photo(photo : Photo, max_side : int, quality : int) -> bytes:
+    if isinstance(photo, str):
+        with open(photo, "rb") as f:
+            photo = f.read()
+    if Image is None:
+        return photo
+
+    with Image.open(io.BytesIO(photo)) as image:
+        if (image.format == "JPEG" and image.mode == "RGB" and max(image.size) <= max_side
+                and image.getexif().get(_ORIENTATION, 1) == 1):
+            return photo
+
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality = quality, optimize = True)
+
+    return output.getvalue()
+
+# Shrunk photos, prepared once in a process pool and kept by source, so a photo pushed to many devices is only
+# decoded once. The least recently used are dropped past max_cache_size bytes.
+class PhotoPreparer:
+    max_side        : int
+    quality         : int
+    max_workers     : Optional[int]
+    max_cache_size  : int
+    executor        : Optional[ProcessPoolExecutor]
+    cache           : OrderedDict[str, bytes]
+    cache_size      : int
+    inflight        : Dict[str, asyncio.Future]
+
+    def __init__(self, max_side : int = DEFAULT_MAX_SIDE, quality : int = DEFAULT_QUALITY, max_workers : Optional[int] = None, max_cache_size : int = DEFAULT_CACHE_SIZE):
+        super().__init__()
+
+        self.max_side       = max_side
+        self.quality        = quality
+        self.max_workers    = max_workers
+        self.max_cache_size = max_cache_size
+        self.executor       = None
+        self.cache          = OrderedDict()
+        self.cache_size     = 0
+        self.inflight       = dict()
+
+        if Image is None:
+            LOG.warning("Pillow is not installed : face photos are enrolled without being shrunk")
+
+    # Created on first use : most brokers never enroll faces.
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # Not forked : the balancer has threads running.
+            start_methods = mp.get_all_start_methods()
+            self.executor = ProcessPoolExecutor(self.max_workers, mp.get_context("forkserver" if "forkserver" in start_methods else "spawn"))
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait = False, cancel_futures = True)
+            self.executor = None
+
+    @staticmethod
+    def key_of(photo : Photo) -> str:
+        if isinstance(photo, str):
+            try:
+                stat = os.stat(photo)
+            except OSError:
+                # Fails again when prepared, for that user alone.
+                return os.path.abspath(photo)
+            return f"{os.path.abspath(photo)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha256(photo).hexdigest()
+
+    async def prepare(self, key : str, photo : Photo) -> bytes:
+        prepared = self.cache.get(key, None)
+        if prepared is not None:
+            self.cache.move_to_end(key)
+            return prepared
+
+        pending = self.inflight.get(key, None)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().run_in_executor(self.get_executor(), prepare_photo, photo, self.max_side, self.quality)
+        self.inflight[key] = future
+        try:
+            prepared = await asyncio.shield(future)
+        finally:
+            self.inflight.pop(key, None)
+
+        self.cache[key] = prepared
+        self.cache_size += len(prepared)
+        while self.cache_size > self.max_cache_size and len(self.cache) > 1:
+            _, dropped = self.cache.popitem(last = False)
+            self.cache_size -= len(dropped)
+        return prepared
+
+# EnrollFaceByPhoto for many users on many devices. Every device works through the list on its own, one photo at a
+# time since it has to receive each one in full, while the photos a few users ahead are already being prepared.
+class FaceEnrollment:
+    execute     : ExecuteRequest
+    preparer    : PhotoPreparer
+    templates   : Optional[TemplateCache]
+
+    def __init__(self, execute : ExecuteRequest, preparer : Optional[PhotoPreparer] = None, templates : Optional[TemplateCache] = None):
+        super().__init__()
+
+        self.execute    = execute
+        self.preparer   = preparer or PhotoPreparer()
+        self.templates  = templates
+
+    async def enroll(
+        self,
+        device_ids      : List[str],
+        photos          : List[Tuple[int, Photo]],
+        max_parallel    : int = DEFAULT_MAX_PARALLEL,
+        lookahead       : int = DEFAULT_LOOKAHEAD,
+        progress        : Optional[StreamProgress] = None
+    ) -> AsyncGenerator[FaceEnrollResult, None]:
+        if progress is not None:
+            progress.total = len(device_ids) * len(photos)
+
+        looper = asyncio.get_running_loop()
+        keys = await looper.run_in_executor(None, lambda: [self.preparer.key_of(photo) for _, photo in photos])
+
+        results : asyncio.Queue = asyncio.Queue()
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def enroll_device(device_id : str):
+            async with semaphore:
+                prepared : Deque[asyncio.Task] = deque()
+                try:
+                    for index, (user_id, photo) in enumerate(photos):
+                        while len(prepared) <= lookahead and index + len(prepared) < len(photos):
+                            ahead = index + len(prepared)
+                            prepared.append(asyncio.create_task(self.preparer.prepare(keys[ahead], photos[ahead][1])))
+                        await results.put(await self.enroll_user(device_id, user_id, prepared.popleft()))
+                finally:
+                    for task in prepared:
+                        task.cancel()
+
+        tasks = [asyncio.create_task(enroll_device(device_id)) for device_id in device_ids]
+        remaining = len(device_ids) * len(photos)
+        try:
+            while remaining > 0:
+                yield await results.get()
+                remaining -= 1
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.templates is not None:
+                await looper.run_in_executor(None, self.templates.flush)
+
+    async def enroll_user(self, device_id : str, user_id : int, prepared : asyncio.Task) -> FaceEnrollResult:
+        try:
+            response = await self.execute(device_id, user_data.EnrollFaceByPhotoRequest(user_id, await prepared))
+        except Exception as ex:
+            return FaceEnrollResult(device_id, user_id, user_data.BeginRemoteEnrollResult.Unknown, str(ex))
+
+        # Whatever face template the device held for the user is gone either way.
+        if self.templates is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.templates.forget, device_id, user_id, FACE_SLOT)
+
+        if response.has_succeeded():
+            return FaceEnrollResult(device_id, user_id, user_data.BeginRemoteEnrollResult.Success)
+
+        # Devices give the same reasons as they do for remote enrollment.
+        reason = response.fail_reason or response.result
+        result_code = user_data.BeginRemoteEnrollResult.__members__.get(reason or "", user_data.BeginRemoteEnrollResult.Unknown)
+        return FaceEnrollResult(device_id, user_id, result_code, reason)
@@ -0,0 +1,244 @@
+import asyncio
+from dataclasses import dataclass, field
+import logging
+import math
+import time
+from typing import Dict, List, Optional
+
+from .device_cmd.m50 import maintenance
+from .streams import ExecuteRequest
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CANARY              : int = 5
+DEFAULT_WAVE_GROWTH         : float = 4
+DEFAULT_MAX_PARALLEL        : int = 50
+DEFAULT_MAX_FAILURE_RATE    : float = 0.1
+DEFAULT_REBOOT_TIMEOUT      : float = 900
+DEFAULT_WAVE_PAUSE          : float = 60
+DEFAULT_KEEP_FINISHED       : float = 24 * 3600     # How long a finished rollout can still be read
+
+# States of one device in a rollout.
+PENDING     = "pending"
+UPGRADING   = "upgrading"
+SUCCEEDED   = "succeeded"
+FAILED      = "failed"
+SKIPPED     = "skipped"     # Offline, or already at the target version
+
+@dataclass
+class DeviceUpgrade:
+    device_id       : str
+    wave            : int
+    state           : str = PENDING
+    old_version     : Optional[str] = None
+    new_version     : Optional[str] = None
+    error           : Optional[str] = None
+
+# Snapshot-friendly : applications receive a pickled copy.
+@dataclass
+class Rollout:
+    rollout_id      : int
+    url             : str
+    target_version  : str
+    waves           : List[List[str]]
+    devices         : Dict[str, DeviceUpgrade]
+    state           : str = "running"     # "running", "completed", "halted" or "aborted"
+    current_wave    : int = 0
+    error           : Optional[str] = None
+    started         : float = field(default_factory = time.time)
+    finished        : Optional[float] = None
+
+# Canary first, then waves growing by growth, so a bad image stops at a handful of devices.
+def plan_waves(device_ids : List[str], canary : int = DEFAULT_CANARY, growth : float = DEFAULT_WAVE_GROWTH) -> List[List[str]]:
+    waves : List[List[str]] = []
+    pos = 0
+    size = max(canary, 1)
+    while pos < len(device_ids):
+        waves.append(device_ids[pos : pos + size])
+        pos += size
+        size = max(size + 1, math.ceil(size * growth))
+    return waves
+
+def version_matches(response : maintenance.GetFirmwareVersionResponse, target_version : str) -> bool:
+    return target_version in (response.version, response.build_number)
+
+# Pushes one firmware image to many devices, a wave at a time. A device counts as upgraded once it has rebooted,
+# reconnected and reports the target version; a wave whose failure rate is over the limit halts the rollout.
+class FirmwareRollouts:
+    execute             : ExecuteRequest
+    base_url            : Optional[str]
+    next_rollout_id     : int
+    rollouts            : Dict[int, Rollout]
+    tasks               : Dict[int, asyncio.Task]
+    busy                : Dict[str, int]            # Device ID -> ID of the running rollout it belongs to
+    reconnects          : Dict[str, asyncio.Event]
+    keep_finished       : float
+
+    def __init__(self, execute : ExecuteRequest, base_url : Optional[str] = None, keep_finished : float = DEFAULT_KEEP_FINISHED):
+        super().__init__()
+
+        self.execute            = execute
+        self.base_url           = base_url
+        self.next_rollout_id    = 0
+        self.rollouts           = dict()
+        self.tasks              = dict()
+        self.busy               = dict()
+        self.reconnects         = dict()
+        self.keep_finished      = keep_finished
+
+    # Image names are served by the broker's own firmware server; full URLs are passed as they are.
+    def url_for(self, image : str) -> str:
+        if "://" in image:
+            return image
+        if self.base_url is None:
+            raise ValueError("No firmware server is configured : pass a full URL")
+        return f"{self.base_url.rstrip('/')}/{image.lstrip('/')}"
+
+    # Called by the load balancer whenever a device ID is assigned to a connection.
+    def device_connected(self, device_id : str):
+        event = self.reconnects.get(device_id, None)
+        if event is not None:
+            event.set()
+
+    def start(
+        self,
+        image               : str,
+        target_version      : str,
+        device_ids          : List[str],
+        canary              : int = DEFAULT_CANARY,
+        growth              : float = DEFAULT_WAVE_GROWTH,
+        max_parallel        : int = DEFAULT_MAX_PARALLEL,
+        max_failure_rate    : float = DEFAULT_MAX_FAILURE_RATE,
+        reboot_timeout      : float = DEFAULT_REBOOT_TIMEOUT,
+        wave_pause          : float = DEFAULT_WAVE_PAUSE
+    ) -> int:
+        self.prune()
+
+        # Every device of a running rollout is taken, not only those rebooting right now.
+        device_ids = list(dict.fromkeys(device_ids))
+        busy = [device_id for device_id in device_ids if device_id in self.busy]
+        if busy:
+            raise ValueError(f"Devices already in a running rollout : {', '.join(busy[:10])}")
+
+        waves = plan_waves(device_ids, canary, growth)
+        rollout = Rollout(
+            rollout_id      = self.next_rollout_id,
+            url             = self.url_for(image),
+            target_version  = target_version,
+            waves           = waves,
+            devices         = {device_id : DeviceUpgrade(device_id, wave_no) for wave_no, wave in enumerate(waves) for device_id in wave})
+        self.next_rollout_id += 1
+        self.rollouts[rollout.rollout_id] = rollout
+        self.busy.update((device_id, rollout.rollout_id) for device_id in rollout.devices)
+
+        task = asyncio.create_task(self.run(rollout, max_parallel, max_failure_rate, reboot_timeout, wave_pause))
+        self.tasks[rollout.rollout_id] = task
+        task.add_done_callback(lambda _: self.release(rollout))
+        return rollout.rollout_id
+
+    # Run when the rollout's task is done, however it ended : its devices can go into another rollout.
+    def release(self, rollout : Rollout):
+        self.tasks.pop(rollout.rollout_id, None)
+        for device_id in rollout.devices:
+            if self.busy.get(device_id, None) == rollout.rollout_id:
+                del self.busy[device_id]
+
+        # Aborted before run() got to start.
+        if rollout.finished is None:
+            rollout.state = "aborted"
+            rollout.finished = time.time()
+
+    # Finished rollouts are dropped once keep_finished has passed.
+    def prune(self):
+        deadline = time.time() - self.keep_finished
+        for rollout_id in [rollout.rollout_id for rollout in self.rollouts.values() if rollout.finished is not None and rollout.finished < deadline]:
+            del self.rollouts[rollout_id]
+
+    def get(self, rollout_id : int) -> Optional[Rollout]:
+        self.prune()
+        return self.rollouts.get(rollout_id, None)
+
+    # Devices already told to upgrade carry on; nothing else is sent.
+    def abort(self, rollout_id : int) -> bool:
+        task = self.tasks.get(rollout_id, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def run(self, rollout : Rollout, max_parallel : int, max_failure_rate : float, reboot_timeout : float, wave_pause : float):
+        semaphore = asyncio.Semaphore(max_parallel)
+        try:
+            for wave_no, wave in enumerate(rollout.waves):
+                rollout.current_wave = wave_no
+                LOG.info(f"Firmware rollout {rollout.rollout_id} : wave {wave_no + 1} of {len(rollout.waves)}, {len(wave)} devices")
+
+                await asyncio.gather(*[self.upgrade(rollout, rollout.devices[device_id], semaphore, reboot_timeout) for device_id in wave])
+
+                attempted = [rollout.devices[device_id] for device_id in wave if rollout.devices[device_id].state != SKIPPED]
+                failed = sum(1 for upgrade in attempted if upgrade.state == FAILED)
+                if attempted and failed / len(attempted) > max_failure_rate:
+                    rollout.state = "halted"
+                    rollout.error = f"{failed} of {len(attempted)} devices failed in wave {wave_no + 1}"
+                    LOG.warning(f"Firmware rollout {rollout.rollout_id} halted : {rollout.error}")
+                    return
+
+                if wave_no + 1 < len(rollout.waves):
+                    await asyncio.sleep(wave_pause)
+
+            rollout.state = "completed"
+
+        except asyncio.CancelledError:
+            rollout.state = "aborted"
+            raise
+
+        finally:
+            rollout.finished = time.time()
+
+    async def upgrade(self, rollout : Rollout, upgrade : DeviceUpgrade, semaphore : asyncio.Semaphore, reboot_timeout : float):
+        async with semaphore:
+            try:
+                try:
+                    before = await self.execute(upgrade.device_id, maintenance.GetFirmwareVersionRequest())
+                except Exception as ex:
+                    upgrade.state = SKIPPED
+                    upgrade.error = str(ex)
+                    return
+
+                upgrade.old_version = before.version
+                if version_matches(before, rollout.target_version):
+                    upgrade.state = SKIPPED
+                    upgrade.new_version = before.version
+                    return
+
+                upgrade.state = UPGRADING
+                reconnected = asyncio.Event()
+                self.reconnects[upgrade.device_id] = reconnected
+                try:
+                    try:
+                        response = await self.execute(upgrade.device_id, maintenance.WriteFirmwareRequest(rollout.url))
+                    except Exception as ex:
+                        # Some firmware reboots before answering : only a device that never comes back has failed.
+                        LOG.info(f"No answer to the upgrade of device {upgrade.device_id} : {ex}")
+                        response = None
+                    if response is not None and not response.has_succeeded():
+                        raise Exception(f"Upgrade refused : {response.fail_reason or response.result}")
+
+                    # The device downloads, flashes and reboots; its version means nothing until it is back.
+                    try:
+                        await asyncio.wait_for(reconnected.wait(), timeout = reboot_timeout)
+                    except TimeoutError:
+                        raise Exception("Device did not reconnect")
+                finally:
+                    self.reconnects.pop(upgrade.device_id, None)
+
+                after = await self.execute(upgrade.device_id, maintenance.GetFirmwareVersionRequest())
+                upgrade.new_version = after.version
+                if not version_matches(after, rollout.target_version):
+                    raise Exception(f"Still at version {after.version}")
+                upgrade.state = SUCCEEDED
+
+            except Exception as ex:
+                upgrade.state = FAILED
+                upgrade.error = str(ex)
+                LOG.warning(f"Firmware upgrade of device {upgrade.device_id} failed : {ex}")
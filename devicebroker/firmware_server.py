@@ -0,0 +1,214 @@
+import asyncio
+from dataclasses import dataclass
+import email.utils
+import logging
+import os
+import re
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+LOG = logging.getLogger(__name__)
+
+MAX_HEADER_LINES    : int = 64
+IDLE_TIMEOUT        : float = 30
+
+_RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+_REASONS : Dict[int, str] = {
+    200 : "OK",
+    206 : "Partial Content",
+    400 : "Bad Request",
+    404 : "Not Found",
+    405 : "Method Not Allowed",
+    416 : "Range Not Satisfiable",
+}
+
+class HttpError(Exception):
+    status  : int
+
+    def __init__(self, status : int):
+        super().__init__(_REASONS.get(status, str(status)))
+        self.status = status
+
+# One byte range out of size, or None for the whole file. Only single ranges : a device resuming a download never
+# asks for more, and a multi-range request may always be answered with the whole file.
+def parse_range(header : Optional[str], size : int) -> Optional[Tuple[int, int]]:
+    if header is None:
+        return None
+
+    match = _RANGE_PATTERN.fullmatch(header.strip())
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    elif last:
+        # Suffix range : the last N bytes.
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        return None
+
+    if start >= size:
+        raise HttpError(416)
+    return start, end
+
+# The request line and headers of one HTTP/1.x request, as read by read_request_head.
+@dataclass(frozen = True)
+class RequestHead:
+    method      : str
+    target      : str
+    headers     : Dict[str, str]
+    keep_alive  : bool
+
+    # Bytes of body that follow, HttpError(400) unless Content-Length is a plain non-negative number.
+    def content_length(self) -> int:
+        value = self.headers.get("content-length", "0")
+        if not (value.isascii() and value.isdigit()):
+            raise HttpError(400)
+        return int(value)
+
+# Reads up to the blank line ending the headers; the body, if any, is left to the caller. None once the peer closes
+# between requests, HttpError(400) for a request that cannot be parsed.
+async def read_request_head(reader : asyncio.StreamReader) -> Optional[RequestHead]:
+    request_line = await asyncio.wait_for(reader.readline(), timeout = IDLE_TIMEOUT)
+    if not request_line:
+        return None
+
+    headers : Dict[str, str] = dict()
+    for _ in range(0, MAX_HEADER_LINES):
+        line = await asyncio.wait_for(reader.readline(), timeout = IDLE_TIMEOUT)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise HttpError(400)
+
+    try:
+        method, target, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400)
+
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    return RequestHead(method, target, headers, keep_alive)
+
+# Serves firmware images from one directory, so devices download them from the broker host instead of whatever
+# server the URL would otherwise point at. File bodies go out with sendfile straight from the page cache; the event
+# loop only ever handles the headers.
+class FirmwareServer:
+    root_dir    : str
+    host        : str
+    port        : int
+    server      : Optional[asyncio.AbstractServer]
+    bytes_sent  : int
+    active      : int
+
+    def __init__(self, root_dir : str, host : str, port : int):
+        super().__init__()
+
+        self.root_dir   = os.path.realpath(root_dir)
+        self.host       = host
+        self.port       = port
+        self.server     = None
+        self.bytes_sent = 0
+        self.active     = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve_connection, self.host, self.port)
+        LOG.info(f"Serving firmware from {self.root_dir} on {self.host}:{self.port}")
+
+    async def run(self, cancellation : asyncio.Future):
+        await self.start()
+        async with self.server:
+            await cancellation
+
+    def path_for(self, target : str) -> str:
+        name = unquote(urlsplit(target).path).lstrip("/")
+        path = os.path.realpath(os.path.join(self.root_dir, name))
+        # Nothing outside the firmware directory, however the path is spelled.
+        if not path.startswith(self.root_dir + os.sep) or not os.path.isfile(path):
+            raise HttpError(404)
+        return path
+
+    async def serve_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        self.active += 1
+        try:
+            while await self.serve_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, TimeoutError):
+            pass
+        except Exception as ex:
+            LOG.warning(f"Exception while serving firmware to {writer.get_extra_info('peername')} : {ex}")
+        finally:
+            self.active -= 1
+            writer.close()
+
+    # Returns whether the connection stays open for another request.
+    async def serve_request(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> bool:
+        try:
+            head = await read_request_head(reader)
+        except HttpError as ex:
+            await self.send_error(writer, ex.status)
+            return False
+        if head is None:
+            return False
+
+        method, target, headers, keep_alive = head.method, head.target, head.headers, head.keep_alive
+
+        try:
+            if method not in ("GET", "HEAD"):
+                # Its body is never read : left on the connection, it would be taken for the next request.
+                keep_alive = False
+                raise HttpError(405)
+
+            path = self.path_for(target)
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                size = stat.st_size
+
+                try:
+                    byte_range = parse_range(headers.get("range", None), size)
+                except HttpError as ex:
+                    await self.send_error(writer, ex.status, keep_alive, {"Content-Range" : f"bytes */{size}"})
+                    return keep_alive
+
+                start, end = byte_range if byte_range is not None else (0, size - 1)
+                count = end - start + 1
+
+                extra = {
+                    "Content-Type"  : "application/octet-stream",
+                    "Accept-Ranges" : "bytes",
+                    "ETag"          : f"\"{stat.st_size:x}-{int(stat.st_mtime):x}\"",
+                    "Last-Modified" : email.utils.formatdate(stat.st_mtime, usegmt = True),
+                }
+                if byte_range is not None:
+                    extra["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+                await self.send_head(writer, 206 if byte_range is not None else 200, count, keep_alive, extra)
+                if method == "GET" and count > 0:
+                    await asyncio.get_running_loop().sendfile(writer.transport, f, start, count)
+                    self.bytes_sent += count
+
+        except HttpError as ex:
+            await self.send_error(writer, ex.status, keep_alive)
+
+        return keep_alive
+
+    async def send_head(self, writer : asyncio.StreamWriter, status : int, length : int, keep_alive : bool, extra : Optional[Dict[str, str]] = None):
+        lines = [
+            f"HTTP/1.1 {status} {_REASONS[status]}",
+            f"Content-Length: {length}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        for name, value in (extra or {}).items():
+            lines.append(f"{name}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def send_error(self, writer : asyncio.StreamWriter, status : int, keep_alive : bool = False, extra : Optional[Dict[str, str]] = None):
+        await self.send_head(writer, status, 0, keep_alive, extra)
@@ -0,0 +1,227 @@
+import asyncio
+from dataclasses import dataclass, field, replace
+import logging
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
+
+from .device_cmd import messages
+from .device_cmd.m50 import access_control, attendance_setting, device_limits, misc
+from .streams import ExecuteRequest, StreamProgress
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_PARALLEL : int = 32
+
+# Desired settings. Anything left out is not looked at : a config only owns what it names.
+@dataclass
+class DeviceConfig:
+    access_timezones        : Dict[int, List[access_control.AccessTimeSection]] = field(default_factory = dict)
+    bell_ring_times         : Optional[int] = None
+    bells                   : Optional[List[attendance_setting.Bell]] = None
+    auto_attendance         : Optional[List[attendance_setting.AutoAttendance]] = None
+    departments             : Dict[int, str] = field(default_factory = dict)
+    proxy_departments       : Dict[int, str] = field(default_factory = dict)
+    center_screen_message   : Optional[misc.CenterScreenMessageSetting] = None
+
+    # Settings of other on top of these.
+    def merged(self, other : 'DeviceConfig') -> 'DeviceConfig':
+        return DeviceConfig(
+            access_timezones        = {**self.access_timezones, **other.access_timezones},
+            bell_ring_times         = other.bell_ring_times if other.bell_ring_times is not None else self.bell_ring_times,
+            bells                   = other.bells if other.bells is not None else self.bells,
+            auto_attendance         = other.auto_attendance if other.auto_attendance is not None else self.auto_attendance,
+            departments             = {**self.departments, **other.departments},
+            proxy_departments       = {**self.proxy_departments, **other.proxy_departments},
+            center_screen_message   = other.center_screen_message if other.center_screen_message is not None else self.center_screen_message)
+
+@dataclass
+class ConfigGroup:
+    name        : str
+    device_ids  : List[str]
+    config      : DeviceConfig
+
+@dataclass
+class ConfigChange:
+    key         : str
+    current     : Any
+    desired     : Any
+    action      : str                   # "unchanged", "set", "would set" or "failed"
+    error       : Optional[str] = None
+
+@dataclass
+class DeviceConfigResult:
+    device_id   : str
+    changes     : List[ConfigChange]
+    succeeded   : bool
+    error       : Optional[str] = None
+
+# One setting : how to read it, how to compare it and how to write it.
+@dataclass
+class _ConfigItem:
+    key         : str
+    read        : messages.GenericRequest
+    current     : Callable[[Any], Any]
+    desired     : Any
+    write       : Callable[[Any], messages.GenericRequest]     # Given the read response
+
+def _padded(items : List[Any], count : int, factory : Callable[[], Any]) -> List[Any]:
+    return list(items[: count]) + [factory() for _ in range(len(items), count)]
+
+def _read_ring_times(response : Any) -> int:
+    has_succeeded = getattr(response, "has_succeeded", None)
+    if has_succeeded is not None and not has_succeeded():
+        raise Exception("Bell ring times unknown : the read failed")
+    return response.ring_times
+
+def _valid_bells(ring_times : Optional[int], bells : List[attendance_setting.Bell]) -> tuple:
+    return ring_times, [bell for bell in bells if bell.valid]
+
+def config_items(config : DeviceConfig) -> List[_ConfigItem]:
+    items : List[_ConfigItem] = []
+
+    for timezone_no, sections in sorted(config.access_timezones.items()):
+        desired = _padded(sections, device_limits.TIMESECTION_COUNT_PER_TIMEZONE, access_control.AccessTimeSection)
+        items.append(_ConfigItem(
+            f"access_timezone {timezone_no}",
+            access_control.GetAccessTimezoneRequest(timezone_no),
+            lambda response: response.time_sections,
+            desired,
+            lambda response, timezone_no = timezone_no, desired = desired: access_control.SetAccessTimezoneRequest(timezone_no, desired)))
+
+    if config.bells is not None:
+        # Unused bell slots come back as invalid entries; only the valid ones count.
+        desired = _valid_bells(config.bell_ring_times, config.bells)
+        items.append(_ConfigItem(
+            "bells",
+            attendance_setting.GetBellSettingsRequest(),
+            lambda response: _valid_bells(response.ring_times if config.bell_ring_times is not None else None, response.bells),
+            desired,
+            # Ring times the config leaves out stay as the device has them.
+            lambda response: attendance_setting.SetBellSettingsRequest(
+                config.bell_ring_times if config.bell_ring_times is not None else _read_ring_times(response), config.bells)))
+
+    if config.auto_attendance is not None:
+        desired = _padded(config.auto_attendance, device_limits.NUM_TR_TIMESECTIONS, attendance_setting.AutoAttendance)
+        items.append(_ConfigItem(
+            "auto_attendance",
+            attendance_setting.GetAutoAttendanceSettingsRequest(),
+            lambda response: response.time_sections,
+            desired,
+            lambda response: attendance_setting.SetAutoAttendanceSettingsRequest(desired)))
+
+    for depart_no, name in sorted(config.departments.items()):
+        items.append(_ConfigItem(
+            f"department {depart_no}",
+            attendance_setting.GetDepartmentRequest(depart_no),
+            lambda response: response.name,
+            name,
+            lambda response, depart_no = depart_no, name = name: attendance_setting.SetDepartmentRequest(depart_no, name)))
+
+    for depart_no, name in sorted(config.proxy_departments.items()):
+        items.append(_ConfigItem(
+            f"proxy_department {depart_no}",
+            attendance_setting.GetProxyDepartmentRequest(depart_no),
+            lambda response: response.name,
+            name,
+            lambda response, depart_no = depart_no, name = name: attendance_setting.SetProxyDepartmentRequest(depart_no, name)))
+
+    if config.center_screen_message is not None:
+        # Read back the way the device stores it.
+        desired = replace(config.center_screen_message, message = config.center_screen_message.message[: misc.CENTER_SCREEN_MSG_LEN])
+        items.append(_ConfigItem(
+            "center_screen_message",
+            misc.GetCenterScreenMessageSettingRequest(),
+            lambda response: response.setting,
+            desired,
+            lambda response: misc.SetCenterScreenMessageSettingRequest(desired)))
+
+    return items
+
+# Config as data : each device group declares the settings it wants, every device is read (through the settings
+# cache unless fresh) and only the Set requests whose setting differs are sent. With dry_run nothing is sent and the
+# results say what would be.
+class FleetConfig:
+    execute : ExecuteRequest
+
+    def __init__(self, execute : ExecuteRequest):
+        super().__init__()
+
+        self.execute = execute
+
+    # Later groups win where a device is in several.
+    @staticmethod
+    def configs_by_device(groups : List[ConfigGroup]) -> Dict[str, DeviceConfig]:
+        configs : Dict[str, DeviceConfig] = dict()
+        for group in groups:
+            for device_id in group.device_ids:
+                base = configs.get(device_id, None)
+                configs[device_id] = group.config if base is None else base.merged(group.config)
+        return configs
+
+    async def push(
+        self,
+        groups          : List[ConfigGroup],
+        dry_run         : bool = False,
+        fresh           : bool = False,
+        max_parallel    : int = DEFAULT_MAX_PARALLEL,
+        progress        : Optional[StreamProgress] = None
+    ) -> AsyncGenerator[DeviceConfigResult, None]:
+        configs = self.configs_by_device(groups)
+        if progress is not None:
+            progress.total = len(configs)
+
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def push_device(device_id : str, config : DeviceConfig) -> DeviceConfigResult:
+            async with semaphore:
+                return await self.push_device(device_id, config, dry_run, fresh)
+
+        tasks = [asyncio.create_task(push_device(device_id, config)) for device_id, config in configs.items()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def push_device(self, device_id : str, config : DeviceConfig, dry_run : bool = False, fresh : bool = False) -> DeviceConfigResult:
+        items = config_items(config)
+        result = DeviceConfigResult(device_id, [], False)
+
+        # All reads queued at once : the device answers in order.
+        try:
+            responses = await asyncio.gather(*[self.execute(device_id, item.read, not fresh) for item in items])
+        except Exception as ex:
+            result.error = str(ex)
+            return result
+
+        writes : List[asyncio.Future] = []
+        for item, response in zip(items, responses):
+            has_succeeded = getattr(response, "has_succeeded", None)
+            if has_succeeded is not None and not has_succeeded():
+                # Unknown is as good as different.
+                change = ConfigChange(item.key, None, item.desired, "set", f"Read failed : {response.fail_reason or response.result}")
+            else:
+                current = item.current(response)
+                if current == item.desired:
+                    result.changes.append(ConfigChange(item.key, current, item.desired, "unchanged"))
+                    continue
+                change = ConfigChange(item.key, current, item.desired, "set")
+
+            result.changes.append(change)
+            if dry_run:
+                change.action = "would set"
+            else:
+                writes.append(self.write(device_id, item, change, response))
+
+        await asyncio.gather(*writes)
+        result.succeeded = all(change.action != "failed" for change in result.changes)
+        return result
+
+    async def write(self, device_id : str, item : _ConfigItem, change : ConfigChange, current : Any):
+        try:
+            response = await self.execute(device_id, item.write(current))
+            if not response.has_succeeded():
+                raise Exception(response.fail_reason or response.result)
+        except Exception as ex:
+            change.action = "failed"
+            change.error = str(ex)
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 import logging
 from multiprocessing.connection import Connection
-from typing import Collection, Dict, List, Optional, Set, Tuple
+from typing import Any, AsyncGenerator, Collection, Dict, List, Optional, Set, Tuple
 from websockets.asyncio.server import ServerConnection
 import asyncio
 import multiprocessing as mp
@@ -9,6 +9,24 @@ from concurrent.futures import ThreadPoolExecutor
 
 from . import worker
 from . import commands
+from .blob_store import BlobStore
+from .device_cmd import messages
+from .device_cmd.m50 import log
+from .clock_sync import DEFAULT_INTERVAL as DEFAULT_CLOCK_SYNC_INTERVAL, DEFAULT_THRESHOLD as DEFAULT_CLOCK_THRESHOLD, ClockSync
+from .face_enrollment import FaceEnrollment, PhotoPreparer
+from .firmware_rollout import FirmwareRollouts
+from .fleet_config import FleetConfig
+from .log_export import DEFAULT_MAX_PARALLEL, CursorStore, LogExporter
+from .log_store import LogStore
+from .message_scanner import request_name
+from .status_poller import DEFAULT_INTERVAL as DEFAULT_STATUS_INTERVAL, DEFAULT_MAX_INTERVAL as DEFAULT_STATUS_MAX_INTERVAL, DEFAULT_MIN_INTERVAL as DEFAULT_STATUS_MIN_INTERVAL, StatusPoller
+from .status_store import StatusStore
+from .streams import DeviceStream, StreamProgress
+from .settings_cache import SettingsCache
+from .template_cache import TemplateCache
+from .user_export import UserExporter
+from .user_sync import SyncStateStore, UserSync
+from .thread_pipe import ThreadConnection
 
 LOG = logging.getLogger(__name__)
 
@@ -63,49 +81,238 @@ class PendingCommandList:
         node.list_obj   = None
 
 
+@dataclass
+class WorkerLink:
+    worker_id           : int
+    connection          : Connection
+    lock                : asyncio.Lock
+    stopped             : asyncio.Event
+    client_count        : int   = 0
+    sent_count          : int   = 0
+    processed_count     : int   = 0
+    webapp_latency      : float = 0.0
+    retiring            : bool  = False
+
+    @property
+    def backlog(self) -> int:
+        return self.sent_count - self.processed_count
+
 @dataclass
 class OnlineDevice:
     client_id           : int
-    worker_index        : int
+    worker              : WorkerLink
     connection          : ServerConnection
     send_lock           : asyncio.Lock
     device_id           : Optional[str]
     attribs             : dict
     closed              : bool
     pending_commands    : PendingCommandList
+    last_sent           : int   = 0         # The worker's sent_count at this client's last message
+
+DRAIN_POLL_INTERVAL : float = 0.5
+CATCH_UP_TIMEOUT    : float = 30        # After the drain timeout, how long a forced move waits for the worker to catch up
+STOP_TIMEOUT        : float = 30
+COMMAND_TIMEOUT     : float = 30
 
 class LoadBalancer:
-    worker_index        : int
     next_client_id      : int
     lock                : asyncio.Lock
-    worker_connections  : List[Tuple[Connection, asyncio.Lock]]
-    worker_processes    : List[mp.Process]
+    workers             : Dict[int, WorkerLink]
 
     clients_map         : Dict[int, OnlineDevice]
     devices_map         : Dict[str, OnlineDevice]
 
     misc_tasks          : Set[asyncio.Task]
-
-    def __init__(self, pipes : Collection[Connection]):
+    blob_store          : Optional[BlobStore]
+
+    next_stream_id      : int
+    streams             : Dict[int, DeviceStream]
+    log_exporter        : LogExporter
+    user_exporter       : UserExporter
+    user_sync           : UserSync
+    settings_cache      : SettingsCache
+    firmware_rollouts   : FirmwareRollouts
+    clock_sync          : ClockSync
+    face_enrollment     : FaceEnrollment
+    fleet_config        : FleetConfig
+    status_poller       : StatusPoller
+    log_store           : Optional[LogStore]
+    templates           : Optional[TemplateCache]
+
+    def __init__(
+        self,
+        blob_store              : Optional[BlobStore] = None,
+        cursor_store            : Optional[CursorStore] = None,
+        max_parallel_exports    : int = DEFAULT_MAX_PARALLEL,
+        sync_state_store        : Optional[SyncStateStore] = None,
+        template_cache          : Optional[TemplateCache] = None,
+        settings_cache          : Optional[SettingsCache] = None,
+        firmware_base_url       : Optional[str] = None,
+        clock_sync_interval     : float = DEFAULT_CLOCK_SYNC_INTERVAL,
+        clock_threshold         : float = DEFAULT_CLOCK_THRESHOLD,
+        clock_utc_offset        : float = 0,
+        photo_preparer          : Optional[PhotoPreparer] = None,
+        status_store            : Optional[StatusStore] = None,
+        status_interval         : float = DEFAULT_STATUS_INTERVAL,
+        status_min_interval     : float = DEFAULT_STATUS_MIN_INTERVAL,
+        status_max_interval     : float = DEFAULT_STATUS_MAX_INTERVAL,
+        log_store               : Optional[LogStore] = None
+    ):
         super().__init__()
 
-        self.worker_index       = 0
         self.next_client_id     = 0
         self.lock               = asyncio.Lock()
-        self.worker_connections = [(conn, asyncio.Lock()) for conn in pipes]
+        self.workers            = dict()
 
         self.clients_map        = dict()
         self.devices_map        = dict()
         self.misc_tasks         = set()
+        self.blob_store         = blob_store
+
+        self.next_stream_id     = 0
+        self.streams            = dict()
+        self.log_store          = log_store
+        self.templates          = template_cache
+        self.log_exporter       = LogExporter(self.execute_request, cursor_store or CursorStore(), max_parallel_exports, store = log_store)
+        self.user_exporter      = UserExporter(self.execute_request, template_cache)
+        self.user_sync          = UserSync(self.execute_request, sync_state_store or SyncStateStore(), template_cache)
+        self.settings_cache     = settings_cache or SettingsCache()
+        self.firmware_rollouts  = FirmwareRollouts(self.execute_request, firmware_base_url)
+        self.clock_sync         = ClockSync(
+            self.execute_request, lambda: list(self.devices_map.keys()),
+            clock_sync_interval, clock_threshold, utc_offset = clock_utc_offset)
+        self.face_enrollment    = FaceEnrollment(self.execute_request, photo_preparer, template_cache)
+        self.fleet_config       = FleetConfig(self.execute_request)
+        self.status_poller      = StatusPoller(
+            self.execute_request, lambda: list(self.devices_map.keys()), status_store or StatusStore(),
+            status_interval, status_min_interval, status_max_interval)
+
+    def add_worker(self, worker_id : int, conn : Connection) -> WorkerLink:
+        link = WorkerLink(
+            worker_id   = worker_id,
+            connection  = conn,
+            lock        = asyncio.Lock(),
+            stopped     = asyncio.Event())
+        self.workers[worker_id] = link
+
+        task : asyncio.Task = asyncio.create_task(self.receive_messages_from_worker(link))
+        self.misc_tasks.add(task)
+        task.add_done_callback(self.misc_tasks.discard)
+
+        LOG.info(f"Added worker {worker_id}")
+        return link
+
+    def active_workers(self) -> List[WorkerLink]:
+        return [link for link in self.workers.values() if not link.retiring]
+
+    def select_worker(self) -> WorkerLink:
+        return min(self.active_workers(), key = lambda link: (link.client_count, link.backlog))
+
+    async def write_to_worker(self, link : WorkerLink, message : tuple):
+        if isinstance(link.connection, ThreadConnection):
+            # Handing over to an in-process worker never blocks, so skip the executor round trip.
+            link.connection.send(message)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, link.connection.send, message)
+
+    async def send_to_worker(self, online_device : OnlineDevice, message : tuple):
+        while True:
+            link = online_device.worker
+            async with link.lock:
+                # The device may have been migrated to another worker while waiting for the lock.
+                if online_device.worker is not link:
+                    continue
+
+                await self.write_to_worker(link, message)
+                if message[0] == commands.MESSAGE_FROM_CLIENT:
+                    link.sent_count += 1
+                    online_device.last_sent = link.sent_count
+                return
+
+    async def migrate_client(self, online_device : OnlineDevice, target : WorkerLink, force : bool, abandon : bool = False) -> bool:
+        source = online_device.worker
+
+        async with online_device.send_lock:
+            # Only idle devices are moved unless forced, so responses to in-flight commands keep their order.
+            if not force and online_device.pending_commands.first_node is not None:
+                return False
+
+            async with source.lock:
+                async with target.lock:
+                    if online_device.closed or online_device.worker is not source or self.clients_map.get(online_device.client_id, None) is not online_device:
+                        return False
+
+                    # Even when forced : a Login still queued on the source would be lost, and the target would
+                    # ignore the device until it reconnects. Workers report processed counts after the messages
+                    # they send for them, so a drained client's device ID is already known here. A stopped
+                    # worker processes nothing more, and past the hard deadline the move happens regardless.
+                    caught_up = source.stopped.is_set() or source.processed_count >= online_device.last_sent
+                    if not caught_up and not abandon:
+                        return False
+
+                    online_device.worker    = target
+                    online_device.last_sent = 0
+                    source.client_count -= 1
+                    target.client_count += 1
+
+                    await self.write_to_worker(target, (commands.CLIENT_CONNECTED, online_device.client_id, online_device.device_id is not None))
+
+                # A dead or stuck source has nobody left to tell; its pipe may be full.
+                try:
+                    await asyncio.wait_for(self.write_to_worker(source, (commands.CLIENT_DISCONNECTED, online_device.client_id)), timeout = STOP_TIMEOUT)
+                except Exception as ex:
+                    LOG.warning(f"Failed to tell worker {source.worker_id} that client {online_device.client_id} left : {ex}")
 
-    async def serve_device(self, sock : ServerConnection):
+        if caught_up:
+            LOG.info(f"Migrated client {online_device.client_id} from worker {source.worker_id} to worker {target.worker_id}")
+        else:
+            LOG.warning(f"Forced client {online_device.client_id} from worker {source.worker_id} to worker {target.worker_id} before it caught up; queued messages may be lost")
+        return True
+
+    async def retire_worker(self, worker_id : int, drain_timeout : float):
         looper = asyncio.get_running_loop()
 
+        link = self.workers.get(worker_id, None)
+        if link is None or link.retiring:
+            return
+
+        if len(self.active_workers()) <= 1:
+            raise ValueError("Cannot retire the last active worker.")
+
+        link.retiring = True
+        LOG.info(f"Draining worker {worker_id}")
+
+        deadline        = looper.time() + drain_timeout
+        hard_deadline   = deadline + CATCH_UP_TIMEOUT
+        while (clients := [x for x in self.clients_map.values() if x.worker is link]):
+            now = looper.time()
+            for online_device in clients:
+                await self.migrate_client(online_device, self.select_worker(), now >= deadline, now >= hard_deadline)
+
+            if any(x.worker is link for x in clients):
+                await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+        if not link.stopped.is_set():
+            try:
+                await asyncio.wait_for(self.stop_worker(link), timeout = STOP_TIMEOUT)
+            except Exception as ex:
+                LOG.warning(f"Worker {worker_id} did not stop cleanly : {ex!r}")
+
+        self.workers.pop(worker_id, None)
+        link.connection.close()
+        LOG.info(f"Retired worker {worker_id}")
+
+    async def stop_worker(self, link : WorkerLink):
+        async with link.lock:
+            await self.write_to_worker(link, (commands.STOP_WORKER, ))
+        await link.stopped.wait()
+
+    async def serve_device(self, sock : ServerConnection):
         # Assign a new client ID and select a worker.
         async with self.lock:
             online_device = OnlineDevice(
                 client_id           = self.next_client_id,
-                worker_index        = self.worker_index,
+                worker              = self.select_worker(),
                 connection          = sock,
                 send_lock           = asyncio.Lock(),
                 device_id           = None,
@@ -113,35 +320,35 @@ class LoadBalancer:
                 closed              = False,
                 pending_commands    = PendingCommandList())
 
-            self.worker_index = online_device.worker_index + 1 if online_device.worker_index < len(self.worker_connections) - 1 else 0
+            online_device.worker.client_count += 1
             self.next_client_id = online_device.client_id + 1
             self.clients_map[online_device.client_id] = online_device
 
         LOG.info(f"Assigned ID {online_device.client_id} to websocket connection {sock.remote_address}")
 
-        worker_conn, worker_lock = self.worker_connections[online_device.worker_index]
-
         # Relay messages from device.
-        async with worker_lock:
-            await looper.run_in_executor(None, worker_conn.send, (commands.CLIENT_CONNECTED, online_device.client_id))
-        
+        await self.send_to_worker(online_device, (commands.CLIENT_CONNECTED, online_device.client_id, False))
+
         try:
             async for message in sock:
-                async with worker_lock:
-                    await looper.run_in_executor(None, worker_conn.send, (commands.MESSAGE_FROM_CLIENT, online_device.client_id, message))
+                await self.send_to_worker(online_device, (commands.MESSAGE_FROM_CLIENT, online_device.client_id, message))
 
         except Exception as ex:
             LOG.warning(f"Exception in client {online_device.client_id} : {ex}")
 
         finally:
-            async with worker_lock:
-                await looper.run_in_executor(None, worker_conn.send, (commands.CLIENT_DISCONNECTED, online_device.client_id))
-            
             async with self.lock:
                 self.clients_map.pop(online_device.client_id, None)
+                online_device.worker.client_count -= 1
                 if online_device.device_id is not None:
                     self.devices_map.pop(online_device.device_id, None)
 
+            # The worker may be gone already when it was retired meanwhile; the commands below fail either way.
+            try:
+                await self.send_to_worker(online_device, (commands.CLIENT_DISCONNECTED, online_device.client_id))
+            except Exception as ex:
+                LOG.warning(f"Failed to tell worker {online_device.worker.worker_id} that client {online_device.client_id} left : {ex}")
+
             async with online_device.send_lock:
                 online_device.closed = True
                 while (node := online_device.pending_commands.first_node) is not None:
@@ -155,21 +362,30 @@ class LoadBalancer:
 
     async def serve_application(self, conn : Connection):
         looper = asyncio.get_running_loop()
-        with ThreadPoolExecutor(max_workers = 1) as executor:
-            while True:
-                try:
-                    cmd, *args = await looper.run_in_executor(executor, conn.recv)
-                except EOFError:
-                    break
 
-                resp = await self.process_message_from_application(looper, cmd, args)
+        # Streams opened by this application, closed with its connection.
+        streams : Set[int] = set()
+
+        try:
+            with ThreadPoolExecutor(max_workers = 1) as executor:
+                while True:
+                    try:
+                        cmd, *args = await looper.run_in_executor(executor, conn.recv)
+                    except EOFError:
+                        break
+
+                    resp = await self.process_message_from_application(looper, cmd, args, streams)
 
-                if resp is None:
-                    break
+                    if resp is None:
+                        break
 
-                await looper.run_in_executor(None, conn.send, resp)
+                    await looper.run_in_executor(None, conn.send, resp)
+
+        finally:
+            for stream_id in streams:
+                self.close_stream(stream_id)
 
-    async def process_message_from_application(self, looper : asyncio.AbstractEventLoop, cmd : int, args : tuple) -> Optional[tuple]:
+    async def process_message_from_application(self, looper : asyncio.AbstractEventLoop, cmd : int, args : tuple, streams : Set[int]) -> Optional[tuple]:
         if cmd == commands.FIND_DEVICE_BY_ID:
             device_id, = args
 
@@ -202,7 +418,9 @@ class LoadBalancer:
                 return None, None
 
         elif cmd == commands.SEND_AND_RECEIVE:
-            client_id, request = args
+            # Older clients do not send the cached flag.
+            client_id, request, *options = args
+            cached = options[0] if options else False
 
             async with self.lock:
                 online_device = self.clients_map.get(client_id, None)
@@ -210,48 +428,252 @@ class LoadBalancer:
             if online_device is None:
                 return False, "Device is offline", None
 
-            node = PendingCommandNode(future = asyncio.Future())
+            try:
+                # Nothing is cached or indexed for a device that has not logged in, so its frames are not looked at.
+                device_id   = online_device.device_id
+                name        = request_name(request) if device_id is not None else None
+                # Broker jobs keep the template index themselves; the application's own writes are only seen here.
+                if device_id is not None and self.templates is not None:
+                    await looper.run_in_executor(None, self.templates.forget_request, device_id, name, request)
+
+                entry = await self.settings_cache.execute(
+                    device_id, name, request,
+                    lambda: self.execute_command(online_device, request), cached)
+                return True, None, entry.response
+
+            except Exception as ex:
+                return False, str(ex), None
+
+        elif cmd == commands.GET_DEVICE_SETTINGS:
+            device_id, request, cached = args
 
             try:
-                async with online_device.send_lock:
-                    if online_device.closed:
-                        return False, "Device is offline", None
+                return True, None, await self.execute_request(device_id, request, cached)
+            except Exception as ex:
+                return False, str(ex), None
 
-                    online_device.pending_commands.add_last(node)
-                    await online_device.connection.send(request)
+        elif cmd == commands.GET_LOG_PHOTO:
+            digest, = args
 
-                response = await asyncio.wait_for(node.future, timeout = 30)
-                return True, None, response
-            
-            except TimeoutError as ex:
-                return False, "Timed out", None
+            if self.blob_store is None:
+                return None,
+
+            return await looper.run_in_executor(None, self.blob_store.get, digest),
+
+        elif cmd == commands.OPEN_LOG_EXPORT:
+            device_id, user_id, start_time, end_time, resume = args
+
+            source = self.log_exporter.iter_logs(device_id, user_id, start_time, end_time, resume)
+            stream_id = self.open_stream(source)
+            streams.add(stream_id)
+            return stream_id,
 
+        elif cmd == commands.OPEN_USER_EXPORT:
+            device_id, faces, fingerprints, cards, photos, window, cached = args
+
+            progress = StreamProgress()
+            source = self.user_exporter.iter_users(device_id, faces, fingerprints, cards, photos, window, progress, cached)
+            stream_id = self.open_stream(source, progress)
+            streams.add(stream_id)
+            return stream_id,
+
+        elif cmd == commands.OPEN_USER_SYNC:
+            device_id, users, prune, full, window = args
+
+            progress = StreamProgress()
+            source = self.user_sync.sync_users(device_id, users, prune, full, window, progress)
+            stream_id = self.open_stream(source, progress)
+            streams.add(stream_id)
+            return stream_id,
+
+        elif cmd == commands.OPEN_FACE_ENROLLMENT:
+            device_ids, photos, max_parallel = args
+
+            progress = StreamProgress()
+            source = self.face_enrollment.enroll(device_ids, photos, max_parallel, progress = progress)
+            stream_id = self.open_stream(source, progress)
+            streams.add(stream_id)
+            return stream_id,
+
+        elif cmd == commands.OPEN_CONFIG_PUSH:
+            groups, dry_run, fresh, max_parallel = args
+
+            progress = StreamProgress()
+            source = self.fleet_config.push(groups, dry_run, fresh, max_parallel, progress)
+            stream_id = self.open_stream(source, progress)
+            streams.add(stream_id)
+            return stream_id,
+
+        elif cmd == commands.COPY_USER_TEMPLATES:
+            source_id, user_id, target_ids = args
+
+            try:
+                return True, None, await self.user_sync.copy_templates(source_id, user_id, target_ids)
             except Exception as ex:
                 return False, str(ex), None
 
-            finally:
-                if node.list_obj is not None:
-                    async with online_device.send_lock:
-                        if node.list_obj is not None: # Need to re-check after acquiring the lock
-                            online_device.pending_commands.remove(node)
+        elif cmd == commands.START_FIRMWARE_ROLLOUT:
+            image, target_version, device_ids, options = args
+
+            try:
+                return True, None, self.firmware_rollouts.start(image, target_version, device_ids, **options)
+            except Exception as ex:
+                return False, str(ex), None
+
+        elif cmd == commands.GET_FIRMWARE_ROLLOUT:
+            rollout_id, = args
+
+            return self.firmware_rollouts.get(rollout_id),
+
+        elif cmd == commands.ABORT_FIRMWARE_ROLLOUT:
+            rollout_id, = args
+
+            return self.firmware_rollouts.abort(rollout_id),
+
+        elif cmd == commands.SYNC_DEVICE_CLOCK:
+            device_id, force = args
+
+            try:
+                return True, None, await self.clock_sync.sync_device(device_id, force)
+            except Exception as ex:
+                return False, str(ex), None
+
+        elif cmd == commands.GET_CLOCK_HISTORY:
+            device_id, = args
+
+            return self.clock_sync.get_history(device_id),
+
+        elif cmd == commands.GET_STATUS_HISTORY:
+            device_id, start, end, limit = args
+
+            try:
+                return True, None, await looper.run_in_executor(None, self.status_poller.store.query, device_id, start, end, limit)
+            except Exception as ex:
+                return False, str(ex), None
+
+        elif cmd == commands.GET_USER_TABLE:
+            device_id, = args
+
+            try:
+                return True, None, await self.user_exporter.fill_table(device_id)
+            except Exception as ex:
+                return False, str(ex), None
+
+        elif cmd == commands.QUERY_STORED_LOGS:
+            device_ids, user_id, start_time, end_time, limit, photos = args
+
+            if self.log_store is None:
+                return False, "No log store", None
+
+            try:
+                return True, None, await looper.run_in_executor(None, self.log_store.query, device_ids, user_id, start_time, end_time, limit, photos)
+            except Exception as ex:
+                return False, str(ex), None
+
+        elif cmd == commands.COMMIT_LOG_EXPORT:
+            device_id, log_id, delete = args
+
+            try:
+                await self.log_exporter.commit(device_id, log_id, delete)
+                return True, None
+            except Exception as ex:
+                return False, str(ex)
+
+        elif cmd == commands.READ_STREAM:
+            stream_id, max_items = args
+
+            stream = self.streams.get(stream_id, None)
+            if stream is None:
+                return [], True, "Stream is closed", (0, None)
+            return await stream.read(max_items)
+
+        elif cmd == commands.CLOSE_STREAM:
+            stream_id, = args
+
+            self.close_stream(stream_id)
+            streams.discard(stream_id)
+            return True,
 
         else:
             return None
 
-    async def receive_messages_from_worker(self, worker_index : int):
+    def open_stream(self, source : AsyncGenerator[Any, None], progress : Optional[StreamProgress] = None) -> int:
+        stream_id = self.next_stream_id
+        self.next_stream_id = stream_id + 1
+        self.streams[stream_id] = DeviceStream(stream_id, source, progress)
+        return stream_id
+
+    def close_stream(self, stream_id : int):
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None:
+            stream.close()
+
+    # Same path as a SEND_AND_RECEIVE from the application, for work the broker runs next to the device itself.
+    async def execute_command(self, online_device : OnlineDevice, request : str | bytes) -> str:
+        node = PendingCommandNode(future = asyncio.Future())
+
+        try:
+            async with online_device.send_lock:
+                if online_device.closed:
+                    raise Exception("Device is offline")
+
+                online_device.pending_commands.add_last(node)
+                # Devices only accept text frames. Sending bytes as text (send(..., text = True)) needs a newer
+                # websockets than the asyncio API alone, so encoded requests from applications are decoded here.
+                await online_device.connection.send(request if isinstance(request, str) else request.decode("utf-8"))
+
+            try:
+                return await asyncio.wait_for(node.future, timeout = COMMAND_TIMEOUT)
+            except TimeoutError:
+                raise Exception("Timed out")
+
+        finally:
+            if node.list_obj is not None:
+                async with online_device.send_lock:
+                    if node.list_obj is not None: # Need to re-check after acquiring the lock
+                        online_device.pending_commands.remove(node)
+
+    # Looked up by device ID on every call, so a device that reconnects in the middle of a long job is followed.
+    # Broker jobs read fresh by default, but their writes still invalidate the settings cache.
+    async def execute_request(self, device_id : str, request : messages.GenericRequest, cached : bool = False) -> messages.GenericResponse:
+        async with self.lock:
+            online_device = self.devices_map.get(device_id, None)
+
+        if online_device is None:
+            raise Exception("Device is offline")
+
+        # Sent as str : websockets encodes it once, where to_bytes() would be decoded back to str first.
+        data = request.to_str()
+        entry = await self.settings_cache.execute(device_id, request.cmd, data, lambda: self.execute_command(online_device, data), cached)
+        return entry.parse(request)
+
+    async def store_log(self, device_id : str, fields : Dict[str, Optional[str]]):
+        try:
+            record = log.decode_time_log(fields)
+            await asyncio.get_running_loop().run_in_executor(None, self.log_store.append, device_id, [record], [fields.get(worker.LOG_IMAGE_REF_KEY, None)])
+        except Exception as ex:
+            LOG.warning(f"Failed to store log of device {device_id} : {ex}")
+
+    async def receive_messages_from_worker(self, link : WorkerLink):
         looper = asyncio.get_running_loop()
-        pipe, _ = self.worker_connections[worker_index]
 
         try:
             with ThreadPoolExecutor(max_workers = 1) as executor:
                 while True:
-                    cmd, *args = await looper.run_in_executor(executor, pipe.recv)
-                    await self.process_message_from_worker(worker_index, cmd, args)
+                    cmd, *args = await looper.run_in_executor(executor, link.connection.recv)
+                    if cmd == commands.WORKER_STOPPED:
+                        break
+                    await self.process_message_from_worker(link, cmd, args)
         except Exception as ex:
             LOG.error(f"Exception while processing message from worker : {ex}")
+        finally:
+            link.stopped.set()
 
-    async def process_message_from_worker(self, worker_index : int, cmd : int, args : tuple):
-        if cmd == commands.ASSIGN_DEVICE_ID:
+    async def process_message_from_worker(self, link : WorkerLink, cmd : int, args : tuple):
+        if cmd == commands.WORKER_STATS:
+            link.processed_count, link.webapp_latency = args
+
+        elif cmd == commands.ASSIGN_DEVICE_ID:
             client_id, device_id, device_attribs = args
 
             existing_device : Optional[OnlineDevice] = None
@@ -271,6 +693,8 @@ class LoadBalancer:
 
                     if online_device.device_id is not None:
                         self.devices_map[online_device.device_id] = online_device
+                        self.settings_cache.forget_device(online_device.device_id)
+                        self.firmware_rollouts.device_connected(online_device.device_id)
 
             if existing_device is not None:
                 LOG.warn(f"Disconnecting old client {existing_device.client_id} with assigned device ID {device_id}")
@@ -283,6 +707,17 @@ class LoadBalancer:
             else:
                 LOG.warn(f"Failed to assign device ID {device_id} to client {client_id} : client not found")
 
+        elif cmd == commands.LOG_FROM_DEVICE:
+            client_id, fields = args
+
+            async with self.lock:
+                online_device = self.clients_map.get(client_id, None)
+
+            if online_device is not None and online_device.device_id is not None and self.log_store is not None:
+                task : asyncio.Task = asyncio.create_task(self.store_log(online_device.device_id, fields))
+                self.misc_tasks.add(task)
+                task.add_done_callback(self.misc_tasks.discard)
+
         elif cmd == commands.SEND_MESSAGE_TO_CLIENT:
             client_id, content = args
 
@@ -312,7 +747,9 @@ class LoadBalancer:
                             return
                         online_device.pending_commands.remove(node)
 
-                    node.future.set_result(content)
+                    # The caller may have given up (timeout, closed stream); the response still consumes its node.
+                    if not node.future.done():
+                        node.future.set_result(content)
 
                 except Exception as ex:
                     LOG.warn(f"Exception while processing response from client {client_id} : {ex}")
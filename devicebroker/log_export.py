@@ -0,0 +1,175 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import threading
+from typing import AsyncIterator, Dict, Optional, Set
+
+from .device_cmd import messages
+from .device_cmd.m50 import log
+from .log_store import LogStore
+from .streams import ExecuteRequest
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE      : int = 32
+DEFAULT_MAX_PARALLEL    : int = 4
+
+# Next log position to read from each device, as last committed by the consumer. Kept in one small JSON file that
+# is rewritten on every commit; without a path the cursors only live as long as the broker.
+class CursorStore:
+    path    : Optional[str]
+    cursors : Dict[str, int]
+    lock    : threading.Lock
+
+    def __init__(self, path : Optional[str] = None):
+        super().__init__()
+
+        self.path       = path
+        self.cursors    = dict()
+        self.lock       = threading.Lock()
+
+        if path is not None:
+            try:
+                with open(path, "r") as f:
+                    self.cursors = {str(device_id) : int(pos) for device_id, pos in json.load(f).items()}
+            except FileNotFoundError:
+                pass
+
+    def get(self, device_id : str) -> Optional[int]:
+        with self.lock:
+            return self.cursors.get(device_id, None)
+
+    # Called from executor threads : the whole map is written under the lock, so the file never goes backwards.
+    def put(self, device_id : str, pos : int):
+        with self.lock:
+            self.cursors[device_id] = pos
+            self.save()
+
+    def clear(self, device_id : str):
+        with self.lock:
+            if self.cursors.pop(device_id, None) is not None:
+                self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.cursors, f)
+        os.replace(temp_path, self.path)
+
+# The GetFirstGlog / GetNextGlog walk, run in the broker next to the device connection instead of one application
+# round trip per record.
+class LogExporter:
+    execute     : ExecuteRequest
+    cursors     : CursorStore
+    semaphore   : asyncio.Semaphore
+    batch_size  : int
+    active      : Set[str]
+    store       : Optional[LogStore]
+
+    def __init__(self, execute : ExecuteRequest, cursors : CursorStore, max_parallel : int = DEFAULT_MAX_PARALLEL, batch_size : int = DEFAULT_BATCH_SIZE, store : Optional[LogStore] = None):
+        super().__init__()
+
+        self.execute    = execute
+        self.cursors    = cursors
+        self.semaphore  = asyncio.Semaphore(max_parallel)
+        self.batch_size = batch_size
+        self.active     = set()
+        self.store      = store
+
+    async def iter_logs(
+        self,
+        device_id   : str,
+        user_id     : Optional[int] = None,
+        start_time  : Optional[datetime.datetime] = None,
+        end_time    : Optional[datetime.datetime] = None,
+        resume      : bool = True
+    ) -> AsyncIterator[log.TimeLog]:
+        # The cursor is per device : a filtered walk starting from it would skip the other users' records.
+        if resume and (user_id is not None or start_time is not None or end_time is not None):
+            raise ValueError("Filtered exports cannot resume")
+        # Two walks over one device would fight over its cursor.
+        if device_id in self.active:
+            raise ValueError(f"Logs of device {device_id} are already being exported")
+        self.active.add(device_id)
+
+        try:
+            filtered = user_id is not None or start_time is not None or end_time is not None
+            pos = (self.cursors.get(device_id) if resume else None) or 0
+            request : messages.GenericRequest = log.GetFirstGlogRequest(user_id, start_time, end_time, begin_pos = pos)
+            finished = False
+            error : Optional[Exception] = None
+
+            while not finished:
+                batch = []
+
+                # The cap only covers device traffic : a batch waiting on a slow reader does not hold a slot.
+                async with self.semaphore:
+                    try:
+                        while len(batch) < self.batch_size:
+                            response = await self.execute(device_id, request)
+                            if not response.has_succeeded():
+                                # Devices answer past the last record with a failure, but so do they when a read fails.
+                                await self.check_end(device_id, pos, filtered, response)
+                                finished = True
+                                break
+
+                            # Decoded here : the record is pickled on its way to the application.
+                            record = response.log
+                            record.photo = record.photo
+
+                            # A record from before the position asked for would restart the walk, and never end it.
+                            if record.log_id < pos:
+                                raise Exception(f"Device {device_id} answered position {pos} with log {record.log_id}")
+
+                            batch.append(record)
+                            pos = record.log_id + 1
+                            request = log.GetNextGlogRequest(pos)
+
+                    # Raised once the records read before it are out.
+                    except Exception as ex:
+                        error = ex
+                        finished = True
+
+                if self.store is not None and batch:
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(None, self.store.append, device_id, batch)
+                    except Exception as ex:
+                        LOG.warning(f"Failed to store logs of device {device_id} : {ex}")
+
+                for record in batch:
+                    yield record
+
+            if error is not None:
+                raise error
+
+        finally:
+            self.active.discard(device_id)
+
+    # A failed read before the last record is an error, not the end of the log. Only an unfiltered walk can tell :
+    # a filtered one legitimately stops short when no later record matches.
+    async def check_end(self, device_id : str, pos : int, filtered : bool, response : messages.GenericResponse):
+        if filtered:
+            return
+
+        info = await self.execute(device_id, log.GetGlogPosInfoRequest())
+        if not info.has_succeeded():
+            raise Exception(f"Failed to read log position info : {info.fail_reason or info.result}")
+
+        end = info.start_pos + info.log_count
+        if pos < end:
+            raise Exception(f"Failed to read log {pos} of {end} : {response.fail_reason or response.result}")
+
+    # Everything up to and including log_id is safely stored by the consumer : the next export starts after it,
+    # and the device may drop those records.
+    async def commit(self, device_id : str, log_id : int, delete : bool = False):
+        await asyncio.get_running_loop().run_in_executor(None, self.cursors.put, device_id, log_id + 1)
+
+        if delete:
+            response = await self.execute(device_id, log.DeleteGlogWithPosRequest(log_id))
+            if not response.has_succeeded():
+                raise Exception(f"Failed to delete logs : {response.fail_reason or response.result}")
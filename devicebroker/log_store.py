@@ -0,0 +1,474 @@
+import array
+from collections import OrderedDict
+from dataclasses import dataclass
+import datetime
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from typing import Collection, Dict, Iterable, List, Optional, Set, Tuple
+
+from .blob_store import BlobStore
+from .device_cmd.m50 import log
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_OPEN_SEGMENTS : int = 256
+
+# Fixed-width columns, one file each per segment. device is the segment's own.
+_COLUMNS : Tuple[Tuple[str, str], ...] = (
+    ("log_id",  "q"),
+    ("user_id", "q"),       # -1 when the log has none
+    ("time",    "q"),       # Device local time, as seconds since 1970-01-01 on that clock
+    ("status",  "h"),       # Index into the attend status names
+    ("jobcode", "i"),
+    ("flags",   "B"),
+)
+_WIDTHS = {name : array.array(typecode).itemsize for name, typecode in _COLUMNS}
+
+FLAG_PHOTO  : int = 1
+FLAG_GEO    : int = 2
+
+_NO_USER        = -1
+_PHOTO_BYTES    = 0
+_PHOTO_BLOB     = 1     # BlobStore digest, for photos the worker already offloaded
+
+# Side files, only written for the rows that have one : row, then the data.
+_GEO            = struct.Struct("<Idd")
+_PHOTO_HEADER   = struct.Struct("<IBI")     # row, kind, length
+
+# User index : which segments hold logs of a user, sharded by user ID.
+_USER_ENTRY     = struct.Struct("<qiI")     # user ID, device number, day
+_USER_SHARDS    = 256
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+@dataclass
+class StoredLog:
+    device_id       : str
+    log_id          : int
+    user_id         : Optional[int]
+    time            : datetime.datetime
+    attend_status   : str
+    jobcode         : int
+    has_photo       : bool = False
+    latitude        : Optional[float] = None
+    longitude       : Optional[float] = None
+    photo           : Optional[bytes] = None    # Only read when asked for
+
+def _seconds(value : datetime.datetime) -> int:
+    return (value.replace(tzinfo = None) - _EPOCH) // datetime.timedelta(seconds = 1)
+
+def _day(value : datetime.datetime) -> int:
+    return value.year * 10000 + value.month * 100 + value.day
+
+def _float_or_nan(text : Optional[str]) -> float:
+    try:
+        return float(text) if text else math.nan
+    except ValueError:
+        return math.nan
+
+# Names numbered in the order first seen, one JSON string per line. Device IDs and attend statuses go into the
+# columns as these numbers.
+class _NameTable:
+    path    : str
+    names   : List[str]
+    numbers : Dict[str, int]
+
+    def __init__(self, path : str):
+        super().__init__()
+
+        self.path       = path
+        self.names      = []
+        self.numbers    = dict()
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        # A line cut short by a crash is dropped; its name gets a new number when seen again.
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            os.truncate(path, complete)
+        for line in data[: complete].splitlines():
+            name = json.loads(line)
+            self.numbers.setdefault(name, len(self.names))
+            self.names.append(name)
+
+    def get(self, name : str) -> Optional[int]:
+        return self.numbers.get(name, None)
+
+    def add(self, name : str) -> int:
+        number = self.numbers.get(name, None)
+        if number is None:
+            with open(self.path, "a", encoding = "utf-8") as f:
+                f.write(json.dumps(name) + "\n")
+            number = self.numbers[name] = len(self.names)
+            self.names.append(name)
+        return number
+
+# What appending to a segment needs to know, kept for recently written ones.
+@dataclass
+class _Segment:
+    rows        : int
+    log_ids     : Set[int]
+    user_ids    : Set[int]
+
+# Attendance logs as they pass through the broker, from TimeLog events and GetGlog pulls, kept so they can be
+# queried without the devices or the webapp. Each device and (device local) day is a segment directory of
+# fixed-width column files, only ever appended to, with photos and positions in side files. Queries map the
+# columns they filter on, and a user index names the segments that hold a user's logs. Records already stored
+# for a device are skipped by log ID.
+class LogStore:
+    root_dir        : str
+    blob_store      : Optional[BlobStore]
+    max_segments    : int
+    devices         : _NameTable
+    statuses        : _NameTable
+    segments        : OrderedDict[Tuple[int, int], _Segment]
+    lock            : threading.Lock
+
+    def __init__(self, root_dir : str, blob_store : Optional[BlobStore] = None, max_segments : int = DEFAULT_OPEN_SEGMENTS):
+        super().__init__()
+
+        os.makedirs(os.path.join(root_dir, "users"), exist_ok = True)
+
+        self.root_dir       = root_dir
+        self.blob_store     = blob_store
+        self.max_segments   = max_segments
+        self.devices        = _NameTable(os.path.join(root_dir, "devices.txt"))
+        self.statuses       = _NameTable(os.path.join(root_dir, "statuses.txt"))
+        self.segments       = OrderedDict()
+        self.lock           = threading.Lock()
+
+    def device_dir(self, device_no : int) -> str:
+        return os.path.join(self.root_dir, str(device_no))
+
+    def segment_dir(self, device_no : int, day : int) -> str:
+        return os.path.join(self.device_dir(device_no), str(day))
+
+    def shard_path(self, user_id : int) -> str:
+        return os.path.join(self.root_dir, "users", f"{user_id % _USER_SHARDS:02x}.idx")
+
+    @staticmethod
+    def row_count(segment_dir : str) -> int:
+        counts = []
+        for name, _ in _COLUMNS:
+            try:
+                counts.append(os.path.getsize(os.path.join(segment_dir, name)) // _WIDTHS[name])
+            except FileNotFoundError:
+                return 0
+        return min(counts)
+
+    # Called from executor threads. photo_refs, when given, holds for each log the BlobStore digest of a photo that
+    # is already there, in place of log.photo.
+    def append(self, device_id : str, logs : List[log.TimeLog], photo_refs : Optional[List[Optional[str]]] = None):
+        by_day : Dict[int, List[Tuple[log.TimeLog, Optional[str]]]] = dict()
+        for index, record in enumerate(logs):
+            if record.time is None:
+                continue
+            by_day.setdefault(_day(record.time), []).append((record, photo_refs[index] if photo_refs is not None else None))
+
+        with self.lock:
+            device_no = self.devices.add(device_id)
+            for day, records in by_day.items():
+                self.append_segment(device_no, day, records)
+
+    def append_segment(self, device_no : int, day : int, records : List[Tuple[log.TimeLog, Optional[str]]]):
+        segment = self.open_segment(device_no, day)
+
+        fresh : Dict[int, Tuple[log.TimeLog, Optional[str]]] = dict()
+        for record, photo_ref in records:
+            if record.log_id not in segment.log_ids:
+                fresh.setdefault(record.log_id, (record, photo_ref))
+        if not fresh:
+            return
+
+        try:
+            self.write_rows(device_no, day, segment, list(fresh.values()))
+        except:
+            # Looked at again from the files, which repair cuts back to whole rows.
+            self.segments.pop((device_no, day), None)
+            raise
+
+    def write_rows(self, device_no : int, day : int, segment : _Segment, fresh : List[Tuple[log.TimeLog, Optional[str]]]):
+        segment_dir = self.segment_dir(device_no, day)
+        os.makedirs(segment_dir, exist_ok = True)
+
+        # The index first : an entry for logs lost in a crash costs a look at one segment, a missing one loses them.
+        for user_id in sorted({record.user_id for record, _ in fresh if record.user_id is not None} - segment.user_ids):
+            with open(self.shard_path(user_id), "ab") as f:
+                f.write(_USER_ENTRY.pack(user_id, device_no, day))
+            segment.user_ids.add(user_id)
+
+        columns = {name : array.array(typecode) for name, typecode in _COLUMNS}
+        photos = bytearray()
+        geo = bytearray()
+        for row, (record, photo_ref) in enumerate(fresh, segment.rows):
+            flags = 0
+
+            photo = record.photo
+            if photo_ref or photo:
+                kind, data = (_PHOTO_BLOB, photo_ref.encode("ascii")) if photo_ref else (_PHOTO_BYTES, photo)
+                photos += _PHOTO_HEADER.pack(row, kind, len(data))
+                photos += data
+                flags |= FLAG_PHOTO
+
+            latitude, longitude = _float_or_nan(record.latitude), _float_or_nan(record.longitude)
+            if not math.isnan(latitude) and not math.isnan(longitude):
+                geo += _GEO.pack(row, latitude, longitude)
+                flags |= FLAG_GEO
+
+            columns["log_id"].append(record.log_id)
+            columns["user_id"].append(record.user_id if record.user_id is not None else _NO_USER)
+            columns["time"].append(_seconds(record.time))
+            columns["status"].append(self.statuses.add(record.attend_status or ""))
+            columns["jobcode"].append(record.jobcode or 0)
+            columns["flags"].append(flags)
+
+        # Side files before the columns : a row only counts once every column has it.
+        for name, data in (("photos", photos), ("geo", geo)):
+            if data:
+                with open(os.path.join(segment_dir, name), "ab") as f:
+                    f.write(data)
+        for name, values in columns.items():
+            with open(os.path.join(segment_dir, name), "ab") as f:
+                values.tofile(f)
+
+        segment.rows += len(fresh)
+        segment.log_ids.update(record.log_id for record, _ in fresh)
+
+    def open_segment(self, device_no : int, day : int) -> _Segment:
+        key = (device_no, day)
+        segment = self.segments.get(key, None)
+        if segment is not None:
+            self.segments.move_to_end(key)
+            return segment
+
+        segment_dir = self.segment_dir(device_no, day)
+        segment = _Segment(0, set(), set())
+        if os.path.isdir(segment_dir):
+            segment.rows = self.repair(segment_dir)
+            for name, values in (("log_id", segment.log_ids), ("user_id", segment.user_ids)):
+                values.update(_read_column(os.path.join(segment_dir, name), name, None, segment.rows))
+            segment.user_ids.discard(_NO_USER)
+
+        self.segments[key] = segment
+        while len(self.segments) > self.max_segments:
+            self.segments.popitem(last = False)
+        return segment
+
+    # Cuts what a crash left of the last append : column and side file entries past the last complete row.
+    def repair(self, segment_dir : str) -> int:
+        sizes : Dict[str, int] = dict()
+        for name, _ in _COLUMNS:
+            try:
+                sizes[name] = os.path.getsize(os.path.join(segment_dir, name))
+            except FileNotFoundError:
+                sizes[name] = 0
+        rows = min(size // _WIDTHS[name] for name, size in sizes.items())
+
+        for name, size in sizes.items():
+            if size > rows * _WIDTHS[name]:
+                LOG.warning(f"Truncating {os.path.join(segment_dir, name)} to {rows} rows")
+                os.truncate(os.path.join(segment_dir, name), rows * _WIDTHS[name])
+
+        for name, entries in (("photos", _photo_entries), ("geo", _geo_entries)):
+            path = os.path.join(segment_dir, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            end = 0
+            for row, entry_end, _ in entries(data):
+                if row >= rows:
+                    break
+                end = entry_end
+            if end < len(data):
+                os.truncate(path, end)
+
+        return rows
+
+    # Logs oldest first, across device_ids (all devices when None), with time in [start, end). With limit, only the
+    # last ones.
+    def query(
+        self,
+        device_ids  : Optional[Collection[str]] = None,
+        user_id     : Optional[int] = None,
+        start       : Optional[datetime.datetime] = None,
+        end         : Optional[datetime.datetime] = None,
+        limit       : Optional[int] = None,
+        photos      : bool = False
+    ) -> List[StoredLog]:
+        device_nos : Optional[Set[int]] = None
+        if device_ids is not None:
+            device_nos = {number for number in map(self.devices.get, device_ids) if number is not None}
+
+        first_day = _day(start) if start is not None else None
+        last_day = _day(end) if end is not None else None
+
+        segments = sorted(
+            (device_no, day) for device_no, day in (self.user_segments(user_id) if user_id is not None else self.all_segments(device_nos))
+            if (device_nos is None or device_no in device_nos) and
+               (first_day is None or day >= first_day) and (last_day is None or day <= last_day))
+
+        start_seconds = _seconds(start) if start is not None else None
+        end_seconds = _seconds(end) if end is not None else None
+
+        results : List[StoredLog] = []
+        for device_no, day in segments:
+            results.extend(self.read_segment(device_no, day, user_id, start_seconds, end_seconds, photos))
+
+        results.sort(key = lambda stored: (stored.time, stored.device_id, stored.log_id))
+        return results[-limit :] if limit else results
+
+    def user_segments(self, user_id : int) -> Set[Tuple[int, int]]:
+        try:
+            with open(self.shard_path(user_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return set()
+
+        # Possibly still being written.
+        data = data[: len(data) - len(data) % _USER_ENTRY.size]
+        return {(device_no, day) for entry_user, device_no, day in _USER_ENTRY.iter_unpack(data) if entry_user == user_id}
+
+    def all_segments(self, device_nos : Optional[Set[int]]) -> List[Tuple[int, int]]:
+        segments : List[Tuple[int, int]] = []
+        for device_no in (device_nos if device_nos is not None else range(0, len(self.devices.names))):
+            try:
+                segments.extend((device_no, int(name)) for name in os.listdir(self.device_dir(device_no)) if name.isdigit())
+            except FileNotFoundError:
+                pass
+        return segments
+
+    def read_segment(
+        self,
+        device_no   : int,
+        day         : int,
+        user_id     : Optional[int],
+        start       : Optional[int],
+        end         : Optional[int],
+        photos      : bool
+    ) -> List[StoredLog]:
+        segment_dir = self.segment_dir(device_no, day)
+        count = self.row_count(segment_dir)
+        if count == 0:
+            return []
+
+        rows : Optional[List[int]] = None
+        if user_id is not None:
+            rows = _matching_rows(os.path.join(segment_dir, "user_id"), "user_id", count, rows, user_id, user_id + 1)
+        if start is not None or end is not None:
+            rows = _matching_rows(os.path.join(segment_dir, "time"), "time", count, rows, start, end)
+        if rows is not None and not rows:
+            return []
+
+        values = {name : _read_column(os.path.join(segment_dir, name), name, rows, count) for name, _ in _COLUMNS}
+        rows = rows if rows is not None else list(range(0, count))
+
+        wanted_photos = {row for row, flags in zip(rows, values["flags"]) if flags & FLAG_PHOTO} if photos else set()
+        wanted_geo = {row for row, flags in zip(rows, values["flags"]) if flags & FLAG_GEO}
+        photo_data = self.read_photos(segment_dir, wanted_photos) if wanted_photos else {}
+        geo = self.read_geo(segment_dir, wanted_geo) if wanted_geo else {}
+
+        device_id = self.devices.names[device_no]
+        statuses = self.statuses.names
+        results : List[StoredLog] = []
+        for index, row in enumerate(rows):
+            stored = StoredLog(
+                device_id       = device_id,
+                log_id          = values["log_id"][index],
+                user_id         = values["user_id"][index] if values["user_id"][index] != _NO_USER else None,
+                time            = _EPOCH + datetime.timedelta(seconds = values["time"][index]),
+                attend_status   = statuses[values["status"][index]] if values["status"][index] < len(statuses) else "",
+                jobcode         = values["jobcode"][index],
+                has_photo       = (values["flags"][index] & FLAG_PHOTO) != 0,
+                photo           = photo_data.get(row, None))
+            if row in geo:
+                stored.latitude, stored.longitude = geo[row]
+            results.append(stored)
+        return results
+
+    def read_photos(self, segment_dir : str, rows : Set[int]) -> Dict[int, Optional[bytes]]:
+        photos : Dict[int, Optional[bytes]] = dict()
+        try:
+            with open(os.path.join(segment_dir, "photos"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return photos
+
+        for row, _, (kind, payload) in _photo_entries(data):
+            if row not in rows:
+                continue
+            if kind == _PHOTO_BLOB:
+                photos[row] = self.blob_store.get(bytes(payload).decode("ascii")) if self.blob_store is not None else None
+            else:
+                photos[row] = bytes(payload)
+        return photos
+
+    def read_geo(self, segment_dir : str, rows : Set[int]) -> Dict[int, Tuple[float, float]]:
+        try:
+            with open(os.path.join(segment_dir, "geo"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        return {row : position for row, _, position in _geo_entries(data) if row in rows}
+
+def _photo_entries(data : bytes) -> Iterable[Tuple[int, int, Tuple[int, memoryview]]]:
+    view = memoryview(data)
+    pos = 0
+    while pos + _PHOTO_HEADER.size <= len(data):
+        row, kind, length = _PHOTO_HEADER.unpack_from(data, pos)
+        end = pos + _PHOTO_HEADER.size + length
+        if end > len(data):
+            break
+        yield row, end, (kind, view[pos + _PHOTO_HEADER.size : end])
+        pos = end
+
+def _geo_entries(data : bytes) -> Iterable[Tuple[int, int, Tuple[float, float]]]:
+    for index, (row, latitude, longitude) in enumerate(_GEO.iter_unpack(data[: len(data) - len(data) % _GEO.size])):
+        yield row, (index + 1) * _GEO.size, (latitude, longitude)
+
+# Values of a column at rows, or all of its first count values, through a read-only mapping of the file.
+def _read_column(path : str, name : str, rows : Optional[List[int]], count : int) -> List[int]:
+    if count == 0:
+        return []
+
+    typecode = dict(_COLUMNS)[name]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as raw, raw[: count * _WIDTHS[name]] as used, used.cast(typecode) as values:
+            if rows is None:
+                return values.tolist()
+            return [values[row] for row in rows]
+
+# Rows (out of rows, or of the whole column when None) whose value is in [low, high).
+def _matching_rows(path : str, name : str, count : int, rows : Optional[List[int]], low : Optional[int], high : Optional[int]) -> List[int]:
+    typecode = dict(_COLUMNS)[name]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+        if np is not None:
+            values = np.frombuffer(mapped, dtype = typecode, count = count)
+            selected = values if rows is None else values[rows]
+            mask = np.ones(len(selected), dtype = bool)
+            if low is not None:
+                mask &= selected >= low
+            if high is not None:
+                mask &= selected < high
+            matches = np.flatnonzero(mask).tolist()
+            # The mapping cannot close while an array still points into it.
+            del values, selected
+            return matches if rows is None else [rows[index] for index in matches]
+
+        with memoryview(mapped) as raw, raw[: count * _WIDTHS[name]] as used, used.cast(typecode) as values:
+            return [row for row in (rows if rows is not None else range(0, count))
+                    if (low is None or values[row] >= low) and (high is None or values[row] < high)]
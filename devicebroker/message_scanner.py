@@ -0,0 +1,97 @@
+import re
+from typing import Collection, Dict, Final, Optional
+from xml.etree import ElementTree
+
+from . import xml_backend
+
+KIND_OTHER      : Final[int] = 0
+KIND_REQUEST    : Final[int] = 1
+KIND_EVENT      : Final[int] = 2
+
+TAG_REQUEST     : Final[str] = "Request"
+TAG_EVENT       : Final[str] = "Event"
+
+LOG_EVENTS      : Final[frozenset] = frozenset(("AdminLog", "AdminLog_v2", "TimeLog", "TimeLog_v2"))
+
+CHUNK_SIZE          : Final[int] = xml_backend.CHUNK_SIZE
+SMALL_MESSAGE_SIZE  : Final[int] = xml_backend.SMALL_MESSAGE_SIZE
+
+REQUEST_NAME_PREFIX : Final[int] = 512
+
+_REQUEST_NAME       : Final[re.Pattern] = re.compile(r"<Request[ \t\r\n]*>([^<&]+)</Request[ \t\r\n]*>")
+_REQUEST_NAME_BYTES : Final[re.Pattern] = re.compile(rb"<Request[ \t\r\n]*>([^<&]+)</Request[ \t\r\n]*>")
+
+# Frames are always classified with the flat scanner, whichever backend is selected for device_cmd : it is as strict
+# as a real parser on the one shape devices send, hands anything else to stdlib, and beats every backend's tree path.
+_SCANNER : Final[xml_backend.XmlBackend] = xml_backend.get("flat")
+
+class ScannedMessage:
+    kind    : int
+    name    : Optional[str]
+    fields  : Dict[str, Optional[str]]
+    partial : bool
+
+    def __init__(self):
+        super().__init__()
+
+        self.kind       = KIND_OTHER
+        self.name       = None
+        self.fields     = dict()
+        self.partial    = False
+
+    def add_field(self, tag : str, text : Optional[str], full_events : Collection[str]) -> bool:
+        self.fields[tag] = text
+
+        if tag == TAG_REQUEST:
+            if self.kind != KIND_REQUEST:
+                self.kind = KIND_REQUEST
+                self.name = text
+        elif tag == TAG_EVENT:
+            if self.kind == KIND_OTHER:
+                self.kind = KIND_EVENT
+                self.name = text
+                if text not in full_events:
+                    self.partial = True
+                    return False
+
+        return True
+
+def scan_message(message : str | bytes, full_events : Collection[str] = LOG_EVENTS, chunk_size : int = CHUNK_SIZE) -> ScannedMessage:
+    result = ScannedMessage()
+    for tag, text in _SCANNER.iter_children(message, chunk_size):
+        if not result.add_field(tag, text, full_events):
+            # A Request wins over an Event wherever it comes, so only stop when none can follow.
+            request_open = "<" + TAG_REQUEST if isinstance(message, str) else b"<" + TAG_REQUEST.encode("ascii")
+            if request_open not in message:
+                break
+            result.partial = False
+    return result
+
+# Command name of a request, from the Request field within the first REQUEST_NAME_PREFIX characters : it comes first in
+# every request the broker builds, and frames carrying photos run to megabytes. Requests go to the device as the
+# application wrote them, so one without a plain Request field there simply has no name.
+def request_name(message : str | bytes) -> Optional[str]:
+    if isinstance(message, str):
+        match = _REQUEST_NAME.search(message, 0, REQUEST_NAME_PREFIX)
+        return match.group(1) if match is not None else None
+
+    match = _REQUEST_NAME_BYTES.search(message, 0, REQUEST_NAME_PREFIX)
+    if match is None:
+        return None
+    try:
+        return match.group(1).decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+# The given fields of a request, stopping as soon as all of them were seen. None when the request does not parse.
+def request_fields(message : str | bytes, tags : Collection[str], chunk_size : int = CHUNK_SIZE) -> Optional[Dict[str, Optional[str]]]:
+    fields : Dict[str, Optional[str]] = dict()
+    try:
+        for tag, text in _SCANNER.iter_children(message, chunk_size):
+            if tag in tags and tag not in fields:
+                fields[tag] = text
+                if len(fields) == len(tags):
+                    break
+    except (ElementTree.ParseError, ValueError):
+        return None
+    return fields
@@ -0,0 +1,185 @@
+import asyncio
+from dataclasses import dataclass
+import logging
+import time
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from .device_cmd import messages
+from .message_scanner import scan_message
+
+LOG = logging.getLogger(__name__)
+
+# Requests that read one group of device settings, requests that change them, and how long a read stays good when
+# nothing passing through the broker changed it. Changes made at the terminal itself are only seen once ttl runs out.
+@dataclass(frozen = True)
+class SettingGroup:
+    name    : str
+    ttl     : float
+    reads   : FrozenSet[str]
+    writes  : FrozenSet[str]
+
+# Wipes the device : every group is stale afterwards.
+_CLEAR_ALL : FrozenSet[str] = frozenset(("EmptyAllData",))
+
+DEFAULT_GROUPS : List[SettingGroup] = [
+    SettingGroup("device_info", 300,
+        frozenset(("GetDeviceInfo", "GetDeviceInfoAll", "GetDeviceInfoExt")),
+        frozenset(("SetDeviceInfo", "SetDeviceInfoExt"))),
+    # Counters also move with every punch, hence the short life.
+    SettingGroup("device_status", 10,
+        frozenset(("GetDeviceStatus", "GetDeviceStatusAll")),
+        frozenset(("SetUserData", "SetFaceData", "SetFingerData", "SetUserPhoto", "EmptyUserEnrollmentData", "TakeOffManager",
+                   "EmptyTimeLog", "EmptyManageLog", "DeleteGlogWithPos", "EnrollFaceByPhoto"))),
+    SettingGroup("network", 600,
+        frozenset(("GetEthernetSetting", "GetWiFiSetting")),
+        frozenset(("SetEthernet", "SetWiFi"))),
+    SettingGroup("attendance", 300,
+        frozenset(("GetDepartment", "GetProxyDept", "GetBellTime", "GetAutoAttendance")),
+        frozenset(("SetDepartment", "SetProxyDept", "SetBellTime", "SetAutoAttendance"))),
+    SettingGroup("access", 300,
+        frozenset(("GetAccessTimeZone",)),
+        frozenset(("SetAccessTimeZone",))),
+    SettingGroup("screen", 300,
+        frozenset(("GetCenterScreenMessage", "GetVideoStreamSetting")),
+        frozenset(("SetCenterScreenMessage", "SetVideoStreamSetting"))),
+    SettingGroup("firmware", 3600,
+        frozenset(("GetFirmwareVersion",)),
+        frozenset(("FirmwareUpgradeHttp",))),
+]
+
+# Set on a shared read whose caller was cancelled before the answer came : the others waiting on it send their own.
+class ReadAbandoned(Exception):
+    pass
+
+class CachedSetting:
+    response    : str
+    expires     : float
+    parsed      : Optional[messages.GenericResponse]
+
+    def __init__(self, response : str, expires : float):
+        super().__init__()
+
+        self.response   = response
+        self.expires    = expires
+        self.parsed     = None
+
+    # Parsed once per cached response, however many applications read it.
+    def parse(self, request : messages.GenericRequest) -> messages.GenericResponse:
+        if self.parsed is None:
+            self.parsed = request.parse_response(self.response)
+        return self.parsed
+
+# Settings read from each device, keyed by the exact request text, so GetDeviceStatus of different parameters are
+# kept apart. A write bumps the device's generation before it is sent and again once answered : a read that was in
+# flight across a write is returned to its caller but never stored.
+class SettingsCache:
+    read_groups     : Dict[str, SettingGroup]
+    write_groups    : Dict[str, List[SettingGroup]]
+    entries         : Dict[str, Dict[bytes, Tuple[str, CachedSetting]]]
+    generations     : Dict[str, int]
+    inflight        : Dict[Tuple[str, bytes], Tuple[int, asyncio.Future]]
+    hits            : int
+    misses          : int
+
+    def __init__(self, groups : Optional[List[SettingGroup]] = None):
+        super().__init__()
+
+        self.read_groups    = dict()
+        self.write_groups   = dict()
+        for group in (DEFAULT_GROUPS if groups is None else groups):
+            for name in group.reads:
+                self.read_groups[name] = group
+            for name in group.writes:
+                self.write_groups.setdefault(name, []).append(group)
+
+        self.entries        = dict()
+        self.generations    = dict()
+        self.inflight       = dict()
+        self.hits           = 0
+        self.misses         = 0
+
+    def invalidate(self, device_id : str, groups : Optional[List[SettingGroup]] = None):
+        self.generations[device_id] = self.generations.get(device_id, 0) + 1
+
+        entries = self.entries.get(device_id, None)
+        if entries is None:
+            return
+        if groups is None:
+            entries.clear()
+            return
+
+        names = {group.name for group in groups}
+        for key in [key for key, (group_name, _) in entries.items() if group_name in names]:
+            del entries[key]
+
+    # A reconnected device may have been reset or reconfigured at the terminal.
+    def forget_device(self, device_id : str):
+        self.entries.pop(device_id, None)
+        self.generations[device_id] = self.generations.get(device_id, 0) + 1
+
+    # Runs request through run unless a live answer is cached. name is the request's command name, when known.
+    async def execute(
+        self,
+        device_id   : Optional[str],
+        name        : Optional[str],
+        request     : str | bytes,
+        run         : Callable[[], Awaitable[str]],
+        cached      : bool = True
+    ) -> CachedSetting:
+        if device_id is None or name is None:
+            return CachedSetting(await run(), 0)
+
+        if name in _CLEAR_ALL or name in self.write_groups:
+            groups = None if name in _CLEAR_ALL else self.write_groups[name]
+            self.invalidate(device_id, groups)
+            try:
+                return CachedSetting(await run(), 0)
+            finally:
+                self.invalidate(device_id, groups)
+
+        group = self.read_groups.get(name, None)
+        if group is None:
+            return CachedSetting(await run(), 0)
+
+        key = request.encode("utf-8") if isinstance(request, str) else bytes(request)
+        generation = self.generations.get(device_id, 0)
+        if cached:
+            hit = self.entries.get(device_id, {}).get(key, None)
+            if hit is not None and hit[1].expires > time.monotonic():
+                self.hits += 1
+                return hit[1]
+
+            # Dashboards tend to ask the same device the same thing at once : one round trip serves them all, unless
+            # a write went through since it was sent.
+            pending = self.inflight.get((device_id, key), None)
+            if pending is not None and pending[0] == generation:
+                try:
+                    entry = await asyncio.shield(pending[1])
+                    self.hits += 1
+                    return entry
+                except ReadAbandoned:
+                    generation = self.generations.get(device_id, 0)
+
+        self.misses += 1
+        future : asyncio.Future = asyncio.get_running_loop().create_future()
+        self.inflight[(device_id, key)] = (generation, future)
+        try:
+            entry = CachedSetting(await run(), time.monotonic() + group.ttl)
+            future.set_result(entry)
+        except asyncio.CancelledError:
+            # Cancelling the future would cancel every waiter with it, tearing down whatever task they run in.
+            future.set_exception(ReadAbandoned())
+            future.exception()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # Only waiters see it; nobody may be waiting.
+            future.exception()
+            raise
+        finally:
+            if self.inflight.get((device_id, key), (0, None))[1] is future:
+                del self.inflight[(device_id, key)]
+
+        if self.generations.get(device_id, 0) == generation and scan_message(entry.response).fields.get("Result", None) == "OK":
+            self.entries.setdefault(device_id, {})[key] = (group.name, entry)
+        return entry
@@ -0,0 +1,151 @@
+import asyncio
+from dataclasses import dataclass
+import heapq
+import logging
+import random
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .device_cmd.m50 import device_control
+from .status_store import StatusSample, StatusStore
+from .streams import ExecuteRequest
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL        : float = 60
+DEFAULT_MIN_INTERVAL    : float = 5
+DEFAULT_MAX_INTERVAL    : float = 600
+DEFAULT_MAX_PARALLEL    : int = 32
+
+TICK            : float = 1
+PRUNE_INTERVAL  : float = 3600
+BACKOFF         : float = 1.5
+JITTER          : float = 0.2
+
+# Alarm and door changes are what someone may be waiting on; counters changing only means the device is in use.
+_WATCHED = (device_control.DeviceStatusParamType.AlarmStatus, device_control.DeviceStatusParamType.DoorStatus)
+
+@dataclass
+class PollState:
+    interval    : float
+    due         : float
+    last        : Optional[StatusSample] = None
+    failures    : int = 0
+
+# GetDeviceStatusAll across the fleet, with an interval per device : back to min_interval as soon as an alarm or door
+# status changes, back to interval when anything else does, and growing towards max_interval while nothing does.
+# Every poll is jittered, so devices that came online together drift apart.
+class StatusPoller:
+    execute         : ExecuteRequest
+    online_devices  : Callable[[], List[str]]
+    store           : StatusStore
+    interval        : float
+    min_interval    : float
+    max_interval    : float
+    semaphore       : asyncio.Semaphore
+    states          : Dict[str, PollState]
+    queue           : List[Tuple[float, str]]
+    tasks           : Set[asyncio.Task]
+
+    def __init__(
+        self,
+        execute         : ExecuteRequest,
+        online_devices  : Callable[[], List[str]],
+        store           : StatusStore,
+        interval        : float = DEFAULT_INTERVAL,
+        min_interval    : float = DEFAULT_MIN_INTERVAL,
+        max_interval    : float = DEFAULT_MAX_INTERVAL,
+        max_parallel    : int = DEFAULT_MAX_PARALLEL
+    ):
+        super().__init__()
+
+        self.execute        = execute
+        self.online_devices = online_devices
+        self.store          = store
+        self.interval       = interval
+        self.min_interval   = min(min_interval, interval)
+        self.max_interval   = max(max_interval, interval)
+        self.semaphore      = asyncio.Semaphore(max_parallel)
+        self.states         = dict()
+        self.queue          = []
+        self.tasks          = set()
+
+    def next_interval(self, state : PollState, sample : StatusSample) -> float:
+        previous = state.last
+        if previous is None:
+            return self.interval
+        if any(previous.values.get(param, None) != sample.values.get(param, None) for param in _WATCHED):
+            return self.min_interval
+        if previous.values != sample.values:
+            return min(state.interval, self.interval)
+        return min(state.interval * BACKOFF, self.max_interval)
+
+    def schedule(self, device_id : str, state : PollState, delay : float):
+        state.due = time.monotonic() + delay * random.uniform(1 - JITTER, 1 + JITTER)
+        heapq.heappush(self.queue, (state.due, device_id))
+
+    async def run(self):
+        looper = asyncio.get_running_loop()
+        next_prune = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+
+                online = set(self.online_devices())
+                for device_id in online:
+                    if device_id not in self.states:
+                        # First polls spread over one interval.
+                        state = self.states[device_id] = PollState(self.interval, now)
+                        self.schedule(device_id, state, random.uniform(0, self.interval))
+
+                while self.queue and self.queue[0][0] <= now:
+                    due, device_id = heapq.heappop(self.queue)
+                    state = self.states.get(device_id, None)
+                    if state is None or state.due != due:
+                        continue
+                    if device_id not in online:
+                        # Polled again from scratch once it is back.
+                        del self.states[device_id]
+                        continue
+
+                    task = asyncio.create_task(self.poll(device_id, state))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+
+                if now >= next_prune:
+                    next_prune = now + PRUNE_INTERVAL
+                    await looper.run_in_executor(None, self.store.prune)
+
+                await asyncio.sleep(TICK)
+
+        finally:
+            for task in self.tasks:
+                task.cancel()
+
+    async def poll(self, device_id : str, state : PollState):
+        async with self.semaphore:
+            try:
+                # Fresh, but the answer also refreshes the settings cache for dashboards.
+                response = await self.execute(device_id, device_control.GetDeviceStatusAllRequest())
+                if not response.has_succeeded():
+                    raise Exception(response.fail_reason or response.result)
+            except Exception as ex:
+                state.failures += 1
+                LOG.debug(f"Status poll of device {device_id} failed : {ex}")
+                self.schedule(device_id, state, min(self.interval * state.failures, self.max_interval))
+                return
+
+        sample = StatusSample(time.time(), response.device_status)
+        state.interval = self.next_interval(state, sample)
+        state.last = sample
+        state.failures = 0
+        self.schedule(device_id, state, state.interval)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.store.append, device_id, sample)
+        except Exception as ex:
+            LOG.warning(f"Failed to store the status of device {device_id} : {ex}")
+
+    def latest(self, device_id : str) -> Optional[StatusSample]:
+        state = self.states.get(device_id, None)
+        return state.last if state is not None else None
@@ -0,0 +1,139 @@
+from dataclasses import dataclass
+import datetime
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .device_cmd.m50.device_control import DeviceStatusParamType
+
+LOG = logging.getLogger(__name__)
+
+_PARAMS     = list(DeviceStatusParamType)
+_MISSING    = -0x80000000
+# Poll time, then one int32 per status parameter in enum order : 44 bytes a sample.
+_RECORD     = struct.Struct("<d" + "i" * len(_PARAMS))
+
+DEFAULT_MEMORY_SAMPLES  : int = 1440
+
+@dataclass
+class StatusSample:
+    time    : float
+    values  : Dict[DeviceStatusParamType, int]
+
+def _pack(sample : StatusSample) -> bytes:
+    return _RECORD.pack(sample.time, *[sample.values.get(param, _MISSING) for param in _PARAMS])
+
+def _unpack(data : bytes | memoryview, start : Optional[float], end : Optional[float]) -> List[StatusSample]:
+    samples : List[StatusSample] = []
+    for sample_time, *values in _RECORD.iter_unpack(data):
+        if (start is None or sample_time >= start) and (end is None or sample_time < end):
+            samples.append(StatusSample(sample_time, {param : value for param, value in zip(_PARAMS, values) if value != _MISSING}))
+    return samples
+
+# Device status over time, as fixed-size records appended to one file per device and UTC day, so a range query only
+# opens the days it covers and retention is deleting old files. Without a directory, the last samples of each device
+# are kept in memory in the same format.
+class StatusStore:
+    root_dir        : Optional[str]
+    max_age         : Optional[float]
+    memory_samples  : int
+    memory          : Dict[str, bytearray]
+    lock            : threading.Lock
+
+    def __init__(self, root_dir : Optional[str] = None, max_age : Optional[float] = None, memory_samples : int = DEFAULT_MEMORY_SAMPLES):
+        super().__init__()
+
+        self.root_dir       = root_dir
+        self.max_age        = max_age
+        self.memory_samples = memory_samples
+        self.memory         = dict()
+        self.lock           = threading.Lock()
+
+    def device_dir(self, device_id : str) -> str:
+        return os.path.join(self.root_dir, hashlib.sha1(device_id.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def day_of(timestamp : float) -> str:
+        return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y%m%d")
+
+    # Called from executor threads.
+    def append(self, device_id : str, sample : StatusSample):
+        record = _pack(sample)
+
+        if self.root_dir is None:
+            with self.lock:
+                data = self.memory.setdefault(device_id, bytearray())
+                data += record
+                if len(data) > self.memory_samples * _RECORD.size:
+                    del data[: len(data) - self.memory_samples * _RECORD.size]
+            return
+
+        path = os.path.join(self.device_dir(device_id), self.day_of(sample.time) + ".bin")
+        try:
+            f = open(path, "ab")
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            f = open(path, "ab")
+        with f:
+            # A sample cut short by a crash would shift every later one.
+            misaligned = f.tell() % _RECORD.size
+            if misaligned:
+                f.truncate(f.tell() - misaligned)
+            f.write(record)
+
+    def query(self, device_id : str, start : Optional[float] = None, end : Optional[float] = None, limit : Optional[int] = None) -> List[StatusSample]:
+        if self.root_dir is None:
+            with self.lock:
+                data = bytes(self.memory.get(device_id, b""))
+            samples = _unpack(data, start, end)
+            return samples[-limit :] if limit else samples
+
+        try:
+            names = sorted(name for name in os.listdir(self.device_dir(device_id)) if name.endswith(".bin"))
+        except FileNotFoundError:
+            return []
+
+        first = self.day_of(start) if start is not None else None
+        last = self.day_of(end) if end is not None else None
+        samples : List[StatusSample] = []
+        # Newest day first when only the last few are wanted.
+        for name in (reversed(names) if limit else names):
+            day = name[: -4]
+            if (first is not None and day < first) or (last is not None and day > last):
+                continue
+            with open(os.path.join(self.device_dir(device_id), name), "rb") as f:
+                data = f.read()
+            # Possibly still being written.
+            data = data[: len(data) - len(data) % _RECORD.size]
+            day_samples = _unpack(data, start, end)
+            if limit:
+                samples = day_samples + samples
+                if len(samples) >= limit:
+                    return samples[-limit :]
+            else:
+                samples.extend(day_samples)
+        return samples
+
+    def latest(self, device_id : str) -> Optional[StatusSample]:
+        samples = self.query(device_id, limit = 1)
+        return samples[0] if samples else None
+
+    # Deletes the day files that ended more than max_age seconds ago.
+    def prune(self):
+        if self.root_dir is None or self.max_age is None or not os.path.isdir(self.root_dir):
+            return
+
+        oldest = self.day_of(time.time() - self.max_age)
+        for device_dir in os.scandir(self.root_dir):
+            if not device_dir.is_dir():
+                continue
+            for entry in os.scandir(device_dir.path):
+                if entry.name.endswith(".bin") and entry.name[: -4] < oldest:
+                    try:
+                        os.remove(entry.path)
+                    except OSError as ex:
+                        LOG.warning(f"Failed to remove {entry.path} : {ex}")
@@ -0,0 +1,80 @@
+import asyncio
+import contextlib
+import logging
+from typing import Any, AsyncGenerator, Awaitable, Callable, List, Optional, Tuple
+
+from .device_cmd import messages
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_BUFFERED    : int = 256
+DEFAULT_READ_SIZE       : int = 64
+
+# Runs one request against a device, by device ID, and returns the parsed response. An optional third argument,
+# cached, lets settings reads be answered from the broker's settings cache.
+ExecuteRequest = Callable[..., Awaitable[messages.GenericResponse]]
+
+_END = object()
+
+# How far a producer got. total is filled in by producers that can ask the device up front.
+class StreamProgress:
+    produced    : int
+    total       : Optional[int]
+
+    def __init__(self):
+        super().__init__()
+
+        self.produced   = 0
+        self.total      = None
+
+# Records produced next to the device and handed to the application a batch at a time. The producer runs ahead of
+# the reader so device round trips overlap with the application's own work, but only up to max_buffered records,
+# so a slow reader never makes the broker hold a whole device in memory.
+class DeviceStream:
+    stream_id   : int
+    queue       : asyncio.Queue
+    task        : asyncio.Task
+    progress    : StreamProgress
+    error       : Optional[str]
+    done        : bool
+
+    def __init__(self, stream_id : int, source : AsyncGenerator[Any, None], progress : Optional[StreamProgress] = None, max_buffered : int = DEFAULT_MAX_BUFFERED):
+        super().__init__()
+
+        self.stream_id  = stream_id
+        self.queue      = asyncio.Queue(maxsize = max_buffered)
+        self.progress   = progress or StreamProgress()
+        self.error      = None
+        self.done       = False
+        self.task       = asyncio.create_task(self.pump(source))
+
+    async def pump(self, source : AsyncGenerator[Any, None]):
+        try:
+            # Closed explicitly, so the producer's cleanup runs as soon as the stream is, not when it is collected.
+            async with contextlib.aclosing(source):
+                async for item in source:
+                    self.progress.produced += 1
+                    await self.queue.put(item)
+        except Exception as ex:
+            LOG.warning(f"Stream {self.stream_id} failed : {ex}")
+            self.error = str(ex) or type(ex).__name__
+        await self.queue.put(_END)
+
+    # Waits for at least one record, then takes whatever else is already buffered.
+    async def read(self, max_items : int = DEFAULT_READ_SIZE) -> Tuple[List[Any], bool, Optional[str], Tuple[int, Optional[int]]]:
+        items : List[Any] = []
+        if not self.done:
+            item = await self.queue.get()
+            while True:
+                if item is _END:
+                    self.done = True
+                    break
+                items.append(item)
+                if len(items) >= max_items or self.queue.empty():
+                    break
+                item = self.queue.get_nowait()
+
+        return items, self.done, self.error, (self.progress.produced, self.progress.total)
+
+    def close(self):
+        self.task.cancel()
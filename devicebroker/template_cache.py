@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+
+from .blob_store import BlobStore
+from .message_scanner import request_fields
+
+LOG = logging.getLogger(__name__)
+
+FACE_SLOT : str = "face"
+
+def finger_slot(finger_no : int) -> str:
+    return f"finger{finger_no}"
+
+# Requests applications send straight to a device that change its templates : the ones that wipe them all, and the
+# ones that touch one user, with the fields that tell which of the user's slots.
+_CLEAR_DEVICE : FrozenSet[str] = frozenset(("EmptyAllData", "EmptyUserEnrollmentData"))
+_CLEAR_USER   : Dict[str, Tuple[str, ...]] = {
+    "SetUserData"       : ("UserID", "Type"),
+    "SetFaceData"       : ("UserID", ),
+    "SetFingerData"     : ("UserID", "FingerNo"),
+    "EnrollFaceByPhoto" : ("UserID", ),
+    "RemoteEnroll"      : ("UserID", ),
+}
+
+# Biometric templates, stored once by content in a BlobStore, with an index of which template each device holds for
+# every (user, slot). A template read from one device is served from here for that device until the index is told
+# otherwise, and is uploaded to other devices without being downloaded again. The store's own size and age limits
+# do the eviction; an index entry whose blob is gone simply reads as a miss.
+class TemplateCache:
+    store       : BlobStore
+    index_dir   : Optional[str]
+    indexes     : Dict[str, Dict[Tuple[int, str], str]]
+    dirty       : Set[str]
+    lock        : threading.Lock
+
+    def __init__(self, store : BlobStore, index_dir : Optional[str] = None):
+        super().__init__()
+
+        self.store      = store
+        self.index_dir  = index_dir
+        self.indexes    = dict()
+        self.dirty      = set()
+        self.lock       = threading.Lock()
+
+    def index_path(self, device_id : str) -> str:
+        return os.path.join(self.index_dir, hashlib.sha1(device_id.encode("utf-8")).hexdigest() + ".json")
+
+    # Called with the lock held.
+    def index_for(self, device_id : str) -> Dict[Tuple[int, str], str]:
+        index = self.indexes.get(device_id, None)
+        if index is not None:
+            return index
+
+        index = dict()
+        if self.index_dir is not None:
+            try:
+                with open(self.index_path(device_id), "r") as f:
+                    for key, digest in json.load(f).items():
+                        user_id, slot = key.split(":", 1)
+                        index[(int(user_id), slot)] = digest
+            except FileNotFoundError:
+                pass
+        self.indexes[device_id] = index
+        return index
+
+    def digest_of(self, device_id : str, user_id : int, slot : str) -> Optional[str]:
+        with self.lock:
+            return self.index_for(device_id).get((user_id, slot), None)
+
+    def lookup(self, device_id : str, user_id : int, slot : str) -> Optional[bytes]:
+        digest = self.digest_of(device_id, user_id, slot)
+        if digest is None:
+            return None
+        return self.store.get(digest, touch = True)
+
+    def get(self, digest : str) -> Optional[bytes]:
+        return self.store.get(digest, touch = True)
+
+    # The device now holds data in this slot, whether it was just read from it or written to it.
+    def record(self, device_id : str, user_id : int, slot : str, data : bytes) -> str:
+        digest = self.store.put(data)
+        with self.lock:
+            self.index_for(device_id)[(user_id, slot)] = digest
+            self.dirty.add(device_id)
+        return digest
+
+    def forget(self, device_id : str, user_id : int, slot : Optional[str] = None):
+        with self.lock:
+            index = self.index_for(device_id)
+            for key in [key for key in index.keys() if key[0] == user_id and (slot is None or key[1] == slot)]:
+                del index[key]
+                self.dirty.add(device_id)
+
+    def forget_device(self, device_id : str):
+        with self.lock:
+            self.indexes[device_id] = dict()
+            self.dirty.add(device_id)
+
+    # A request an application sent to the device itself, which broker jobs never see. Whatever it may have changed is
+    # forgotten, whether or not the device carries it out; a user that cannot be told from the frame costs the device.
+    def forget_request(self, device_id : str, name : Optional[str], request : str | bytes):
+        if name in _CLEAR_DEVICE:
+            self.forget_device(device_id)
+            return
+
+        tags = _CLEAR_USER.get(name, None)
+        if tags is None:
+            return
+
+        fields = request_fields(request, tags)
+        try:
+            user_id = int(fields["UserID"])
+        except (TypeError, KeyError, ValueError):
+            self.forget_device(device_id)
+            return
+
+        if name == "SetUserData":
+            # Setting a user's details leaves the templates alone.
+            if fields.get("Type", None) != "Delete":
+                return
+            self.forget(device_id, user_id)
+        elif name == "SetFaceData":
+            self.forget(device_id, user_id, FACE_SLOT)
+        elif name == "SetFingerData" and (fields.get("FingerNo", None) or "").isdigit():
+            self.forget(device_id, user_id, finger_slot(int(fields["FingerNo"])))
+        else:
+            self.forget(device_id, user_id)
+
+    # Indexes change a slot at a time during a job; they are written once it is over.
+    def flush(self):
+        if self.index_dir is None:
+            return
+
+        with self.lock:
+            snapshots = {device_id : dict(self.indexes[device_id]) for device_id in self.dirty}
+            self.dirty.clear()
+
+            os.makedirs(self.index_dir, exist_ok = True)
+            for device_id, index in snapshots.items():
+                path = self.index_path(device_id)
+                temp_path = f"{path}.tmp"
+                with open(temp_path, "w") as f:
+                    json.dump({f"{user_id}:{slot}" : digest for (user_id, slot), digest in index.items()}, f)
+                os.replace(temp_path, path)
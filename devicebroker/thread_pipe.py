@@ -0,0 +1,45 @@
+import queue
+from typing import Any, Tuple
+
+_CLOSED = object()
+
+class ThreadConnection:
+    incoming    : queue.SimpleQueue
+    outgoing    : queue.SimpleQueue
+    closed      : bool
+
+    def __init__(self, incoming : queue.SimpleQueue, outgoing : queue.SimpleQueue):
+        super().__init__()
+
+        self.incoming   = incoming
+        self.outgoing   = outgoing
+        self.closed     = False
+
+    def send(self, obj : Any):
+        if self.closed:
+            raise OSError("handle is closed")
+        self.outgoing.put(obj)
+
+    def recv(self) -> Any:
+        obj = self.incoming.get()
+        if obj is _CLOSED:
+            # Leave the marker in place so every later recv() fails the same way.
+            self.incoming.put(_CLOSED)
+            raise EOFError
+        return obj
+
+    def poll(self) -> bool:
+        return not self.incoming.empty()
+
+    # Both ends see EOF : the peer, and any thread still blocked in recv() on this end.
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.outgoing.put(_CLOSED)
+            self.incoming.put(_CLOSED)
+
+# Same shape as multiprocessing.Pipe(), but objects are handed over by reference instead of pickled.
+def thread_pipe() -> Tuple[ThreadConnection, ThreadConnection]:
+    a_to_b = queue.SimpleQueue()
+    b_to_a = queue.SimpleQueue()
+    return ThreadConnection(b_to_a, a_to_b), ThreadConnection(a_to_b, b_to_a)
@@ -0,0 +1,164 @@
+import asyncio
+from collections import deque
+import logging
+from typing import AsyncGenerator, Deque, List, Optional
+
+from .device_cmd import messages
+from .device_cmd.m50 import device_control, device_limits, user_data
+from .streams import ExecuteRequest, StreamProgress
+from .template_cache import FACE_SLOT, TemplateCache, finger_slot
+from .user_table import UserTable
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_WINDOW : int = 8
+
+# The GetFirstUserData / GetNextUserData walk, run in the broker next to the device. The walk itself is a chain, but
+# the biometric and card requests of earlier users are sent while it goes on, so the device always has a few
+# commands queued instead of waiting for one application round trip per request.
+class UserExporter:
+    execute     : ExecuteRequest
+    templates   : Optional[TemplateCache]
+
+    def __init__(self, execute : ExecuteRequest, templates : Optional[TemplateCache] = None):
+        super().__init__()
+
+        self.execute    = execute
+        self.templates  = templates
+
+    async def cached_template(self, device_id : str, user_id : int, slot : str) -> Optional[bytes]:
+        if self.templates is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(None, self.templates.lookup, device_id, user_id, slot)
+
+    async def remember_template(self, device_id : str, user_id : int, slot : str, data : Optional[bytes]):
+        if self.templates is not None and data:
+            await asyncio.get_running_loop().run_in_executor(None, self.templates.record, device_id, user_id, slot, data)
+
+    async def flush_templates(self):
+        if self.templates is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.templates.flush)
+
+    async def iter_users(
+        self,
+        device_id       : str,
+        faces           : bool = False,
+        fingerprints    : bool = False,
+        cards           : bool = False,
+        photos          : bool = False,
+        window          : int = DEFAULT_WINDOW,
+        progress        : Optional[StreamProgress] = None,
+        cached          : bool = False
+    ) -> AsyncGenerator[user_data.UserInfo, None]:
+        if progress is not None:
+            progress.total = await self.count_users(device_id)
+
+        # Users whose details are still being fetched, oldest first. Never more than window of them.
+        pending : Deque[asyncio.Task] = deque()
+        try:
+            request : messages.GenericRequest = user_data.GetFirstUserDataRequest()
+            while True:
+                response = await self.execute(device_id, request)
+                if not response.has_succeeded() or response.user is None:
+                    break
+
+                user = response.user
+                pending.append(asyncio.create_task(self.complete_user(device_id, user, faces, fingerprints, cards, photos, cached)))
+
+                while len(pending) >= window or (pending and pending[0].done()):
+                    yield await pending.popleft()
+
+                if not response.has_more:
+                    break
+                request = user_data.GetNextUserDataRequest(user.user_id)
+
+            while pending:
+                yield await pending.popleft()
+
+        finally:
+            for task in pending:
+                task.cancel()
+            await self.flush_templates()
+
+    # The same walk without extras, straight into columns : no UserInfo outlives its own response.
+    async def fill_table(self, device_id : str, table : Optional[UserTable] = None) -> UserTable:
+        if table is None:
+            table = UserTable()
+
+        request : messages.GenericRequest = user_data.GetFirstUserDataRequest()
+        while True:
+            response = await self.execute(device_id, request)
+            if not response.has_succeeded() or response.user is None:
+                break
+
+            table.append(response.user)
+            if not response.has_more:
+                break
+            request = user_data.GetNextUserDataRequest(response.user.user_id)
+
+        return table
+
+    async def count_users(self, device_id : str) -> Optional[int]:
+        try:
+            response = await self.execute(device_id, device_control.GetDeviceStatusRequest(device_control.DeviceStatusParamType.UserCount))
+        except Exception as ex:
+            LOG.warning(f"Failed to count users of device {device_id} : {ex}")
+            return None
+        return response.param_value if response.has_succeeded() else None
+
+    async def complete_user(
+        self,
+        device_id       : str,
+        user            : user_data.UserInfo,
+        faces           : bool,
+        fingerprints    : bool,
+        cards           : bool,
+        photos          : bool,
+        cached          : bool = False
+    ) -> user_data.UserInfo:
+        requests : List[messages.GenericRequest] = []
+
+        # Some firmware sends the face along with the user record already.
+        if faces and user.face.enrolled:
+            if user.face.data:
+                await self.remember_template(device_id, user.user_id, FACE_SLOT, user.face.data)
+            elif cached and (data := await self.cached_template(device_id, user.user_id, FACE_SLOT)) is not None:
+                user.face.data = data
+            else:
+                requests.append(user_data.GetFaceDataRequest(user.user_id))
+        if fingerprints:
+            for finger_no in range(0, device_limits.MAX_FINGERS_PER_USER):
+                if not user.fingerprints[finger_no].enrolled:
+                    continue
+                if cached and (data := await self.cached_template(device_id, user.user_id, finger_slot(finger_no))) is not None:
+                    user.fingerprints[finger_no].data = data
+                else:
+                    requests.append(user_data.GetFingerprintDataRequest(user.user_id, finger_no))
+        if cards:
+            requests.append(user_data.GetUserCardRequest(user.user_id))
+            requests.append(user_data.GetUserQRRequest(user.user_id))
+        if photos:
+            requests.append(user_data.GetUserPhotoRequest(user.user_id))
+
+        # All sent at once : the device answers in order, and the balancer matches answers to requests the same way.
+        responses = await asyncio.gather(*[self.execute(device_id, request) for request in requests])
+
+        for request, response in zip(requests, responses):
+            if not response.has_succeeded():
+                continue
+            if isinstance(request, user_data.GetFaceDataRequest):
+                user.face.data = response.face
+                await self.remember_template(device_id, user.user_id, FACE_SLOT, user.face.data)
+            elif isinstance(request, user_data.GetFingerprintDataRequest):
+                user.fingerprints[request.finger_no].data = response.fingerprint_data
+                await self.remember_template(device_id, user.user_id, finger_slot(request.finger_no), response.fingerprint_data)
+            elif isinstance(request, user_data.GetUserCardRequest):
+                user.card = response.card
+            elif isinstance(request, user_data.GetUserQRRequest):
+                user.qr = response.qr
+            elif isinstance(request, user_data.GetUserPhotoRequest):
+                user.photo = response.photo or None
+
+        # Decoded here : the record is pickled on its way to the application.
+        user.face.data = user.face.data
+        return user
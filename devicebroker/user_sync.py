@@ -0,0 +1,328 @@
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import AsyncGenerator, Dict, List, Optional, Set, Tuple
+
+from .device_cmd import messages
+from .device_cmd.m50 import user_data
+from .streams import ExecuteRequest, StreamProgress
+from .template_cache import FACE_SLOT, TemplateCache, finger_slot
+from .user_export import UserExporter
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_WINDOW : int = 8
+
+# What was last pushed to a device for one user : short hashes of the SetUserData request and of each blob. Enough
+# to tell whether anything changed, at a few dozen bytes per user.
+@dataclass(frozen = True)
+class UserDigest:
+    record  : str
+    face    : Optional[str]
+    fingers : Tuple[Optional[str], ...]
+    photo   : Optional[str]
+
+@dataclass
+class UserSyncResult:
+    user_id     : int
+    action      : str           # "add", "update", "replace" or "delete"
+    steps       : List[str]
+    succeeded   : bool
+    error       : Optional[str] = None
+
+@dataclass
+class TemplateCopyResult:
+    device_id   : str
+    steps       : List[str]     # Slots uploaded
+    skipped     : List[str]     # Slots the device already held
+    succeeded   : bool
+    error       : Optional[str] = None
+
+def _hash(data : bytes | bytearray) -> str:
+    return hashlib.blake2b(data, digest_size = 8).hexdigest()
+
+def digest_user(user : user_data.UserInfo) -> UserDigest:
+    return UserDigest(
+        record  = _hash(user_data.SetUserDataRequest(user).to_bytes()),
+        face    = _hash(user.face.data) if user.face.data else None,
+        fingers = tuple(_hash(bytes((fp.duress, )) + fp.data) if fp.data else None for fp in user.fingerprints),
+        photo   = _hash(user.photo) if user.photo else None,
+    )
+
+# Per-device digests of the users last pushed, one JSON file per device. Without a directory they only live as long
+# as the broker, and the first sync of each device after a restart pushes everything.
+class SyncStateStore:
+    root_dir    : Optional[str]
+    states      : Dict[str, Dict[int, UserDigest]]
+    lock        : threading.Lock
+
+    def __init__(self, root_dir : Optional[str] = None):
+        super().__init__()
+
+        self.root_dir   = root_dir
+        self.states     = dict()
+        self.lock       = threading.Lock()
+
+    def path_for(self, device_id : str) -> str:
+        return os.path.join(self.root_dir, hashlib.sha1(device_id.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, device_id : str) -> Optional[Dict[int, UserDigest]]:
+        with self.lock:
+            state = self.states.get(device_id, None)
+            if state is not None or self.root_dir is None:
+                return None if state is None else dict(state)
+
+            try:
+                with open(self.path_for(device_id), "r") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                return None
+
+            state = {int(user_id) : UserDigest(record, face, tuple(fingers), photo) for user_id, (record, face, fingers, photo) in data.items()}
+            self.states[device_id] = state
+            return dict(state)
+
+    def put(self, device_id : str, state : Dict[int, UserDigest]):
+        with self.lock:
+            self.states[device_id] = dict(state)
+            if self.root_dir is None:
+                return
+
+            os.makedirs(self.root_dir, exist_ok = True)
+            path = self.path_for(device_id)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump({str(user_id) : (x.record, x.face, x.fingers, x.photo) for user_id, x in state.items()}, f)
+            os.replace(temp_path, path)
+
+    def clear(self, device_id : str):
+        with self.lock:
+            self.states.pop(device_id, None)
+            if self.root_dir is not None:
+                try:
+                    os.remove(self.path_for(device_id))
+                except FileNotFoundError:
+                    pass
+
+# One user's change : the requests to send, in order, and the digest the device holds once they all succeed.
+@dataclass
+class _UserChange:
+    user_id     : int
+    action      : str
+    requests    : List[Tuple[str, messages.GenericRequest]]
+    digest      : Optional[UserDigest]
+
+# Brings a device's users in line with a desired list, sending only what differs from the last successful sync.
+class UserSync:
+    execute         : ExecuteRequest
+    states          : SyncStateStore
+    templates       : Optional[TemplateCache]
+    user_exporter   : UserExporter
+    active          : Set[str]
+
+    def __init__(self, execute : ExecuteRequest, states : SyncStateStore, templates : Optional[TemplateCache] = None):
+        super().__init__()
+
+        self.execute        = execute
+        self.states         = states
+        self.templates      = templates
+        self.user_exporter  = UserExporter(execute, templates)
+        self.active         = set()
+
+    # Removals only with prune : otherwise users left out keep their place on the device and their digests in the state.
+    def plan(self, users : List[user_data.UserInfo], known : Dict[int, UserDigest], present : Optional[Set[int]], prune : bool = False) -> List[_UserChange]:
+        changes : List[_UserChange] = []
+        wanted = set()
+
+        for user in users:
+            wanted.add(user.user_id)
+            digest = digest_user(user)
+            old = known.get(user.user_id, None)
+            if old == digest:
+                continue
+
+            # The protocol can set biometrics but not take one away : dropping one means starting the user over.
+            dropped = old is not None and (
+                (old.face is not None and digest.face is None) or
+                any(before is not None and after is None for before, after in zip(old.fingers, digest.fingers)))
+
+            if old is None or dropped:
+                action = "replace" if dropped else "update" if present is not None and user.user_id in present else "add"
+                requests = [("delete", user_data.DeleteUserRequest(user.user_id))] if dropped else []
+                requests += self.user_requests(user, digest, None)
+            else:
+                action = "update"
+                requests = self.user_requests(user, digest, old)
+            changes.append(_UserChange(user.user_id, action, requests, digest))
+
+        if not prune:
+            return changes
+
+        # Removals : users synced before, plus whatever else the device holds when its contents were listed.
+        stale = set(known.keys()) | (present or set())
+        for user_id in sorted(stale - wanted):
+            changes.append(_UserChange(user_id, "delete", [("delete", user_data.DeleteUserRequest(user_id))], None))
+
+        return changes
+
+    # Requests for the parts of a user that differ from old, or all of them without old.
+    def user_requests(self, user : user_data.UserInfo, digest : UserDigest, old : Optional[UserDigest]) -> List[Tuple[str, messages.GenericRequest]]:
+        requests : List[Tuple[str, messages.GenericRequest]] = []
+
+        if old is None or old.record != digest.record:
+            requests.append(("record", user_data.SetUserDataRequest(user)))
+        if digest.face is not None and (old is None or old.face != digest.face):
+            requests.append(("face", user_data.SetFaceDataRequest(user.user_id, user.face.data)))
+        for finger_no, fp in enumerate(user.fingerprints):
+            if digest.fingers[finger_no] is not None and (old is None or old.fingers[finger_no] != digest.fingers[finger_no]):
+                requests.append((f"finger {finger_no}", user_data.SetFingerprintDataRequest(user.user_id, finger_no, fp.data, fp.duress)))
+        if (old is None and digest.photo is not None) or (old is not None and old.photo != digest.photo):
+            requests.append(("photo", user_data.SetUserPhotoRequest(user.user_id, user.photo)))
+
+        return requests
+
+    async def apply(self, device_id : str, change : _UserChange, state : Dict[int, UserDigest]) -> UserSyncResult:
+        result = UserSyncResult(change.user_id, change.action, [], False)
+        try:
+            # In order : biometrics need the user record in place.
+            for step, request in change.requests:
+                response = await self.execute(device_id, request)
+                if not response.has_succeeded():
+                    raise Exception(f"{step} : {response.fail_reason or response.result}")
+                result.steps.append(step)
+                await self.note_templates(device_id, change.user_id, request)
+
+            result.succeeded = True
+            if change.digest is None:
+                state.pop(change.user_id, None)
+            else:
+                state[change.user_id] = change.digest
+
+        except Exception as ex:
+            result.error = str(ex)
+            # Half applied : whatever the device holds now is unknown, so the next sync sends the whole user again.
+            if change.action != "delete":
+                state.pop(change.user_id, None)
+            if self.templates is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self.templates.forget, device_id, change.user_id)
+
+        return result
+
+    # Keeps the template index in step with what was just written to the device.
+    async def note_templates(self, device_id : str, user_id : int, request : messages.GenericRequest):
+        if self.templates is None:
+            return
+
+        looper = asyncio.get_running_loop()
+        if isinstance(request, user_data.DeleteUserRequest):
+            await looper.run_in_executor(None, self.templates.forget, device_id, user_id)
+        elif isinstance(request, user_data.SetFaceDataRequest) and request.face_data:
+            await looper.run_in_executor(None, self.templates.record, device_id, user_id, FACE_SLOT, request.face_data)
+        elif isinstance(request, user_data.SetFingerprintDataRequest) and request.fingerprint_data:
+            await looper.run_in_executor(None, self.templates.record, device_id, user_id, finger_slot(request.finger_no), request.fingerprint_data)
+
+    async def sync_users(
+        self,
+        device_id   : str,
+        users       : List[user_data.UserInfo],
+        prune       : bool = True,
+        full        : bool = False,
+        window      : int = DEFAULT_WINDOW,
+        progress    : Optional[StreamProgress] = None
+    ) -> AsyncGenerator[UserSyncResult, None]:
+        if device_id in self.active:
+            raise ValueError(f"Users of device {device_id} are already being synced")
+        self.active.add(device_id)
+
+        looper = asyncio.get_running_loop()
+        pending : Dict[asyncio.Task, _UserChange] = dict()
+        known : Optional[Dict[int, UserDigest]] = None
+        state : Dict[int, UserDigest] = dict()
+
+        try:
+            known = None if full else await looper.run_in_executor(None, self.states.get, device_id)
+
+            # Without a record of the last sync, only the device itself can say which users to remove.
+            present : Optional[Set[int]] = None
+            if known is None and prune:
+                present = set((await self.user_exporter.fill_table(device_id)).user_ids)
+
+            state = dict(known or {})
+            changes = self.plan(users, known or {}, present, prune)
+            if progress is not None:
+                progress.total = len(changes)
+
+            for change in changes:
+                while len(pending) >= window:
+                    done, _ = await asyncio.wait(pending.keys(), return_when = asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        del pending[task]
+                        yield task.result()
+                pending[asyncio.create_task(self.apply(device_id, change, state))] = change
+
+            while pending:
+                done, _ = await asyncio.wait(pending.keys(), return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del pending[task]
+                    yield task.result()
+
+        finally:
+            # Users cut off halfway are in an unknown state on the device.
+            for task, change in pending.items():
+                task.cancel()
+                if change.action != "delete":
+                    state.pop(change.user_id, None)
+            self.active.discard(device_id)
+            if state or known is not None:
+                await looper.run_in_executor(None, self.states.put, device_id, state)
+            await self.user_exporter.flush_templates()
+
+    # Copies one user's face and fingerprints from a device to others. The source is only read for templates the
+    # cache does not hold, and targets already holding the same template are skipped.
+    async def copy_templates(self, source_id : str, user_id : int, target_ids : List[str], window : int = DEFAULT_WINDOW) -> List[TemplateCopyResult]:
+        response = await self.execute(source_id, user_data.GetUserDataRequest(user_id))
+        if not response.has_succeeded() or response.user is None:
+            raise Exception(f"User {user_id} not found on device {source_id} : {response.fail_reason or response.result}")
+        user = await self.user_exporter.complete_user(source_id, response.user, True, True, False, False)
+
+        # Slot, digest and the request writing it. Digests are taken once, whatever the number of targets.
+        templates : List[Tuple[str, str, messages.GenericRequest]] = []
+        if user.face.data:
+            templates.append((FACE_SLOT, hashlib.sha256(user.face.data).hexdigest(), user_data.SetFaceDataRequest(user_id, user.face.data)))
+        for finger_no, fp in enumerate(user.fingerprints):
+            if fp.data:
+                templates.append((
+                    finger_slot(finger_no), hashlib.sha256(fp.data).hexdigest(),
+                    user_data.SetFingerprintDataRequest(user_id, finger_no, fp.data, fp.duress)))
+
+        looper = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(window)
+
+        async def copy_to(target_id : str) -> TemplateCopyResult:
+            result = TemplateCopyResult(target_id, [], [], False)
+            async with semaphore:
+                try:
+                    for slot, digest, request in templates:
+                        # The index may have to be read from disk, and its lock is held by executor threads.
+                        if self.templates is not None and await looper.run_in_executor(None, self.templates.digest_of, target_id, user_id, slot) == digest:
+                            result.skipped.append(slot)
+                            continue
+
+                        response = await self.execute(target_id, request)
+                        if not response.has_succeeded():
+                            raise Exception(f"{slot} : {response.fail_reason or response.result}")
+                        result.steps.append(slot)
+                        await self.note_templates(target_id, user_id, request)
+                    result.succeeded = True
+                except Exception as ex:
+                    result.error = str(ex)
+            return result
+
+        try:
+            return await asyncio.gather(*[copy_to(target_id) for target_id in target_ids])
+        finally:
+            await self.user_exporter.flush_templates()
@@ -0,0 +1,252 @@
+import array
+from dataclasses import dataclass
+import datetime
+import operator
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Set
+
+from .device_cmd.m50 import device_limits, user_data
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Card and QR column value of a user without one : both are unsigned 32 bit on the device.
+NO_CODE : int = -1
+
+# Fingers column : two bits per finger as GetUserData sends them, enrolled then duress.
+ENROLLED_FINGERS : int = sum(1 << (finger_no * 2) for finger_no in range(0, device_limits.MAX_FINGERS_PER_USER))
+
+# A boolean per row : a NumPy array when NumPy is installed, a list otherwise.
+Mask = Sequence[bool]
+
+def finger_bits(fingerprints : List[user_data.UserFingerprintInfo]) -> int:
+    bits = 0
+    for finger_no, fp in enumerate(fingerprints):
+        if fp.enrolled:
+            bits |= 1 << (finger_no * 2)
+            if fp.duress:
+                bits |= 1 << (finger_no * 2 + 1)
+    return bits
+
+def _view(column : array.array) -> Any:
+    return np.frombuffer(column, dtype = column.typecode) if len(column) > 0 else np.zeros(0, dtype = column.typecode)
+
+# Works on single values and NumPy arrays alike.
+def _compare(column : array.array, test : Callable[[Any, Any], Any], value : Any) -> Mask:
+    if np is not None:
+        return test(_view(column), value)
+    return [bool(test(item, value)) for item in column]
+
+def _both(first : Mask, second : Mask) -> Mask:
+    if np is not None:
+        return first & second
+    return [a and b for a, b in zip(first, second)]
+
+def _has_bits(values : Any, bits : int) -> Any:
+    return (values & bits) != 0
+
+def _lacks_bits(values : Any, bits : int) -> Any:
+    return (values & bits) == 0
+
+@dataclass
+class UserTableDiff:
+    added       : List[int]     # User IDs only in the newer table
+    removed     : List[int]     # User IDs only in the older table
+    changed     : List[int]     # User IDs in both, with any column different
+
+# The users of a device as columns : a few dozen bytes a user instead of a UserInfo with its lists and objects, and
+# filters or diffs over a whole fleet's users without touching Python objects one by one when NumPy is installed.
+# Templates and photos are not kept; face and fingers only say what is enrolled.
+class UserTable:
+    user_ids        : array.array       # q
+    departments     : array.array       # i
+    privileges      : array.array       # b, UserPrivilege values
+    enabled         : array.array       # b
+    cards           : array.array       # q, NO_CODE when none
+    qrs             : array.array       # q, NO_CODE when none
+    fingers         : array.array       # i, see ENROLLED_FINGERS
+    faces           : array.array       # b
+    period_starts   : array.array       # i, proleptic ordinals, 0 when unused
+    period_ends     : array.array       # i
+    timesets        : array.array       # h, TIMESET_COUNT per user
+    names           : List[str]
+    passwords       : List[Optional[str]]
+
+    def __init__(self):
+        super().__init__()
+
+        self.user_ids       = array.array("q")
+        self.departments    = array.array("i")
+        self.privileges     = array.array("b")
+        self.enabled        = array.array("b")
+        self.cards          = array.array("q")
+        self.qrs            = array.array("q")
+        self.fingers        = array.array("i")
+        self.faces          = array.array("b")
+        self.period_starts  = array.array("i")
+        self.period_ends    = array.array("i")
+        self.timesets       = array.array("h")
+        self.names          = []
+        self.passwords      = []
+
+    @classmethod
+    def from_users(cls, users : Iterable[user_data.UserInfo]) -> 'UserTable':
+        table = cls()
+        for user in users:
+            table.append(user)
+        return table
+
+    def columns(self) -> List[array.array]:
+        return [self.user_ids, self.departments, self.privileges, self.enabled, self.cards, self.qrs, self.fingers,
+                self.faces, self.period_starts, self.period_ends]
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def append(self, user : user_data.UserInfo):
+        timesets = list(user.timesets[: user_data.TIMESET_COUNT])
+        timesets += [-1] * (user_data.TIMESET_COUNT - len(timesets))
+
+        self.user_ids.append(user.user_id)
+        self.departments.append(user.department)
+        self.privileges.append(user.privilege.value)
+        self.enabled.append(1 if user.enabled else 0)
+        self.cards.append(user.card if user.card is not None else NO_CODE)
+        self.qrs.append(user.qr if user.qr is not None else NO_CODE)
+        self.fingers.append(finger_bits(user.fingerprints))
+        self.faces.append(1 if user.face.enrolled else 0)
+        self.period_starts.append(user.period[0].toordinal() if user.period is not None else 0)
+        self.period_ends.append(user.period[1].toordinal() if user.period is not None else 0)
+        self.timesets.extend(timesets)
+        self.names.append(user.name)
+        self.passwords.append(user.password)
+
+    # The row as a UserInfo, without templates.
+    def user(self, index : int) -> user_data.UserInfo:
+        user = user_data.UserInfo()
+        user.user_id    = self.user_ids[index]
+        user.name       = self.names[index]
+        user.privilege  = user_data.UserPrivilege(self.privileges[index])
+        user.enabled    = self.enabled[index] != 0
+        user.department = self.departments[index]
+        user.timesets   = self.timesets[index * user_data.TIMESET_COUNT : (index + 1) * user_data.TIMESET_COUNT].tolist()
+        user.card       = self.cards[index] if self.cards[index] != NO_CODE else None
+        user.qr         = self.qrs[index] if self.qrs[index] != NO_CODE else None
+        user.password   = self.passwords[index]
+
+        if self.period_starts[index] != 0:
+            user.period = (datetime.date.fromordinal(self.period_starts[index]), datetime.date.fromordinal(self.period_ends[index]))
+
+        user.face.enrolled = self.faces[index] != 0
+        bits = self.fingers[index]
+        for finger_no, fp in enumerate(user.fingerprints):
+            fp.enrolled = ((bits >> (finger_no * 2)) & 1) != 0
+            fp.duress   = ((bits >> (finger_no * 2 + 1)) & 1) != 0
+        return user
+
+    def __iter__(self) -> Iterator[user_data.UserInfo]:
+        for index in range(0, len(self)):
+            yield self.user(index)
+
+    # Rows matching every condition given. fingerprints and face test whether any is enrolled, card and qr whether
+    # the user has one.
+    def where(
+        self,
+        department      : Optional[int] = None,
+        privilege       : Optional[user_data.UserPrivilege] = None,
+        enabled         : Optional[bool] = None,
+        face            : Optional[bool] = None,
+        fingerprints    : Optional[bool] = None,
+        card            : Optional[bool] = None,
+        qr              : Optional[bool] = None,
+        user_ids        : Optional[Set[int]] = None
+    ) -> Mask:
+        conditions : List[Mask] = []
+        if department is not None:
+            conditions.append(_compare(self.departments, operator.eq, department))
+        if privilege is not None:
+            conditions.append(_compare(self.privileges, operator.eq, privilege.value))
+        if enabled is not None:
+            conditions.append(_compare(self.enabled, operator.eq if enabled else operator.ne, 1))
+        if face is not None:
+            conditions.append(_compare(self.faces, operator.eq if face else operator.ne, 1))
+        if fingerprints is not None:
+            conditions.append(_compare(self.fingers, _has_bits if fingerprints else _lacks_bits, ENROLLED_FINGERS))
+        if card is not None:
+            conditions.append(_compare(self.cards, operator.ne if card else operator.eq, NO_CODE))
+        if qr is not None:
+            conditions.append(_compare(self.qrs, operator.ne if qr else operator.eq, NO_CODE))
+        if user_ids is not None:
+            if np is not None:
+                conditions.append(np.isin(_view(self.user_ids), np.fromiter(user_ids, dtype = "q", count = len(user_ids))))
+            else:
+                conditions.append([user_id in user_ids for user_id in self.user_ids])
+
+        mask : Mask = np.ones(len(self), dtype = bool) if np is not None else [True] * len(self)
+        for condition in conditions:
+            mask = _both(mask, condition)
+        return mask
+
+    def select(self, mask : Mask) -> 'UserTable':
+        table = UserTable()
+
+        if np is not None:
+            indices = np.flatnonzero(mask)
+            for source, target in zip(self.columns(), table.columns()):
+                target.frombytes(_view(source)[indices].tobytes())
+            table.timesets.frombytes(_view(self.timesets).reshape(-1, user_data.TIMESET_COUNT)[indices].tobytes())
+            indices = indices.tolist()
+        else:
+            indices = [index for index, selected in enumerate(mask) if selected]
+            for source, target in zip(self.columns(), table.columns()):
+                target.extend(source[index] for index in indices)
+            for index in indices:
+                table.timesets.extend(self.timesets[index * user_data.TIMESET_COUNT : (index + 1) * user_data.TIMESET_COUNT])
+
+        table.names     = [self.names[index] for index in indices]
+        table.passwords = [self.passwords[index] for index in indices]
+        return table
+
+    def filter(self, **conditions) -> 'UserTable':
+        return self.select(self.where(**conditions))
+
+    # What changed from this table to newer, by user ID. User IDs are unique within a table, as on a device.
+    def diff(self, newer : 'UserTable') -> UserTableDiff:
+        if np is not None:
+            old_ids, new_ids = _view(self.user_ids), _view(newer.user_ids)
+            common, old_rows, new_rows = np.intersect1d(old_ids, new_ids, assume_unique = True, return_indices = True)
+
+            changed = np.zeros(len(common), dtype = bool)
+            for old_column, new_column in zip(self.columns(), newer.columns()):
+                changed |= _view(old_column)[old_rows] != _view(new_column)[new_rows]
+            changed |= (_view(self.timesets).reshape(-1, user_data.TIMESET_COUNT)[old_rows] !=
+                        _view(newer.timesets).reshape(-1, user_data.TIMESET_COUNT)[new_rows]).any(axis = 1)
+            # Strings stay Python objects; only the rows not already known to differ are compared.
+            for row in np.flatnonzero(~changed).tolist():
+                old_row, new_row = old_rows[row], new_rows[row]
+                changed[row] = self.names[old_row] != newer.names[new_row] or self.passwords[old_row] != newer.passwords[new_row]
+
+            return UserTableDiff(
+                added   = np.setdiff1d(new_ids, old_ids, assume_unique = True).tolist(),
+                removed = np.setdiff1d(old_ids, new_ids, assume_unique = True).tolist(),
+                changed = common[changed].tolist())
+
+        old_index = {user_id : row for row, user_id in enumerate(self.user_ids)}
+        new_index = {user_id : row for row, user_id in enumerate(newer.user_ids)}
+        changed_ids : List[int] = []
+        for user_id, new_row in new_index.items():
+            old_row = old_index.get(user_id, None)
+            if old_row is not None and self.row(old_row) != newer.row(new_row):
+                changed_ids.append(user_id)
+
+        return UserTableDiff(
+            added   = sorted(user_id for user_id in new_index if user_id not in old_index),
+            removed = sorted(user_id for user_id in old_index if user_id not in new_index),
+            changed = sorted(changed_ids))
+
+    # Every column of a row, for comparing rows one at a time.
+    def row(self, index : int) -> tuple:
+        return (*[column[index] for column in self.columns()],
+                self.timesets[index * user_data.TIMESET_COUNT : (index + 1) * user_data.TIMESET_COUNT],
+                self.names[index], self.passwords[index])
@@ -1,81 +1,123 @@
 from ast import parse
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import multiprocessing as mp
 import multiprocessing.connection as mpc
 from urllib import request
 import requests
 import secrets
-from xml.etree import ElementTree
+import threading
+import time
 
 from . import commands
+from .blob_store import BlobStore
+from . import message_scanner
+from .thread_pipe import ThreadConnection, thread_pipe
 from . import xml_consts
+from . import xml_templates
 
 LOG = logging.getLogger(__name__)
 
-def get_element_value(element : ElementTree.Element, name : str) -> Optional[str]:
-    child = element.find(name)
-    if child is None:
-        return None
-    else:
-        return child.text
+LOG_IMAGE_REF_KEY = "LogImageRef"
 
-def create_text_element(tag : str, text : str) -> ElementTree.Element:
-    result = ElementTree.Element(tag)
-    result.text = text
-    return result
+STATS_INTERVAL      : float = 1.0
+LATENCY_SMOOTHING   : float = 0.2
 
 
 class Worker:
     connection          : mpc.Connection
     webapp_url          : str
     device_logged_in    : Dict[int, bool]
+    blob_store          : Optional[BlobStore]
+    forward_logs        : bool
+    processed_count     : int
+    webapp_latency      : float
+    last_stats_time     : float
 
-    def __init__(self, conn : mpc.Connection, webapp_url : str):
+    def __init__(self, conn : mpc.Connection, webapp_url : str, blob_store : Optional[BlobStore] = None, forward_logs : bool = False):
         super().__init__()
 
         self.connection         = conn
         self.webapp_url         = webapp_url
         self.device_logged_in   = dict()
+        self.blob_store         = blob_store
+        self.forward_logs       = forward_logs
+        self.processed_count    = 0
+        self.webapp_latency     = 0.0
+        self.last_stats_time    = 0.0
 
     @classmethod
-    def run(cls, conn : mpc.Connection, webapp_url : str):
-        self = Worker(conn, webapp_url)
-
-        while True:
-            cmd, *args = conn.recv()
-            self.process_command(cmd, args)
+    def run(cls, conn : mpc.Connection, webapp_url : str, blob_store : Optional[BlobStore] = None, forward_logs : bool = False):
+        self = Worker(conn, webapp_url, blob_store, forward_logs)
+
+        try:
+            while True:
+                try:
+                    cmd, *args = conn.recv()
+                except EOFError:
+                    break
+
+                if cmd == commands.STOP_WORKER:
+                    self.report_stats()
+                    conn.send((commands.WORKER_STOPPED, ))
+                    break
+
+                self.process_command(cmd, args)
+
+                # Report when the queue runs dry so the balancer never sees a stale backlog.
+                if not conn.poll() or time.monotonic() - self.last_stats_time >= STATS_INTERVAL:
+                    self.report_stats()
+
+        finally:
+            # The balancer's reader of this pipe sees EOF instead of waiting forever.
+            conn.close()
+
+    def report_stats(self):
+        self.last_stats_time = time.monotonic()
+        self.connection.send((commands.WORKER_STATS, self.processed_count, self.webapp_latency))
+
+    def post_to_webapp(self, path : str, data : dict) -> requests.Response:
+        start_time = time.monotonic()
+        try:
+            return requests.post(self.webapp_url + path, json = data)
+        finally:
+            elapsed = time.monotonic() - start_time
+            self.webapp_latency += (elapsed - self.webapp_latency) * LATENCY_SMOOTHING
 
     def process_command(self, cmd : int, args : tuple):
         if cmd == commands.CLIENT_CONNECTED:
-            client_id, = args
+            client_id, logged_in = args
+            if logged_in:
+                self.device_logged_in[client_id] = True
 
         elif cmd == commands.CLIENT_DISCONNECTED:
             client_id, = args
             self.device_logged_in.pop(client_id, None)
 
         elif cmd == commands.MESSAGE_FROM_CLIENT:
+            self.processed_count += 1
             try:
                 client_id, message = args
-                parsed_msg = ElementTree.fromstring(message)
+                logged_in = self.device_logged_in.get(client_id, False)
+                scanned = message_scanner.scan_message(message, message_scanner.LOG_EVENTS if logged_in else ())
 
-                if (request := parsed_msg.find("Request")) is not None:
-                    match request.text:
+                if scanned.kind == message_scanner.KIND_REQUEST:
+                    match scanned.name:
                         case "Register":
-                            self.process_register_request(client_id, parsed_msg)
+                            self.process_register_request(client_id, scanned.fields)
                         case "Login":
-                            self.process_login_request(client_id, parsed_msg)
+                            self.process_login_request(client_id, scanned.fields)
                         case _:
                             pass
 
-                elif (event := parsed_msg.find("Event")) is not None:
-                    if self.device_logged_in.get(client_id, False):
-                        match event.text:
+                elif scanned.kind == message_scanner.KIND_EVENT:
+                    if logged_in:
+                        match scanned.name:
                             case "AdminLog" | "AdminLog_v2" | "TimeLog" | "TimeLog_v2":
-                                self.process_log(client_id, event.text, parsed_msg)
+                                self.process_log(client_id, scanned.name, scanned.fields)
 
                             case "KeepAlive":
-                                self.process_keepalive(client_id, parsed_msg)
+                                self.process_keepalive(client_id, scanned.fields)
 
                 else:
                     self.connection.send((commands.RESPONSE_FROM_DEVICE, client_id, message))
@@ -83,16 +125,16 @@ class Worker:
             except Exception as ex:
                 LOG.warning(f"Exception : {ex}")
 
-    def process_register_request(self, client_id : int, parsed_msg : ElementTree.Element):
-        sn = get_element_value(parsed_msg, xml_consts.TAG_DEVICE_SERIAL_NO)
+    def process_register_request(self, client_id : int, fields : Dict[str, Optional[str]]):
+        sn = fields.get(xml_consts.TAG_DEVICE_SERIAL_NO)
         if sn is None:
             return
 
-        terminal_type   = get_element_value(parsed_msg, "TerminalType")
-        product_name    = get_element_value(parsed_msg, "ProductName")
-        cloud_id        = get_element_value(parsed_msg, "CloudId")
+        terminal_type   = fields.get("TerminalType")
+        product_name    = fields.get("ProductName")
+        cloud_id        = fields.get("CloudId")
 
-        check_res = requests.post(self.webapp_url + "/device/check_registration", json = {
+        check_res = self.post_to_webapp("/device/check_registration", {
             "sn"            : sn,
             "terminal_type" : terminal_type,
             "product_name"  : product_name,
@@ -107,23 +149,18 @@ class Worker:
             if token is not None and token != "":
                 succeeded = True
 
-        response = ElementTree.Element(xml_consts.TAG_MESSAGE)
-        response.append(create_text_element(xml_consts.TAG_RESPONSE, "Register"))
-        response.append(create_text_element(xml_consts.TAG_DEVICE_SERIAL_NO, sn))
-        response.append(create_text_element(xml_consts.TAG_TOKEN, token))
-        response.append(create_text_element(xml_consts.TAG_RESULT, xml_consts.RESULT_OK if succeeded else xml_consts.RESULT_FAIL))
         self.connection.send((
             commands.SEND_MESSAGE_TO_CLIENT,
             client_id,
-            ElementTree.tostring(response, encoding = "unicode") ))
+            xml_templates.REGISTER_RESPONSE.render(sn, token, xml_consts.RESULT_OK if succeeded else xml_consts.RESULT_FAIL) ))
 
-    def process_login_request(self, client_id : int, parsed_msg : ElementTree.Element):
-        sn              = get_element_value(parsed_msg, xml_consts.TAG_DEVICE_SERIAL_NO)
-        token           = get_element_value(parsed_msg, xml_consts.TAG_TOKEN)
-        terminal_type   = get_element_value(parsed_msg, "TerminalType")
-        product_name    = get_element_value(parsed_msg, "ProductName")
+    def process_login_request(self, client_id : int, fields : Dict[str, Optional[str]]):
+        sn              = fields.get(xml_consts.TAG_DEVICE_SERIAL_NO)
+        token           = fields.get(xml_consts.TAG_TOKEN)
+        terminal_type   = fields.get("TerminalType")
+        product_name    = fields.get("ProductName")
 
-        check_res = requests.post(self.webapp_url + "/device/check_login", json = {
+        check_res = self.post_to_webapp("/device/check_login", {
             "sn"            : sn,
             "token"         : token
         })
@@ -138,14 +175,10 @@ class Worker:
             if result_str is None or result_str == "":
                 result_str = xml_consts.RESULT_FAIL
 
-        response = ElementTree.Element(xml_consts.TAG_MESSAGE)
-        response.append(create_text_element(xml_consts.TAG_RESPONSE, "Login"))
-        response.append(create_text_element(xml_consts.TAG_DEVICE_SERIAL_NO, sn))
-        response.append(create_text_element(xml_consts.TAG_RESULT, result_str))
         self.connection.send((
             commands.SEND_MESSAGE_TO_CLIENT,
             client_id,
-            ElementTree.tostring(response, encoding = "unicode") ))
+            xml_templates.LOGIN_RESPONSE.render(sn, result_str) ))
 
         if succeeded:
             self.device_logged_in[client_id] = True
@@ -158,48 +191,113 @@ class Worker:
                     "product_name"  : product_name,
                 } ))
 
-    def process_log(self, client_id : int, log_type : str, parsed_msg : ElementTree.Element):
-        data = {}
-        for child in parsed_msg:
-            data[child.tag] = child.text
+    def process_log(self, client_id : int, log_type : str, fields : Dict[str, Optional[str]]):
+        upload_data = fields
+        if self.blob_store is not None:
+            upload_data = self.offload_log_photo(fields)
 
-        upload_res = requests.post(self.webapp_url + f"/device/upload_log?type={log_type}", json = data)
+        # A copy for the balancer's log store, with the photo as a blob reference when it was offloaded.
+        if self.forward_logs and log_type in ("TimeLog", "TimeLog_v2"):
+            self.connection.send((commands.LOG_FROM_DEVICE, client_id, upload_data))
+
+        upload_res = self.post_to_webapp(f"/device/upload_log?type={log_type}", upload_data)
         succeeded : bool = False
         if upload_res.status_code == requests.codes.ok:
             succeeded = True
 
-        response = ElementTree.Element(xml_consts.TAG_MESSAGE)
-        response.append(create_text_element(xml_consts.TAG_RESPONSE, log_type))
-        response.append(create_text_element(xml_consts.TAG_RESULT, xml_consts.RESULT_OK if succeeded else xml_consts.RESULT_FAIL))
-        if "TransID" in data:
-            response.append(create_text_element("TransID", data["TransID"]))
-
         self.connection.send((
             commands.SEND_MESSAGE_TO_CLIENT,
             client_id,
-            ElementTree.tostring(response, encoding = "unicode") ))
+            xml_templates.render_log_ack(
+                log_type,
+                succeeded,
+                xml_consts.TAG_TRANS_ID in fields,
+                fields.get(xml_consts.TAG_TRANS_ID)) ))
     
-    def process_keepalive(self, client_id : int, parsed_msg : ElementTree.Element):
-        response = ElementTree.Element(xml_consts.TAG_MESSAGE)
-        response.append(create_text_element(xml_consts.TAG_RESPONSE, "KeepAlive"))
-        response.append(create_text_element(xml_consts.TAG_RESULT, xml_consts.RESULT_OK))
-
+    def offload_log_photo(self, fields : Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+        photo = fields.get(xml_consts.TAG_LOG_IMAGE)
+        if not photo:
+            return fields
+
+        try:
+            digest = self.blob_store.put_base64(photo)
+        # binascii.Error is a ValueError, and a non-ASCII string raises a plain one.
+        except (ValueError, OSError) as ex:
+            LOG.warning(f"Failed to store log photo, uploading it inline : {ex}")
+            return fields
+
+        upload_data = {tag : text for tag, text in fields.items() if tag != xml_consts.TAG_LOG_IMAGE}
+        upload_data[LOG_IMAGE_REF_KEY] = digest
+        return upload_data
+
+    def process_keepalive(self, client_id : int, fields : Dict[str, Optional[str]]):
         self.connection.send((
             commands.SEND_MESSAGE_TO_CLIENT,
             client_id,
-            ElementTree.tostring(response, encoding = "unicode") ))
+            xml_templates.KEEPALIVE_RESPONSE ))
 
 class WorkerHost:
-    workers : List[mp.Process]
+    context             : mp.context.BaseContext
+    webapp_url          : str
+    blob_store          : Optional[BlobStore]
+    forward_logs        : bool
+    next_worker_id      : int
+    workers             : Dict[int, mp.Process | threading.Thread]
 
-    def __init__(self, pipes : List[mpc.Connection], webapp_url : str):
+    def __init__(self, webapp_url : str, blob_store : Optional[BlobStore] = None, forward_logs : bool = False):
         super().__init__()
 
-        self.workers = [mp.Process(target = Worker.run, args = (x, webapp_url)) for x in pipes]
-        for process in self.workers:
-            process.daemon = True
-            process.start()
+        # Workers are also spawned while the balancer's threads are running, where forking is unsafe.
+        start_methods = mp.get_all_start_methods()
+        self.context            = mp.get_context("forkserver" if "forkserver" in start_methods else "spawn")
+        self.webapp_url         = webapp_url
+        self.blob_store         = blob_store
+        self.forward_logs       = forward_logs
+        self.next_worker_id     = 0
+        self.workers            = dict()
+
+    def spawn(self) -> Tuple[int, mpc.Connection]:
+        host_pipe, worker_pipe = self.create_pipe()
+        worker = self.start_worker(worker_pipe)
+
+        worker_id = self.next_worker_id
+        self.next_worker_id = worker_id + 1
+        self.workers[worker_id] = worker
+        return worker_id, host_pipe
+
+    def create_pipe(self) -> Tuple[mpc.Connection, mpc.Connection]:
+        return self.context.Pipe()
+
+    def start_worker(self, worker_pipe : mpc.Connection) -> mp.Process:
+        process = self.context.Process(target = Worker.run, args = (worker_pipe, self.webapp_url, self.blob_store, self.forward_logs))
+        process.daemon = True
+        process.start()
+        worker_pipe.close()
+        return process
+
+    def join(self, worker_id : int, timeout : Optional[float] = None):
+        process = self.workers.pop(worker_id, None)
+        if process is not None:
+            process.join(timeout)
+            # A worker stuck past the timeout is killed; a stuck thread is a daemon and is left behind.
+            if isinstance(process, mp.process.BaseProcess) and process.is_alive():
+                LOG.warning(f"Terminating worker {worker_id}, which did not exit")
+                process.terminate()
 
     def stop(self):
-        for process in self.workers:
+        for process in self.workers.values():
             process.join()
+        self.workers.clear()
+
+class ThreadWorkerHost(WorkerHost):
+    def create_pipe(self) -> Tuple[ThreadConnection, ThreadConnection]:
+        return thread_pipe()
+
+    def start_worker(self, worker_pipe : ThreadConnection) -> threading.Thread:
+        thread = threading.Thread(
+            target  = Worker.run,
+            args    = (worker_pipe, self.webapp_url, self.blob_store, self.forward_logs),
+            name    = f"worker-{self.next_worker_id}",
+            daemon  = True)
+        thread.start()
+        return thread
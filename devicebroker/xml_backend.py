@@ -0,0 +1,373 @@
+from abc import ABC, abstractmethod
+import itertools
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, Final, Iterator, Optional, Tuple
+from xml.etree import ElementTree
+
+from .xml_templates import render_element
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+LOG = logging.getLogger(__name__)
+
+ENV_BACKEND     : Final[str] = "DEVICEBROKER_XML_BACKEND"
+BACKEND_NAMES   : Final[Tuple[str, ...]] = ("stdlib", "lxml", "flat", "auto")
+
+CHUNK_SIZE          : Final[int] = 16384
+SMALL_MESSAGE_SIZE  : Final[int] = 4096
+
+class XmlBackend(ABC):
+    name : str = ""
+
+    # Root element of a whole message.
+    @abstractmethod
+    def parse(self, message : str | bytes) -> Any:
+        ...
+
+    # (tag, text) of each direct child of the root, in document order. Large messages are streamed so that
+    # a caller which stops early never pays for the rest.
+    @abstractmethod
+    def iter_children(self, message : str | bytes, chunk_size : int = CHUNK_SIZE) -> Iterator[Tuple[str, Optional[str]]]:
+        ...
+
+    @abstractmethod
+    def element(self, tag : str, text : Optional[str] = None) -> Any:
+        ...
+
+    @abstractmethod
+    def tostring(self, root : Any) -> str:
+        ...
+
+# Works on both ElementTree and lxml elements, so trees never mix element types.
+def sub_element(parent : Any, tag : str, text : Optional[str] = None) -> Any:
+    child = parent.makeelement(tag, {})
+    child.text = text
+    parent.append(child)
+    return child
+
+class StdlibBackend(XmlBackend):
+    name = "stdlib"
+
+    def parse(self, message : str | bytes) -> ElementTree.Element:
+        return ElementTree.fromstring(message)
+
+    def make_pull_parser(self) -> Any:
+        return ElementTree.XMLPullParser(events = ("start", "end"))
+
+    def feed(self, parser : Any, chunk : str | bytes):
+        parser.feed(chunk)
+
+    def iter_children(self, message : str | bytes, chunk_size : int = CHUNK_SIZE) -> Iterator[Tuple[str, Optional[str]]]:
+        # Small frames are cheaper to parse in one go; the tree is tiny and is walked once.
+        if len(message) <= SMALL_MESSAGE_SIZE:
+            for elem in self.parse(message):
+                yield elem.tag, elem.text
+            return
+
+        parser = self.make_pull_parser()
+        root  : Any = None
+        depth : int = 0
+
+        for offset in range(0, max(len(message), 1), chunk_size):
+            self.feed(parser, message[offset : offset + chunk_size])
+
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if depth == 0:
+                        root = elem
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth != 1:
+                    continue
+
+                # Direct child of the root element : hand it out and drop it so the tree never grows.
+                root.remove(elem)
+                yield elem.tag, elem.text
+
+        parser.close()
+
+    def element(self, tag : str, text : Optional[str] = None) -> ElementTree.Element:
+        elem = ElementTree.Element(tag)
+        elem.text = text
+        return elem
+
+    def tostring(self, root : ElementTree.Element) -> str:
+        return ElementTree.tostring(root, encoding = "unicode")
+
+# Entities are never resolved, and the huge tree option lets through the megabyte-sized base64 fields that
+# libxml2 would otherwise refuse.
+_LXML_OPTIONS : Final[Dict[str, Any]] = dict(
+    encoding            = "utf-8",
+    resolve_entities    = False,
+    no_network          = True,
+    huge_tree           = True,
+    remove_comments     = True,
+    remove_pis          = True,
+)
+
+class LxmlBackend(StdlibBackend):
+    name = "lxml"
+
+    local : threading.local
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def make_parser(self) -> Any:
+        return lxml_etree.XMLParser(**_LXML_OPTIONS)
+
+    # lxml parsers are not meant to be shared between threads.
+    def parser(self) -> Any:
+        parser = getattr(self.local, "parser", None)
+        if parser is None:
+            parser = self.local.parser = self.make_parser()
+        return parser
+
+    # lxml refuses str input that carries an encoding declaration, so text is always handed over as UTF-8, which
+    # is also what devices send.
+    def parse(self, message : str | bytes) -> Any:
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        try:
+            return lxml_etree.fromstring(message, self.parser())
+        except lxml_etree.XMLSyntaxError as ex:
+            raise ElementTree.ParseError(str(ex)) from ex
+
+    def make_pull_parser(self) -> Any:
+        return lxml_etree.XMLPullParser(events = ("start", "end"), **_LXML_OPTIONS)
+
+    def feed(self, parser : Any, chunk : str | bytes):
+        parser.feed(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+
+    def iter_children(self, message : str | bytes, chunk_size : int = CHUNK_SIZE) -> Iterator[Tuple[str, Optional[str]]]:
+        try:
+            yield from super().iter_children(message, chunk_size)
+        except lxml_etree.XMLSyntaxError as ex:
+            raise ElementTree.ParseError(str(ex)) from ex
+
+    def element(self, tag : str, text : Optional[str] = None) -> Any:
+        elem = lxml_etree.Element(tag)
+        elem.text = text
+        return elem
+
+    def tostring(self, root : Any) -> str:
+        if isinstance(root, ElementTree.Element):
+            return super().tostring(root)
+        return lxml_etree.tostring(root, encoding = "unicode")
+
+class FlatScanError(ValueError):
+    # Children already handed out when the scan gave up.
+    count : int = 0
+
+# Children are childless, attribute-free elements, either self-closing or holding plain text. Short text is taken
+# by one regex match ; longer text runs up to the next "<", found with str.find, which is far quicker than a regex
+# over megabyte-sized base64 fields. When that "<" does not close the element (nesting, comments, CDATA) the message
+# is left to a real parser.
+SHORT_TEXT_SIZE : Final[int] = 1024
+
+_ROOT_OPEN      = re.compile(r"(?:<\?xml[^>]*\?>)?[ \t\r\n]*<([A-Za-z_][\w.\-]*)[ \t\r\n]*(/?)>")
+_ROOT_CLOSE     = re.compile(r"[ \t\r\n]*</([A-Za-z_][\w.\-]*)[ \t\r\n]*>[ \t\r\n]*\Z")
+_CHILD          = re.compile(r"[ \t\r\n]*<([A-Za-z_][\w.\-]*)[ \t\r\n]*(?:/>|>([^<]{0,%d})</\1[ \t\r\n]*>)" % SHORT_TEXT_SIZE)
+_CHILD_OPEN     = re.compile(r"[ \t\r\n]*<([A-Za-z_][\w.\-]*)[ \t\r\n]*>")
+_CHILD_CLOSE    = re.compile(r"</([A-Za-z_][\w.\-]*)[ \t\r\n]*>")
+_BLANK          = re.compile(r"[ \t\r\n]*\Z")
+_ENTITY         = re.compile(r"&([^&;]*)(;?)")
+_ENTITIES       : Final[Dict[str, str]] = {"amp" : "&", "lt" : "<", "gt" : ">", "quot" : '"', "apos" : "'"}
+
+# Characters expat rejects as invalid tokens. Each is looked for with its own str.find rather than a character
+# class, which runs several times slower than the scan itself on large messages.
+_CONTROL_CHARS  : Final[Tuple[str, ...]] = tuple(chr(code) for code in range(0x20) if code not in (0x09, 0x0A, 0x0D))
+_NON_CHARACTERS : Final[Tuple[str, ...]] = ("\ufffe", "\uffff")
+
+def _replace_entity(match : re.Match) -> str:
+    name, semicolon = match.groups()
+    if not semicolon:
+        raise FlatScanError("Unterminated entity reference")
+
+    value = _ENTITIES.get(name, None)
+    if value is not None:
+        return value
+
+    try:
+        if name.startswith("#x"):
+            code = int(name[2 :], 16)
+        elif name.startswith("#"):
+            code = int(name[1 :], 10)
+        else:
+            raise FlatScanError(f"Unknown entity : {name}")
+    except ValueError:
+        raise FlatScanError(f"Bad character reference : {name}")
+
+    if code == 0 or 0xD800 <= code <= 0xDFFF or code > 0x10FFFF:
+        raise FlatScanError(f"Bad character reference : {name}")
+    return chr(code)
+
+def _decode_text(text : str) -> str:
+    if "]]>" in text:
+        raise FlatScanError("Stray CDATA end")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if "&" in text:
+        text = _ENTITY.sub(_replace_entity, text)
+    return text
+
+def _check_chars(message : str):
+    # Short frames on a single line, most of what devices send, are settled in one pass.
+    if len(message) <= SMALL_MESSAGE_SIZE and message.isprintable():
+        return
+
+    if any(char in message for char in _CONTROL_CHARS):
+        raise FlatScanError("Control character")
+    if message.isascii():
+        return
+
+    if any(char in message for char in _NON_CHARACTERS):
+        raise FlatScanError("Non-character")
+    try:
+        message.encode("utf-8")
+    except UnicodeEncodeError:
+        raise FlatScanError("Surrogate character")
+
+def _open_flat(message : str) -> Tuple[str, int, bool]:
+    _check_chars(message)
+
+    match = _ROOT_OPEN.match(message)
+    if match is None:
+        raise FlatScanError("Unsupported root element")
+
+    root_tag, empty = match.groups()
+    if empty and _BLANK.match(message, match.end()) is None:
+        raise FlatScanError("Content after the root element")
+    return root_tag, match.end(), bool(empty)
+
+def _iter_flat(message : str, root_tag : str, pos : int) -> Iterator[Tuple[str, Optional[str]]]:
+    match_child = _CHILD.match
+    match_open  = _CHILD_OPEN.match
+    match_close = _CHILD_CLOSE.match
+    find        = message.find
+    count       = 0
+    try:
+        while True:
+            match = match_child(message, pos)
+            if match is not None:
+                tag, text = match.groups()
+                pos = match.end()
+            else:
+                match = match_open(message, pos)
+                if match is None:
+                    break
+                tag   = match.group(1)
+                start = match.end()
+                end   = find("<", start)
+                match = match_close(message, end) if end >= 0 else None
+                if match is None or match.group(1) != tag:
+                    break
+                text = message[start : end]
+                pos  = match.end()
+
+            if not text:
+                text = None
+            elif "&" in text or "\r" in text or "]]>" in text:
+                text = _decode_text(text)
+            yield tag, text
+            count += 1
+
+        match = _ROOT_CLOSE.match(message, pos)
+        if match is None or match.group(1) != root_tag:
+            raise FlatScanError("Unsupported content")
+    except FlatScanError as ex:
+        ex.count = count
+        raise
+
+# A scanner for the one shape devices actually send : a root holding childless, attribute-free elements. Whatever
+# falls outside that shape is handed to the stdlib parser, which also gets to report malformed input.
+class FlatBackend(StdlibBackend):
+    name = "flat"
+
+    def parse(self, message : str | bytes) -> ElementTree.Element:
+        if isinstance(message, str):
+            try:
+                root_tag, pos, empty = _open_flat(message)
+                root = ElementTree.Element(root_tag)
+                if not empty:
+                    for tag, text in _iter_flat(message, root_tag, pos):
+                        ElementTree.SubElement(root, tag).text = text
+                return root
+            except FlatScanError:
+                pass
+        return super().parse(message)
+
+    def iter_children(self, message : str | bytes, chunk_size : int = CHUNK_SIZE) -> Iterator[Tuple[str, Optional[str]]]:
+        if not isinstance(message, str):
+            yield from super().iter_children(message, chunk_size)
+            return
+
+        try:
+            root_tag, pos, empty = _open_flat(message)
+            if not empty:
+                yield from _iter_flat(message, root_tag, pos)
+        except FlatScanError as ex:
+            # Start over with the real parser and skip what the caller has already seen.
+            yield from itertools.islice(super().iter_children(message, chunk_size), ex.count, None)
+
+    def tostring(self, root : ElementTree.Element) -> str:
+        if root.attrib or root.text or not isinstance(root.tag, str) or "{" in root.tag:
+            return super().tostring(root)
+
+        parts = [f"<{root.tag}>"]
+        for child in root:
+            if len(child) or child.attrib or child.tail or not isinstance(child.tag, str) or "{" in child.tag:
+                return super().tostring(root)
+            parts.append(render_element(child.tag, child.text))
+
+        if len(parts) == 1:
+            return f"<{root.tag} />"
+        parts.append(f"</{root.tag}>")
+        return "".join(parts)
+
+_backends : Dict[str, XmlBackend] = {
+    "stdlib"    : StdlibBackend(),
+    "flat"      : FlatBackend(),
+}
+if lxml_etree is not None:
+    _backends["lxml"] = LxmlBackend()
+
+def available() -> Tuple[str, ...]:
+    return tuple(_backends.keys())
+
+def get(name : str) -> XmlBackend:
+    if name not in BACKEND_NAMES:
+        raise ValueError(f"Unknown XML backend : {name}")
+
+    if name == "auto":
+        name = "lxml" if "lxml" in _backends else "flat"
+
+    backend = _backends.get(name, None)
+    if backend is None:
+        LOG.warning(f"XML backend {name} is not installed, using stdlib")
+        backend = _backends["stdlib"]
+    return backend
+
+_current : XmlBackend = _backends["stdlib"]
+
+def current() -> XmlBackend:
+    return _current
+
+# Process-wide, set by __main__ or ENV_BACKEND : it applies to device_cmd parsing and building in the balancer
+# process. Workers never use it, their frames always go through the flat scanner.
+def select(name : str) -> XmlBackend:
+    global _current
+    _current = get(name)
+    return _current
+
+if os.environ.get(ENV_BACKEND):
+    select(os.environ[ENV_BACKEND])
@@ -5,6 +5,8 @@ TAG_RESPONSE            : Final[str] = "Response"
 TAG_DEVICE_SERIAL_NO    : Final[str] = "DeviceSerialNo"
 TAG_TOKEN               : Final[str] = "Token"
 TAG_RESULT              : Final[str] = "Result"
+TAG_TRANS_ID            : Final[str] = "TransID"
+TAG_LOG_IMAGE           : Final[str] = "LogImage"
 
 RESULT_OK               : Final[str] = "OK"
 RESULT_FAIL             : Final[str] = "Fail"
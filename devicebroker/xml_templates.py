@@ -0,0 +1,66 @@
+from typing import Dict, Final, List, Optional, Tuple
+
+from . import xml_consts
+
+def escape_text(text : str) -> str:
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+# Same output as ElementTree.tostring for a childless element without attributes.
+def render_element(tag : str, text : Optional[str]) -> str:
+    if text:
+        return f"<{tag}>{escape_text(text)}</{tag}>"
+    else:
+        return f"<{tag} />"
+
+class ResponseTemplate:
+    prefix  : str
+    slots   : List[Tuple[str, str, str]]
+    suffix  : str
+
+    def __init__(self, response : str, *slot_tags : str):
+        super().__init__()
+
+        self.prefix = f"<{xml_consts.TAG_MESSAGE}>" + render_element(xml_consts.TAG_RESPONSE, response)
+        self.slots  = [(f"<{tag}>", f"</{tag}>", f"<{tag} />") for tag in slot_tags]
+        self.suffix = f"</{xml_consts.TAG_MESSAGE}>"
+
+    def render(self, *values : Optional[str]) -> str:
+        assert len(values) == len(self.slots)
+
+        parts = [self.prefix]
+        for (open_tag, close_tag, empty_tag), value in zip(self.slots, values):
+            if value:
+                parts.append(open_tag)
+                parts.append(escape_text(value))
+                parts.append(close_tag)
+            else:
+                parts.append(empty_tag)
+        parts.append(self.suffix)
+        return "".join(parts)
+
+REGISTER_RESPONSE   : Final[ResponseTemplate] = ResponseTemplate("Register", xml_consts.TAG_DEVICE_SERIAL_NO, xml_consts.TAG_TOKEN, xml_consts.TAG_RESULT)
+LOGIN_RESPONSE      : Final[ResponseTemplate] = ResponseTemplate("Login", xml_consts.TAG_DEVICE_SERIAL_NO, xml_consts.TAG_RESULT)
+KEEPALIVE_RESPONSE  : Final[str] = ResponseTemplate("KeepAlive", xml_consts.TAG_RESULT).render(xml_consts.RESULT_OK)
+
+_log_ack_templates : Dict[Tuple[str, bool], ResponseTemplate] = dict()
+
+def render_log_ack(log_type : str, succeeded : bool, has_trans_id : bool, trans_id : Optional[str] = None) -> str:
+    template = _log_ack_templates.get((log_type, has_trans_id), None)
+    if template is None:
+        if has_trans_id:
+            template = ResponseTemplate(log_type, xml_consts.TAG_RESULT, xml_consts.TAG_TRANS_ID)
+        else:
+            template = ResponseTemplate(log_type, xml_consts.TAG_RESULT)
+        _log_ack_templates[(log_type, has_trans_id)] = template
+
+    result = xml_consts.RESULT_OK if succeeded else xml_consts.RESULT_FAIL
+    if has_trans_id:
+        return template.render(result, trans_id)
+    else:
+        return template.render(result)
@@ -0,0 +1,38 @@
+import datetime
+
+import pytest
+
+from devicebroker.device_cmd.m50 import device_control, log
+
+def glog_response(time_elem : str) -> str:
+    return ("<Message><Response>GetFirstGlog</Response><Result>OK</Result><LogID>7</LogID>"
+            f"{time_elem}<UserID>12</UserID><AttendStat>0</AttendStat><Photo>No</Photo></Message>")
+
+def parse_glog(message : str) -> log.GetGlogResponse:
+    response = log.GetGlogResponse()
+    response.parse_message(message)
+    return response
+
+def test_time_log_time():
+    record = parse_glog(glog_response("<Time>2024-05-06-T07:08:09Z</Time>")).log
+    assert record.log_id == 7
+    assert record.time == datetime.datetime(2024, 5, 6, 7, 8, 9)
+
+# One record with a bad clock must not stop a whole log walk : its time reads as None, like a missing one.
+@pytest.mark.parametrize("time_elem", ["<Time>garbage</Time>", "<Time></Time>", "<Time/>", ""])
+def test_time_log_bad_time(time_elem : str):
+    record = parse_glog(glog_response(time_elem)).log
+    assert record.log_id == 7
+    assert record.user_id == 12
+    assert record.time is None
+
+def test_time_log_event_bad_time():
+    record = log.decode_time_log({"LogID" : "3", "Time" : "garbage", "UserID" : "4"})
+    assert record.time is None
+    assert record.user_id == 4
+
+# GetTime has nothing else to offer : a bad answer is still an error.
+def test_get_time_bad_time():
+    response = device_control.GetTimeResponse()
+    with pytest.raises(ValueError):
+        response.parse_message("<Message><Response>GetTime</Response><Result>OK</Result><Time>garbage</Time></Message>")
@@ -0,0 +1,132 @@
+import enum
+import os
+import sys
+from typing import Any, List, Tuple
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+import m50_fixtures
+from devicebroker import message_scanner, xml_backend
+from devicebroker.device_cmd import messages
+
+# Everything is compared against the stdlib backend, which is what the broker used before backends existed.
+REFERENCE = "stdlib"
+
+REQUESTS    = m50_fixtures.make_requests(4096)
+RESPONSES   = m50_fixtures.make_responses(4096)
+FRAMES      = m50_fixtures.make_frames(4096)
+
+# lxml is optional : it is tested wherever it is installed, and reported as skipped elsewhere.
+BACKENDS = [
+    pytest.param(name, marks = pytest.mark.skipif(name not in xml_backend.available(), reason = f"{name} is not installed"))
+    for name in ("stdlib", "flat", "lxml")
+]
+
+# Plain values for comparing parsed responses, whatever objects they hold.
+def snapshot(value : Any) -> Any:
+    if isinstance(value, enum.Enum):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [snapshot(item) for item in value]
+    if isinstance(value, dict):
+        return {key : snapshot(item) for key, item in value.items()}
+    names = set(getattr(value, "__dict__", ()))
+    for cls in type(value).__mro__:
+        names.update(slot.lstrip("_") for slot in cls.__dict__.get("__slots__", ()))
+    if len(names) > 0:
+        return (type(value).__name__, {name : snapshot(getattr(value, name)) for name in sorted(names) if hasattr(value, name)})
+    return value
+
+def children(backend : xml_backend.XmlBackend, message : str) -> List[Tuple[str, Any]]:
+    return list(backend.iter_children(message))
+
+def tree_children(backend : xml_backend.XmlBackend, message : str) -> List[Tuple[str, Any]]:
+    return [(elem.tag, elem.text) for elem in backend.parse(message)]
+
+def parse_response(request_type : type, message : str) -> Any:
+    response = request_type()
+    if isinstance(response, messages.GenericResponse):
+        response.parse_message(message)
+    else:
+        response.parse(xml_backend.current().parse(message))
+    return response
+
+@pytest.fixture
+def backend(request) -> xml_backend.XmlBackend:
+    backend = xml_backend.select(request.param)
+    yield backend
+    xml_backend.select(REFERENCE)
+
+def test_fixtures_cover_every_message():
+    m50_fixtures.check_coverage()
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect = True)
+@pytest.mark.parametrize("name, request_obj", REQUESTS, ids = [name for name, _ in REQUESTS])
+def test_request(backend : xml_backend.XmlBackend, name : str, request_obj : messages.GenericRequest):
+    reference = xml_backend.get(REFERENCE)
+    message = request_obj.to_str()
+    expected = children(reference, message)
+
+    assert bytes(request_obj.to_bytes()) == message.encode("utf-8")
+    assert children(backend, message) == expected
+    assert tree_children(backend, message) == expected
+    assert children(reference, backend.tostring(request_obj.to_xml())) == expected
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect = True)
+@pytest.mark.parametrize("name, response_type, message", RESPONSES, ids = [name for name, _, _ in RESPONSES])
+def test_response(backend : xml_backend.XmlBackend, name : str, response_type : type, message : str):
+    reference = xml_backend.get(REFERENCE)
+    expected = children(reference, message)
+
+    assert children(backend, message) == expected
+    assert tree_children(backend, message) == expected
+
+    xml_backend.select(REFERENCE)
+    expected_response = snapshot(parse_response(response_type, message))
+    xml_backend.select(backend.name)
+    assert snapshot(parse_response(response_type, message)) == expected_response
+
+# Frames are classified with the flat scanner whatever backend is selected; it must agree with a real parser.
+@pytest.mark.parametrize("backend", BACKENDS, indirect = True)
+@pytest.mark.parametrize("name, frame", FRAMES, ids = [name for name, _ in FRAMES])
+def test_frame_children(backend : xml_backend.XmlBackend, name : str, frame : str):
+    assert children(backend, frame) == children(xml_backend.get(REFERENCE), frame)
+
+@pytest.mark.parametrize("name, frame", FRAMES, ids = [name for name, _ in FRAMES])
+def test_scan_message(name : str, frame : str):
+    scanned = message_scanner.scan_message(frame, full_events = message_scanner.LOG_EVENTS)
+    fields = dict(children(xml_backend.get(REFERENCE), frame))
+
+    assert scanned.name == fields.get(message_scanner.TAG_REQUEST, fields.get(message_scanner.TAG_EVENT, None))
+    for tag, text in scanned.fields.items():
+        assert fields[tag] == text
+
+# Shapes outside the flat dialect are handed to a real parser, and malformed input fails the same way.
+@pytest.mark.parametrize("backend", BACKENDS, indirect = True)
+@pytest.mark.parametrize("message", [
+    "<Message><Request>A</Request><Nested><Child>1</Child></Nested></Message>",
+    "<Message><Request a=\"1\">A</Request></Message>",
+    "<Message><!-- note --><Request>A</Request></Message>",
+    "<Message><Request><![CDATA[A<B]]></Request></Message>",
+    "<Message><Request>A &amp; B &#x41;</Request></Message>",
+    "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\r\n<Message>\r\n<Request>A\r\nB</Request>\r\n</Message>",
+])
+def test_irregular_message(backend : xml_backend.XmlBackend, message : str):
+    expected = children(xml_backend.get(REFERENCE), message)
+    assert children(backend, message) == expected
+    assert tree_children(backend, message) == expected
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect = True)
+@pytest.mark.parametrize("message", [
+    "<Message><Request>A</Request>",
+    "<Message><Request>A</Reqest></Message>",
+    "<Message><Request>A &bogus; B</Request></Message>",
+    "<Message><Request>A\x01B</Request></Message>",
+])
+def test_malformed_message(backend : xml_backend.XmlBackend, message : str):
+    with pytest.raises(xml_backend.ElementTree.ParseError):
+        children(backend, message)
+    with pytest.raises(xml_backend.ElementTree.ParseError):
+        backend.parse(message)